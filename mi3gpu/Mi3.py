@@ -19,10 +19,12 @@
 #Contact: allan.haldane _AT_ gmail.com
 
 import sys, os, errno, time, datetime, socket, signal, atexit
+import copy, functools
+from concurrent.futures import ThreadPoolExecutor
 import configargparse
 from pathlib import Path
 import numpy as np
-from numpy.random import randint, rand
+from numpy.random import randint
 from scipy.special import logsumexp
 import pyopencl as cl
 import pyopencl.array as cl_array
@@ -33,10 +35,13 @@ version = pkg_resources.require("mi3gpu")[0].version
 import mi3gpu
 import mi3gpu.NewtonSteps
 from mi3gpu.utils.seqload import loadSeqs, writeSeqs
-from mi3gpu.utils.changeGauge import fieldlessGaugeEven
+from mi3gpu.utils.changeGauge import (fieldlessGaugeEven,
+                                      fieldlessGaugeDistributed)
 from mi3gpu.utils import printsome, getLq, getUnimarg, validate_bimarg
 from mi3gpu.mcmcGPU import (setup_GPU_context, initGPU, wgsize_heuristic,
-                            printGPUs)
+                            seqbits_heuristic, printGPUs, jstep_log_max)
+from mi3gpu.mcmcCPU import initCPU
+from mi3gpu.cpu_pool import start_cpu_pool
 from mi3gpu.node_manager import GPU_node
 
 try:
@@ -110,23 +115,87 @@ def optionRegistry():
     # GPU options
     add('nwalkers', type=np.uint32,
         help="Number of MC walkers")
+    add('start_walkers', type=int, default=None,
+        help=("Number of MC walkers in the first rounds of inference. The "
+              "walkers are doubled, up to NWALKERS, each time the SSR falls "
+              "below GROW_SSR times its statistical value"))
+    add('grow_ssr', type=float, default=2.0,
+        help="SSR factor at which the walkers are doubled, see start_walkers")
     add('nsteps', type=np.uint32, default=2048,
         help="number of mc steps per kernel call")
     add('wgsize', default=512, help="GPU workgroup size")
     add('gpus',
         help="GPUs to use (comma-sep list of platforms #s, eg '0,0')")
+    add('backend', default='opencl', choices=['opencl', 'cpu'],
+        help="run MCMC using OpenCL devices, or on the host CPU using numpy")
+    add('ncpus', type=int,
+        help="number of worker processes for the cpu backend (default: all)")
+    add('sampler', default='auto',
+        choices=['auto', 'metropolis', 'fields', 'gibbs'],
+        help=("MCMC update: 'metropolis' proposes a random residue, 'fields' "
+              "does the same using a per-walker table of local fields "
+              "(faster at low acceptance rates, uses more memory), 'auto' "
+              "switches between these two based on the acceptance rate, and "
+              "'gibbs' (heat-bath) resamples the residue from its "
+              "conditional distribution"))
+    add('schedule', default='random',
+        choices=['random', 'sweep', 'permutation'],
+        help=("order of the positions at which mutations are proposed: "
+              "independent random positions, systematic sweeps over the "
+              "sequence, or sweeps in a random order"))
+    add('proposal', default='uniform',
+        choices=['uniform', 'indep', 'adaptive'],
+        help=("distribution of the residues proposed by the metropolis "
+              "samplers: uniform, the independent-model marginals (of the "
+              "target bimarg, or --indep_marg), or 'adaptive' which starts "
+              "from these marginals if available and tunes them from the "
+              "acceptance rate of each residue at each position. Non-uniform "
+              "proposals are accepted with the Hastings correction"))
+    add('gap_moves', type=int, default=0,
+        help=("number of gap-block moves per walker after each MCMC kernel "
+              "call, which insert, delete or shift contiguous blocks of gaps "
+              "as a single move. 0 disables them"))
+    add('gap_letter', default='-',
+        help="the gap letter of the alphabet, used by --gap_moves")
+    add('jumps', type=float, default=0,
+        help=("probability per walker per MCMC kernel call of proposing to "
+              "replace its sequence by an independent-model sequence, or one "
+              "from --jump_msa, accepted with the Metropolis-Hastings "
+              "criterion. Helps walkers escape from local minima"))
+    add('jump_msa',
+        help=("sequence file of the sequences proposed by --jumps, each with "
+              "a small fraction of residues redrawn from the independent "
+              "model"))
+    add('precision', default='single', choices=['single', 'half'],
+        help=("storage precision of the couplings used by the MCMC and "
+              "energy kernels. 'half' halves the coupling memory traffic, "
+              "while still summing in single precision. Use "
+              "--measurefperror to check the resulting error"))
+    add('jlayout', default='auto', choices=['auto', 'packed', 'unpacked'],
+        help=("layout of the couplings read by the MCMC kernels. 'unpacked' "
+              "stores each coupling twice, in L*L*q*q floats, which may be "
+              "faster. 'auto' uses it only if it fits in GPU memory and is "
+              "faster on the first kernel calls"))
+    add('seqbits', default='auto', choices=['auto', '8', '4', '2'],
+        help=("bits per residue in the GPU sequence buffers. 'auto' uses the "
+              "fewest which fit the alphabet (4 for q <= 16, 2 for q <= 4), "
+              "which reduces sequence memory and bandwidth"))
     add('profile', action='store_true',
         help="enable OpenCL profiling")
     add('nlargebuf', type=np.uint32, default=1,
         help='size of large seq buffer, in multiples of nwalkers')
     add('measurefperror', action='store_true',
-        help="enable fp error calculation")
+        help=("after each MCMC round, compare walker energies to exact "
+              "double precision energies and estimate the resulting "
+              "bimarg error (slow)"))
     add('beta', type=np.float32,
         help="beta at which to generate sequences")
 
     # Newton options
-    add('bimarg',
-        help="Target bivariate marginals (npy file)")
+    add('bimarg', nargs='+',
+        help=("Target bivariate marginals (npy file). If several are given, "
+              "a model is fit to each of them in one process, see "
+              "UserGuide"))
     add('mcsteps', type=np.uint32, default=64,
         help="Number of rounds of MCMC generation")
     add('newtonsteps', default=1024, type=np.uint32,
@@ -135,6 +204,26 @@ def optionRegistry():
         help="Newton step number tuning scale")
     add('fracNeff', type=np.float32, default=0.9,
         help="stop coupling updates after Neff/N = fracNeff")
+    add('optimizer', default='newton',
+        choices=['newton', 'linesearch', 'nesterov', 'rmsprop', 'adam'],
+        help="Method used to compute the coupling updates, see UserGuide")
+    add('momentum', type=np.float32, default=0.9,
+        help="Momentum of the 'nesterov' optimizer")
+    add('newton_batch', type=int, default=16,
+        help=("Number of coupling updates queued on the GPUs before Neff is "
+              "checked on the host"))
+    add('stop_floor', type=float, default=None,
+        help=("Stop when the SSR, rel%% and X errors averaged over the last "
+              "STOP_WINDOW rounds are within this factor of their expected "
+              "statistical error"))
+    add('stop_plateau', type=float, default=None,
+        help=("Stop when the SSR and rel%% errors decrease, and X changes, by "
+              "less than this fraction over the last STOP_WINDOW rounds"))
+    add('stop_window', type=int, default=4,
+        help="Number of rounds used by --stop_floor and --stop_plateau")
+    add('mbar_rounds', type=int, default=1,
+        help=("Number of MCMC rounds whose samples are kept and combined "
+              "using MBAR weights in the coupling updates"))
     add('gamma', type=np.float32, default=0.0004,
         help="Initial step size")
     add('damping', default=0.001, type=float,
@@ -168,6 +257,10 @@ def optionRegistry():
     add('indep_marg',
         help="marg (uni or bi to convert to uni) used to generate "
              "site-independent sequences")
+    add('clamp',
+        help="Positions clamped to fixed residues during sampling, as a comma "
+             "separated list of POS:RES items with positions counted from 0, "
+             "eg '12:K,40:A'")
 
     # Sampling Param
     add('equiltime', default='auto',
@@ -182,9 +275,28 @@ def optionRegistry():
         help='Data saved to "equilibration" dir when trackequil is enabled. '
              'Comma separated allowed options: "bim", "E", "seq"')
     add('tempering',
-        help='optional inverse Temperature schedule')
+        help='Inverse temperatures for parallel tempering, as a comma '
+             'separated list or a .npy file. The walkers are divided '
+             'evenly among the temperatures, and results are computed from '
+             'the walkers at the lowest temperature')
     add('nswaps_temp', type=np.uint32, default=128,
-        help='optional number of pt swaps')
+        help='number of rounds of replica exchange between neighboring '
+             'temperatures after every MCMC kernel call')
+    add('annealing',
+        help='Inverse temperature schedule for population annealing, as a '
+             'comma separated list or a .npy file. Before equilibration the '
+             'walkers are run at each temperature in turn and resampled in '
+             'proportion to their Boltzmann weights between steps. The '
+             'target temperature is appended if it is not the last one')
+    add('anneal_loops', type=np.uint32, default=4,
+        help='number of MCMC kernel calls at each annealing temperature')
+    add('nsamples', type=np.uint32, default=1,
+        help='number of samples of each walker per MCMC round. After '
+             'equilibration the walkers are stored in the large buffer every '
+             'SAMPLE_LOOPS MCMC kernel calls, and the Newton steps use all '
+             'the stored sequences')
+    add('sample_loops', type=np.uint32, default=4,
+        help='number of MCMC kernel calls between samples with --nsamples')
 
     return dict(options)
 
@@ -222,16 +334,76 @@ def setup_seed(args, p, log):
 
 def describe_tempering(args, p, log):
     if p.tempering is not None:
-        if len(p.tempering) == p.nwalkers:
-            msg = (f"The walkers are assigned temperatures from "
-                   f"file {args.tempering}")
-        else:
-            msg = (f"The walkers are divided into {p.tempering} temperature "
-                   f"groups ({args.tempering})")
+        log(f"Parallel tempering: The walkers are divided into "
+            f"{len(p.tempering)} temperature groups ({args.tempering}), and "
+            f"neighbor temperatures are swapped {p.nswaps} times after every "
+            f"MCMC loop. The low-temperature B is {np.max(p.tempering)}")
+
+def setup_jumps(args, p, gpus, unimarg, log):
+    if not p.jumps:
+        return
+    msaseqs = None
+    if args.jump_msa is not None:
+        msaseqs = loadSequenceFile(args.jump_msa, p.alpha, log)
+        log(f"Jumps are proposed to sequences from {args.jump_msa}")
+    elif unimarg is None:
+        raise ValueError("jumps require independent-model marginals, or "
+                         "--jump_msa")
+    gpus.initJumps(p.jumps, unimarg, msaseqs)
+
+def process_indep_args(args, L, q, log, needed=True, required=None):
+    # load the independent-model marginals from indep_marg, or else from the
+    # bimarg of init_model. If they are not found, raise with the message
+    # "indep_marg must be supplied <required>" if required is given
+    if not needed:
+        return None
+
+    fn = None
+    if args.indep_marg is not None:
+        fn = args.indep_marg
+    elif args.init_model and Path(args.init_model, 'bimarg.npy').is_file():
+        fn = Path(args.init_model, 'bimarg.npy')
+    if fn is None:
+        if required is not None:
+            raise ValueError(f"indep_marg must be supplied {required}")
+        return None
+
+    imarg = np.load(fn)
+    if imarg.shape == (L, q):
+        log(f"loading unimarg from {fn} for the independent model")
+        unimarg = imarg
+    else:
+        log(f"loading bimarg from {fn} and converted to unimarg for the "
+             "independent model")
+        unimarg = getUnimarg(imarg)
+    return unimarg.astype('f4')
+
+def process_clamp_args(args, L, alpha, log):
+    if args.clamp is None:
+        return {}
 
-        log(f"Parallel tempering: {msg}, and neighbor temperatures are "
-            f"swapped {p.nswaps} times after every MCMC loop. The "
-            f"low-temperature B is {p.tempering}")
+    clampseq = np.zeros(L, dtype='<u1')
+    marks = np.zeros(L, dtype='<u1')
+    for item in args.clamp.split(','):
+        pos, res = item.split(':')
+        pos = int(pos)
+        if not 0 <= pos < L or len(res) != 1 or res not in alpha:
+            raise ValueError(f"invalid clamped position '{item}'")
+        clampseq[pos] = alpha.index(res)
+        marks[pos] = 1
+
+    log("Clamped positions: " + ", ".join(f"{i}:{alpha[clampseq[i]]}"
+                                          for i in np.flatnonzero(marks)))
+    log("")
+    return {'clamp': (clampseq, marks)}
+
+def describe_annealing(args, p, log):
+    if p.annealing is not None:
+        log(f"Population annealing: Before equilibration the walkers are "
+            f"annealed through {len(p.annealing)} inverse temperatures "
+            f"({', '.join(f'{b:g}' for b in p.annealing)}), running "
+            f"{p.anneal_loops} MCMC loops at each and resampling them "
+            f"between temperatures.")
 
 def print_node_startup(log, orig_args):
     log(f"Hostname:   {socket.gethostname()}")
@@ -319,14 +491,39 @@ def setup_GPUs_MPI(p, log):
                   for n, nwalk in zip(gpus.gpu_list, gpuwalkers)))
     return gpus
 
-def setup_GPUs(p, log, splitwalkers=True):
+def setup_CPU(p, log):
+    if MPI:
+        raise Exception("The cpu backend cannot be used with MPI")
+
+    ncpus = p.ncpus or os.cpu_count()
+    ncpus = max(min(ncpus, p.nwalkers), 1)
+    cpuwalkers = divideWalkers(p.nwalkers, ncpus, log)
+
+    log("CPU Initialization:")
+    if ncpus == 1:
+        gpus = GPU_node([initCPU(0, p.nwalkers, p, log)])
+    else:
+        gpus = start_cpu_pool(ncpus, cpuwalkers, p, log)
+    log('Running on CPU:\n' +
+        "\n".join(f'    {n}   ({nwalk} walkers)'
+                  for n, nwalk in zip(gpus.gpu_list, cpuwalkers)))
+    return gpus
+
+def setup_GPUs(p, log, splitwalkers=True, clctx=None):
+    # clctx is an existing (clinfo, gpudevs) built with the same options
+    if p.backend == 'cpu':
+        return setup_CPU(p, log)
     if MPI:
         return setup_GPUs_MPI(p, log)
 
-    clinfo, gpudevs, cllog = setup_GPU_context(scriptPath, scriptfile, p, log)
-    with open(p.outdir / 'ptx', 'wt') as f:
-        f.write(cllog[1])
-        f.write(cllog[0])
+    if clctx is not None:
+        clinfo, gpudevs = clctx
+    else:
+        clinfo, gpudevs, cllog = setup_GPU_context(scriptPath, scriptfile,
+                                                   p, log)
+        with open(p.outdir / 'ptx', 'wt') as f:
+            f.write(cllog[1])
+            f.write(cllog[0])
 
     ngpus = len(gpudevs)
 
@@ -354,21 +551,34 @@ def inverseIsing(orig_args, infer_args, log):
     parser = configargparse.ArgumentParser(prog=progname + ' inverseIsing',
                                      description=descr)
     addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gpus profile beta')
+                                          'start_walkers grow_ssr '
+                                          'gpus backend ncpus sampler schedule '
+                                          'proposal gap_moves gap_letter '
+                                          'jumps jump_msa jlayout seqbits '
+                                          'precision '
+                                          'profile measurefperror beta')
     addopt(parser, 'Sequence Options',    'seedseq seqs seqs_large')
     addopt(parser, 'Newton Step Options', 'bimarg mcsteps newtonsteps '
-                                          'newton_delta fracNeff '
+                                          'stop_floor stop_plateau stop_window '
+                                          'newton_delta fracNeff newton_batch '
+                                          'optimizer momentum mbar_rounds '
                                           'damping reg distribute_jstep gamma '
                                           'preopt reseed seedmsa')
     addopt(parser, 'Sampling Options',    'equiltime min_equil max_equil '
                                           'trackequil tracked '
-                                          'tempering nswaps_temp ')
+                                          'tempering nswaps_temp '
+                                          'annealing anneal_loops '
+                                          'nsamples sample_loops')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'init_model outdir rngseed '
                                           'config finish')
 
     args = parser.parse_args(infer_args)
 
+    if args.bimarg is not None and len(args.bimarg) > 1:
+        inverseIsingBatch(orig_args, parser, args)
+        return
+
     # set up output directory and log file
     if args.finish:
         outdir = args.finish
@@ -410,7 +620,7 @@ def inverseIsing(orig_args, infer_args, log):
         parser.write_config_file(args, [str(args.outdir / 'config.cfg')])
 
     requireargs(args, 'bimarg alpha')
-    args.measurefperror = False
+    args.bimarg = args.bimarg[0]
 
     print_node_startup(log, orig_args)
 
@@ -422,6 +632,12 @@ def inverseIsing(orig_args, infer_args, log):
         log(f"Continuing from {rundir}")
         log("")
 
+    p, gpus, unimarg = setup_inference(args, log)
+    mi3gpu.NewtonSteps.newtonMCMC(p, gpus, startrun, jstep, log, unimarg)
+
+    logfile.close()
+
+def setup_inference(args, log, clctx=None):
     log("Initialization")
     log("===============")
 
@@ -440,9 +656,27 @@ def inverseIsing(orig_args, infer_args, log):
     L, q, alpha = p.L, p.q, p.alpha
 
     p.update(process_sample_args(args, log))
-    gpup = process_GPU_args(args, L, q, p.outdir, log)
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
     p.update(gpup)
-    gpus = setup_GPUs(p, log)
+
+    # start with fewer walkers, which are doubled by growWalkers
+    if args.start_walkers is not None:
+        ndouble = np.log2(p.nwalkers/args.start_walkers)
+        if ndouble < 0 or ndouble != int(ndouble):
+            raise ValueError("nwalkers must be start_walkers times a power "
+                             "of 2")
+        if (p.tempering is not None or p.nsamples > 1 or p.mbar_rounds > 1
+                or p.distribute_jstep != 'all'):
+            raise ValueError("start_walkers cannot be used with tempering, "
+                             "nsamples, mbar_rounds or distribute_jstep")
+        p['max_walkers'] = p.nwalkers
+        p['nwalkers'] = args.start_walkers
+        p['grow_ssr'] = args.grow_ssr
+        log(f"Starting with {p.nwalkers} walkers, doubled up to "
+            f"{p.max_walkers} when the SSR is below {p.grow_ssr} times its "
+            f"statistical value")
+
+    gpus = setup_GPUs(p, log, clctx=clctx)
     gpus.initMCMC(p.nsteps)
     gpus.initJstep()
 
@@ -458,12 +692,31 @@ def inverseIsing(orig_args, infer_args, log):
     else:  # all
         pass
 
+    # the samples of each gpu are stored in its large buffer
+    if p.nsamples > 1:
+        if p.distribute_jstep != 'all':
+            raise ValueError("nsamples requires distribute_jstep 'all'")
+        gpuwalkers = divideWalkers(gpus.nwalkers, gpus.ngpus, log)
+        gpus.initLargeBufs([p.nsamples*n for n in gpuwalkers])
+
+    # the walkers of the last mbar_rounds rounds are stored, see storeRound
+    if p.mbar_rounds > 1:
+        if p.distribute_jstep != 'all':
+            raise ValueError("mbar_rounds requires distribute_jstep 'all'")
+        if p.nsamples > 1 or p.beta is not None or p.tempering is not None:
+            raise ValueError("mbar_rounds cannot be used with nsamples, "
+                             "beta or tempering")
+        gpuwalkers = divideWalkers(gpus.nwalkers, gpus.ngpus, log)
+        gpus.initLargeBufs([p.mbar_rounds*n for n in gpuwalkers])
+
     log("")
 
     unimarg = getUnimarg(p.bimarg)
     gen_indep = args.seqs == 'independent' or args.init_model == 'independent'
-    if gen_indep or args.reseed == 'independent':
+    if (gen_indep or args.reseed == 'independent' or p.proposal != 'uniform'
+            or p.gapmoves):
         gpus.prepare_indep(unimarg)
+    setup_jumps(args, p, gpus, unimarg, log)
 
     # figure out how many sequences we need to initialize
     needed_seqs = None
@@ -517,11 +770,18 @@ def inverseIsing(orig_args, infer_args, log):
             f"or {p.nsteps*p.equiltime/p.L:.1f} steps per position).")
 
     describe_tempering(args, p, log)
+    describe_annealing(args, p, log)
+    if p.nsamples > 1:
+        log(f"After equilibration, {p.nsamples} samples of each walker are "
+            f"stored, one every {p.sample_loops} MCMC loops, and the Newton "
+            f"steps use all {p.nsamples*p.nwalkers} sequences.")
+    if p.mbar_rounds > 1:
+        log(f"The walkers of the last {p.mbar_rounds} rounds are stored, and "
+            f"the Newton steps use all of them, reweighted using MBAR.")
 
     N = p.nwalkers
-    if p.tempering:
-        B0 = p.tempering[0]
-        N = np.sum(p.tempering == B0)
+    if p.tempering is not None:
+        N = p.nwalkers//len(p.tempering)
 
     f = p.bimarg
     expect_SSR = np.sum(f*(1-f))/N
@@ -532,6 +792,8 @@ def inverseIsing(orig_args, infer_args, log):
         f"bimarg is:\nMIN:    SSR = {expect_SSR:.4f}   rel% = {expect_Ferr:.3f}")
     log("(Statistical error only. Modeling biases and perturbation procedure "
         "may cause additional error)")
+    p['expect_SSR'] = expect_SSR
+    p['expect_Ferr'] = expect_Ferr
 
     log("")
     log("")
@@ -542,17 +804,89 @@ def inverseIsing(orig_args, infer_args, log):
     p['peak_ns'] = 256
     p['cur_ns'] = 256
 
-    mi3gpu.NewtonSteps.newtonMCMC(p, gpus, startrun, jstep, log, unimarg)
+    return p, gpus, unimarg
+
+def inverseIsingBatch(orig_args, parser, args):
+    # Fits a model to each of several bimarg, eg bootstrap replicates or
+    # different subsets of an MSA, in one process. Each model has its own
+    # walkers and buffers, and its own outdir 'model_N' containing the usual
+    # run directories. On OpenCL devices all models share one context and
+    # compiled program, and the Newton-MCMC loops of the models run in
+    # separate threads so that the devices are kept busy with the kernels of
+    # the other models while one waits on the host.
+    if args.finish:
+        raise ValueError("--finish does not accept several bimarg, instead "
+                         "finish each model_N directory separately")
+    if MPI:
+        raise ValueError("Several bimarg cannot be fit when using MPI")
+
+    shapes = set(np.load(fn, mmap_mode='r').shape for fn in args.bimarg)
+    if len(shapes) != 1:
+        raise ValueError("All bimarg must have the same L and q")
+    nmodels = len(args.bimarg)
 
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    logfile = open(args.outdir / 'log', 'wt')
+    log = lambda *s, **kwds: print(*s, file=logfile, flush=True, **kwds)
+    parser.write_config_file(args, [str(args.outdir / 'config.cfg')])
+
+    requireargs(args, 'bimarg alpha')
+
+    print_node_startup(log, orig_args)
+
+    # share the cpus between the models
+    if args.backend == 'cpu' and args.ncpus is None:
+        args.ncpus = max(os.cpu_count()//nmodels, 1)
+
+    log(f"Fitting {nmodels} models:")
+    models = []
+    clctx = None
+    for n, fn in enumerate(args.bimarg):
+        margs = copy.copy(args)
+        margs.bimarg = fn
+        margs.outdir = args.outdir / f'model_{n}'
+        if args.rngseed is not None:
+            # setup_seed uses the seed and seed + 1
+            margs.rngseed = np.uint32(args.rngseed + 2*n)
+
+        margs.outdir.mkdir(parents=True, exist_ok=True)
+        parser.write_config_file(margs, [str(margs.outdir / 'config.cfg')])
+        mlogfile = open(margs.outdir / 'log', 'wt')
+        mlog = functools.partial(print, file=mlogfile, flush=True)
+        print_node_startup(mlog, orig_args)
+
+        p, gpus, unimarg = setup_inference(margs, mlog, clctx)
+        # the host rng used by the reseed options is not shared by the threads
+        p['rng'] = np.random.RandomState(p.rngseed)
+        if p.backend == 'opencl':
+            clctx = ((gpus.gpus[0].ctx, gpus.gpus[0].prg),
+                     [g.device for g in gpus.gpus])
+        models.append((p, gpus, unimarg, mlog, mlogfile))
+        log(f"    {margs.outdir}: {fn}")
+    log("")
+
+    with ThreadPoolExecutor(max_workers=nmodels) as pool:
+        runs = [pool.submit(mi3gpu.NewtonSteps.newtonMCMC,
+                            p, gpus, 0, 0, mlog, unimarg)
+                for p, gpus, unimarg, mlog, mlogfile in models]
+
+    for n, (run, model) in enumerate(zip(runs, models)):
+        model[4].close()
+        err = run.exception()
+        log(f"model_{n}: " + ("done" if err is None else f"failed ({err!r})"))
     logfile.close()
 
+    # re-raise the first error, if any
+    for run in runs:
+        run.result()
+
 def getEnergies(orig_args, args, log):
     descr = ('Compute Potts Energy of a set of sequences')
     parser = configargparse.ArgumentParser(prog=progname + ' getEnergies',
                                      description=descr)
     add = parser.add_argument
     add('out', default='output', help='Output File')
-    addopt(parser, 'GPU Options',         'wgsize gpus profile')
+    addopt(parser, 'GPU Options',         'wgsize gpus backend ncpus profile')
     addopt(parser, 'Potts Model Options', 'alpha couplings')
     addopt(parser, 'Sequence Options',    'seqs')
     addopt(parser,  None,                 'outdir')
@@ -588,7 +922,16 @@ def getEnergies(orig_args, args, log):
     args.nwalkers = len(seqs)
     args.nsteps = 1
     args.nlargebuf = 1
-    gpup = process_GPU_args(args, L, q, p.outdir, log)
+    args.beta = None
+    args.sampler = 'metropolis'
+    args.schedule = 'random'
+    args.proposal = 'uniform'
+    args.gap_moves = 0
+    args.jumps = 0
+    args.precision = 'single'
+    args.jlayout = 'packed'
+    args.seqbits = 'auto'
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
     p.update(gpup)
     gpus = setup_GPUs(p, log)
     gpus.setSeqs('main', seqs, log)
@@ -607,6 +950,28 @@ def getEnergies(orig_args, args, log):
 
     logfile.close()
 
+def energy_autocorr_time(es):
+    """
+    Integrated autocorrelation time of the walker energies es, of shape
+    (ntimes, nwalkers), in units of the time between samples. The
+    autocorrelation is averaged over walkers, and summed up to its first
+    negative value. Returns the time and whether the autocorrelation decayed
+    within the time series.
+    """
+    es = es.astype('f8')
+    es = es - np.mean(es)
+    var = np.mean(es**2)
+    if var == 0:
+        return 1.0, True
+
+    tau = 1.0
+    for t in range(1, es.shape[0]):
+        rho = np.mean(es[:-t]*es[t:])/var
+        if rho < 0:
+            return tau, True
+        tau += 2*rho
+    return tau, False
+
 def MCMCbenchmark(orig_args, args, log):
     descr = ('Benchmark MCMC generation on the GPU')
     parser = configargparse.ArgumentParser(prog=progname + ' benchmark',
@@ -615,14 +980,17 @@ def MCMCbenchmark(orig_args, args, log):
     add('--nloop', type=np.uint32, required=True,
         help="Number of kernel calls to benchmark")
     addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gpus profile')
-    addopt(parser, 'Sequence Options',    'seedseq seqs')
+                                          'gpus backend ncpus sampler schedule '
+                                          'proposal gap_moves gap_letter '
+                                          'jumps jump_msa jlayout seqbits '
+                                          'precision '
+                                          'profile measurefperror beta')
+    addopt(parser, 'Sequence Options',    'seedseq seqs indep_marg')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'init_model outdir rngseed')
 
     args = parser.parse_args(args)
     nloop = args.nloop
-    args.measurefperror = False
 
     if args.couplings is None:
         raise ValueError("--couplings is required")
@@ -650,11 +1018,21 @@ def MCMCbenchmark(orig_args, args, log):
 
     setup_seed(args, p, log)
 
-    gpup = process_GPU_args(args, L, q, p.outdir, log)
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
     p.update(gpup)
     gpus = setup_GPUs(p, log)
     gpus.initMCMC(p.nsteps)
 
+    # the proposals, gap fills and jumps start from the independent-model
+    # marginals, if given
+    unimarg = process_indep_args(args, L, q, log,
+        needed=p.proposal != 'uniform' or p.gapmoves or p.jumps,
+        required=("if using independent-model proposals"
+                  if p.proposal == 'indep' else None))
+    if unimarg is not None:
+        gpus.prepare_indep(unimarg)
+    setup_jumps(args, p, gpus, unimarg, log)
+
     # figure out how many sequences we need to initialize
     needed_seqs = None
     use_seed = False
@@ -664,7 +1042,9 @@ def MCMCbenchmark(orig_args, args, log):
         use_seed = True
     else:
         raise Exception("'seqs' or 'seedseq' option required")
-    unimarg = getUnimarg(p.bimarg)
+    unimarg = None
+    if p.bimarg is not None:
+        unimarg = getUnimarg(p.bimarg)
     p.update(process_sequence_args(args, L, alpha, log, unimarg,
                                    nseqs=needed_seqs, needseed=use_seed))
     if p.reseed == 'msa':
@@ -713,11 +1093,41 @@ def MCMCbenchmark(orig_args, args, log):
     steps_per_second = totsteps/(end-start)
     log(f"MC steps computed: {totsteps}")
     log(f"MC steps per second: {steps_per_second:g}")
-
-    ## quick sanity check as a bonus
-    #gpus.calcEnergies('main')
-    #es = gpus.collect('E main')
-    #log("\nConsistency check: <E> = ", np.mean(es), np.std(es))
+    naccept = gpus.collect('naccept')
+    log(f"Acceptance rate: {np.sum(naccept)/(p.nwalkers*p.nsteps):.4f}")
+    if p.gapmoves:
+        gapaccept = gpus.collect('gapaccept')
+        log(f"Gap move acceptance rate: "
+            f"{np.sum(gapaccept)/(p.nwalkers*p.gapmoves):.4f}")
+    if p.jumps:
+        jumpaccept = gpus.collect('jumpaccept')
+        log(f"Jump acceptance rate: "
+            f"{np.sum(jumpaccept)/(p.nwalkers*p.jumps):.4f}")
+
+    # The MC steps/s does not account for how well each step decorrelates
+    # the walkers, which depends on the sampler. Estimate that from the
+    # energy autocorrelation over a further nloop kernel calls.
+    log("")
+    log("Decorrelation run...")
+    es = []
+    for i in range(nloop):
+        gpus.runMCMC()
+        gpus.calcEnergies('main')
+        es.append(gpus.collect('E main'))
+    es = np.array(es)
+
+    tau, converged = energy_autocorr_time(es)
+    log(f"Energy autocorrelation time: {tau:.3g} kernel calls "
+        f"({tau*p.nsteps:.4g} MC steps)")
+    if not converged:
+        log("Warning: autocorrelation did not decay within nloop kernel "
+            "calls, so this is a lower bound. Increase nloop or nsteps.")
+    ess_per_second = p.nwalkers*nloop/tau/(end-start)
+    log(f"Effective samples per second: {ess_per_second:g}")
+
+    if p.fperror:
+        log("")
+        mi3gpu.NewtonSteps.measureFPerror(gpus, p.couplings, p, log)
 
     logfile.close()
 
@@ -727,16 +1137,20 @@ def equilibrate(orig_args, args, log):
                                      description=descr)
     add = parser.add_argument
     addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
-                                          'gpus profile beta')
-    addopt(parser, 'Sequence Options',    'seedseq seqs indep_marg ')
+                                          'gpus backend ncpus sampler schedule '
+                                          'proposal gap_moves gap_letter '
+                                          'jumps jump_msa jlayout seqbits '
+                                          'precision '
+                                          'profile measurefperror beta')
+    addopt(parser, 'Sequence Options',    'seedseq seqs indep_marg clamp')
     addopt(parser, 'Sampling Options',    'equiltime min_equil max_equil '
                                           'trackequil tracked '
-                                          'tempering nswaps_temp')
+                                          'tempering nswaps_temp '
+                                          'annealing anneal_loops')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'init_model outdir rngseed')
 
     args = parser.parse_args(args)
-    args.measurefperror = False
 
     args.outdir.mkdir(parents=True, exist_ok=True)
     logfile = open(args.outdir / 'log', 'wt')
@@ -760,32 +1174,27 @@ def equilibrate(orig_args, args, log):
     else:
         rngPeriod = p.equiltime
 
-    gpup = process_GPU_args(args, L, q, p.outdir, log)
+    p.update(process_clamp_args(args, L, alpha, log))
+
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
     p.update(gpup)
+    if p.clamp is not None and (p.gapmoves or p.jumps):
+        raise ValueError("clamped positions cannot be used with gap moves or "
+                         "jumps")
     gpus = setup_GPUs(p, log)
     gpus.initMCMC(p.nsteps)
+    if p.clamp is not None:
+        gpus.initClamp(*p.clamp)
 
     gen_indep = args.seqs == 'independent' or args.init_model == 'independent'
-    if gen_indep:
-        imarg = None
-        if args.indep_marg is not None:
-            imarg = np.load(args.indep_marg)
-        elif args.init_model:
-            fn = Path(args.init_model, 'bimarg.npy')
-            if fn.is_file():
-                imarg = np.load(fn)
-        if imarg is None:
-            raise ValueError("indep_marg must be supplied if generating "
-                             "independent-model sequences")
-        if imarg.shape == (L, q):
-            log(f"loading unimarg from {args.indep_marg} for independent model "
-                 "sequence generation")
-            unimarg = imarg
-        else:
-            log(f"loading bimarg from {args.indep_marg} and converted to unimarg"
-                 " for independent model sequence generation")
-            unimarg = getUnimarg(imarg)
-        gpus.prepare_indep(unimarg.astype('f4'))
+    unimarg = process_indep_args(args, L, q, log,
+        needed=gen_indep or p.proposal != 'uniform' or p.gapmoves or p.jumps,
+        required=("if generating independent-model sequences or using "
+                  "independent-model proposals")
+                 if gen_indep or p.proposal == 'indep' else None)
+    if unimarg is not None:
+        gpus.prepare_indep(unimarg)
+    setup_jumps(args, p, gpus, unimarg, log)
 
     nseqs = None
     needseed = False
@@ -810,6 +1219,7 @@ def equilibrate(orig_args, args, log):
             f"{p.nsteps*p.equiltime/p.L:.1f} steps per position).")
 
     describe_tempering(args, p, log)
+    describe_annealing(args, p, log)
 
     # set up gpu buffers
     if needseed:
@@ -818,6 +1228,8 @@ def equilibrate(orig_args, args, log):
         gpus.gen_indep('main')
     else:
         gpus.setSeqs('main', p.seqs, log)
+    if p.clamp is not None:
+        gpus.clampSeqs()
 
     gpus.setBuf('J', p.couplings)
 
@@ -831,16 +1243,10 @@ def equilibrate(orig_args, args, log):
     # set up tempering if needed
     if p.tempering is not None:
         MCMC_func = mi3gpu.NewtonSteps.runMCMC_tempered
-        B0 = np.max(p.tempering)
+        gpus.initTempering(p.tempering)
 
-        if p.nwalkers % len(p.tempering) != 0:
-            raise Exception("# of temperatures must evenly divide # walkers")
-        Bs = np.concatenate([full(p.nwalkers/len(p.tempering), b, dtype='f4')
-                          for b in p.tempering])
-        Bs = np.split(Bs, len(gpus))
-        for B,gpu in zip(Bs, gpus):
-            gpu.setBuf('Bs', B)
-            gpu.markSeqs(B == B0)
+    if p.annealing is not None:
+        gpus.initAnnealing()
 
     (bimarg_model,
      bicount,
@@ -849,7 +1255,8 @@ def equilibrate(orig_args, args, log):
      ptinfo,
      equilsteps) = MCMC_func(gpus, p.couplings, 'gen', p, log)
 
-    seqs = gpus.collect('seq main')
+    # with tempering, only output the lowest temperature walkers
+    seqs = gpus.collect('seq large' if p.tempering is not None else 'seq main')
 
     outdir = p.outdir
     np.savetxt(outdir / 'bicounts', bicount, fmt='%d')
@@ -858,10 +1265,10 @@ def equilibrate(orig_args, args, log):
     writeSeqs(outdir / 'seqs', seqs, alpha)
 
     if p.tempering is not None:
-        e, b = readGPUbufs(['E main', 'Bs'], gpus)
-        np.save(outdir / 'walker_Bs', np.concatenate(b))
-        np.save(outdir / 'walker_Es', np.concatenate(e))
-        log(f"Final PT swap rate: {ptinfo[1]}")
+        e, b = gpus.collect(['E main', 'Bs'])
+        np.save(outdir / 'walker_Bs', b)
+        np.save(outdir / 'walker_Es', e)
+        log(f"Final PT swap rates: {ptinfo[1]}")
 
     log("Mean energy:", np.mean(sampledenergies))
 
@@ -869,6 +1276,285 @@ def equilibrate(orig_args, args, log):
 
     logfile.close()
 
+def design(orig_args, args, log):
+    descr = ('Search for low-energy sequences by simulated annealing and '
+             'greedy descent on the GPU')
+    parser = configargparse.ArgumentParser(prog=progname + ' design',
+                                     description=descr)
+    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
+                                          'gpus backend ncpus sampler schedule '
+                                          'proposal gap_moves gap_letter '
+                                          'jumps jump_msa jlayout seqbits '
+                                          'precision '
+                                          'profile measurefperror')
+    addopt(parser, 'Sequence Options',    'seedseq seqs indep_marg ')
+    addopt(parser, 'Potts Model Options', 'alpha couplings L')
+    addopt(parser,  None,                 'init_model outdir rngseed')
+    group = parser.add_argument_group('Design Options')
+    group.add_argument('--design_betas',
+        help='Inverse temperature schedule, as a comma separated list or a '
+             '.npy file. All walkers are run at each temperature in turn')
+    group.add_argument('--design_loops', type=np.uint32, default=16,
+        help='number of MCMC kernel calls at each design temperature')
+    group.add_argument('--greedy_sweeps', type=np.uint32, default=64,
+        help='maximum number of greedy descent sweeps after annealing, which '
+             'stop early once no single mutation lowers the energy. 0 '
+             'disables greedy descent')
+    group.add_argument('--topk', type=np.uint32, default=100,
+        help='number of distinct lowest-energy sequences to output')
+
+    args = parser.parse_args(args)
+    # the design schedule sets the temperatures
+    args.beta = None
+
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    logfile = open(args.outdir / 'log', 'wt')
+    log = lambda *s, **kwds: print(*s, file=logfile, flush=True, **kwds)
+
+    print_node_startup(log, orig_args)
+
+    log("Initialization")
+    log("===============")
+
+    p = attrdict({'outdir': args.outdir})
+
+    setup_seed(args, p, log)
+
+    p.update(process_potts_args(args, None, None, None, log))
+    L, q, alpha = p.L, p.q, p.alpha
+
+    Bs = np.zeros(0, dtype='f4')
+    if args.design_betas:
+        try:
+            Bs = np.load(args.design_betas).astype('f4')
+        except:
+            Bs = np.array([x for x in args.design_betas.split(",")],
+                          dtype='f4')
+        if np.any(Bs <= 0) or np.any(Bs[1:] <= Bs[:-1]):
+            raise ValueError("design_betas must be positive and increasing")
+    if len(Bs) == 0 and args.greedy_sweeps == 0:
+        raise ValueError("design requires design_betas or greedy_sweeps")
+    # the samplers use the per-walker 'Bs' buffer, see setup_GPU_context
+    p['design'] = Bs
+
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
+    p.update(gpup)
+    gpus = setup_GPUs(p, log)
+    gpus.initMCMC(p.nsteps)
+    gpus.initDesign()
+
+    gen_indep = args.seqs == 'independent' or args.init_model == 'independent'
+    unimarg = process_indep_args(args, L, q, log,
+        needed=gen_indep or p.proposal != 'uniform' or p.gapmoves or p.jumps,
+        required=("if generating independent-model sequences or using "
+                  "independent-model proposals")
+                 if gen_indep or p.proposal == 'indep' else None)
+    if unimarg is not None:
+        gpus.prepare_indep(unimarg)
+    setup_jumps(args, p, gpus, unimarg, log)
+
+    nseqs = None
+    needseed = False
+    if args.seedseq is not None:
+        needseed = True
+    elif not gen_indep:
+        nseqs = p.nwalkers
+    p.update(process_sequence_args(args, L, alpha, log, nseqs=nseqs,
+                                   needseed=needseed))
+    log("")
+
+    log("Computation Overview")
+    log("====================")
+    if len(Bs) > 0:
+        log(f"Annealing {p.nwalkers} MC walkers through inverse temperatures "
+            f"{', '.join(f'{b:g}' for b in Bs)}, with {args.design_loops} "
+            f"MCMC kernel calls of {p.nsteps} MC steps per temperature")
+    if args.greedy_sweeps > 0:
+        log(f"Greedy descent of the lowest-energy sequence of each walker, "
+            f"for up to {args.greedy_sweeps} sweeps")
+    log(f"Writing the {args.topk} distinct lowest-energy sequences found")
+
+    # set up gpu buffers
+    if needseed:
+        gpus.fillSeqs(p.seedseq)
+    elif gen_indep:
+        gpus.gen_indep('main')
+    else:
+        gpus.setSeqs('main', p.seqs, log)
+
+    gpus.setBuf('J', p.couplings)
+
+    log("")
+
+    log("Designing")
+    log("====================")
+
+    gpus.updateBest()
+    for B in Bs:
+        gpus.fillBuf('Bs', B)
+        for i in range(args.design_loops):
+            gpus.runMCMC()
+            gpus.updateBest()
+        e, be = gpus.collect(['E main', 'E best'])
+        log(f"B = {B:g}:  mean E {np.mean(e):.4f}  lowest E {np.min(be):.4f}")
+
+    if args.greedy_sweeps > 0:
+        # descend from the lowest-energy sequence of each walker
+        gpus.setSeqs('main', gpus.collect('seq best'), log)
+        for i in range(args.greedy_sweeps):
+            gpus.greedyDescent(1)
+            nmut = np.sum(gpus.collect('naccept'))
+            if nmut == 0:
+                break
+        gpus.updateBest()
+        log(f"Greedy descent: {i+1} sweeps, {nmut} mutations in the last "
+            f"sweep, lowest E {np.min(gpus.collect('E best')):.4f}")
+
+    # recompute the energies exactly, as the running energies carry
+    # rounding error
+    gpus.calcEnergies('best')
+    seqs, energies = gpus.collect(['seq best', 'E best'])
+    seqs, ind = np.unique(seqs, axis=0, return_index=True)
+    energies = energies[ind]
+    order = np.argsort(energies, kind='stable')[:args.topk]
+    seqs, energies = seqs[order], energies[order]
+
+    outdir = p.outdir
+    np.save(outdir / 'energies', energies)
+    writeSeqs(outdir / 'seqs', seqs, alpha)
+
+    log("")
+    log(f"Found {len(seqs)} distinct sequences, lowest energy "
+        f"{energies[0]:.4f}")
+
+    log("Done!")
+
+    logfile.close()
+
+def logZ(orig_args, args, log):
+    descr = ('Estimate the log partition function of a Potts model by annealed '
+             'importance sampling on the GPU')
+    parser = configargparse.ArgumentParser(prog=progname + ' logZ',
+                                     description=descr)
+    addopt(parser, 'GPU options',         'nwalkers nsteps wgsize '
+                                          'gpus backend ncpus sampler schedule '
+                                          'proposal gap_moves gap_letter '
+                                          'jumps jump_msa jlayout seqbits '
+                                          'precision '
+                                          'profile measurefperror')
+    addopt(parser, 'Sequence Options',    'indep_marg')
+    addopt(parser, 'Potts Model Options', 'alpha couplings L')
+    addopt(parser,  None,                 'init_model outdir rngseed')
+    group = parser.add_argument_group('AIS Options')
+    group.add_argument('--ais_schedule',
+        help='Increasing interpolation schedule from the independent model '
+             '(0) to the Potts model (1), as a comma separated list or a .npy '
+             'file. 1 is appended if it is not the last value. Defaults to '
+             'AIS_NBETA evenly spaced values')
+    group.add_argument('--ais_nbeta', type=np.uint32, default=1000,
+        help='number of evenly spaced steps of the default schedule')
+    group.add_argument('--ais_loops', type=np.uint32, default=1,
+        help='number of MCMC kernel calls at each step of the schedule')
+    group.add_argument('--bootstrap', type=np.uint32, default=1000,
+        help='number of bootstrap resamples of the walkers used to estimate '
+             'the error of log Z')
+
+    args = parser.parse_args(args)
+    # the samplers run at the couplings of each step of the schedule
+    args.beta = None
+
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    logfile = open(args.outdir / 'log', 'wt')
+    log = lambda *s, **kwds: print(*s, file=logfile, flush=True, **kwds)
+
+    print_node_startup(log, orig_args)
+
+    log("Initialization")
+    log("===============")
+
+    p = attrdict({'outdir': args.outdir})
+
+    setup_seed(args, p, log)
+
+    p.update(process_potts_args(args, None, None, None, log))
+    L, q, alpha = p.L, p.q, p.alpha
+
+    if args.ais_schedule:
+        try:
+            bs = np.load(args.ais_schedule).astype('f8')
+        except:
+            bs = np.array([x for x in args.ais_schedule.split(",")],
+                          dtype='f8')
+        if np.any(bs <= 0) or np.any(bs > 1) or np.any(bs[1:] <= bs[:-1]):
+            raise ValueError("ais_schedule must be increasing, in (0, 1]")
+        if bs[-1] != 1:
+            bs = np.append(bs, 1)
+    else:
+        bs = np.arange(1, args.ais_nbeta + 1)/args.ais_nbeta
+
+    unimarg = process_indep_args(args, L, q, log,
+        required="for the independent model the annealing starts from")
+    unimarg = unimarg/np.sum(unimarg, axis=1, keepdims=True)
+    # every residue must have nonzero probability in the starting model
+    unimarg = ((1 - 1e-3)*unimarg + 1e-3/q).astype('f4')
+
+    # couplings with the energies -sum_i log(unimarg_i), so that Z = 1
+    J0 = fieldlessGaugeDistributed(-np.log(unimarg.astype('f8')), None)[1]
+    J0 = J0.astype('f4')
+
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
+    p.update(gpup)
+    gpus = setup_GPUs(p, log)
+    gpus.initMCMC(p.nsteps)
+    gpus.prepare_indep(unimarg)
+    setup_jumps(args, p, gpus, unimarg, log)
+    log("")
+
+    log("Computation Overview")
+    log("====================")
+    log(f"Annealing {p.nwalkers} MC walkers from the independent model to "
+        f"the Potts model through {len(bs)} interpolated Hamiltonians, with "
+        f"{args.ais_loops} MCMC kernel calls of {p.nsteps} MC steps at each")
+    log("")
+
+    gpus.gen_indep('main')
+    gpus.setBuf('J', J0)
+    gpus.initAIS(p.couplings - J0)
+
+    log("Annealing")
+    log("====================")
+
+    def estimate(logw):
+        return logsumexp(logw) - np.log(len(logw))
+
+    b = 0
+    for n, bn in enumerate(bs):
+        gpus.aisStep(bn - b)
+        b = bn
+        for i in range(args.ais_loops):
+            gpus.runMCMC()
+        if (n+1) % max(1, len(bs)//10) == 0 or n+1 == len(bs):
+            logw = np.concatenate(gpus.collect('ais logw')).astype('f8')
+            log(f"b = {b:.4g}:  log Z estimate {estimate(logw):.4f}")
+
+    logw = np.concatenate(gpus.collect('ais logw')).astype('f8')
+    lZ = estimate(logw)
+    boot = [estimate(logw[randint(len(logw), size=len(logw))])
+            for i in range(args.bootstrap)]
+    err = np.std(boot)
+    ess = np.exp(2*logsumexp(logw) - logsumexp(2*logw))
+
+    outdir = p.outdir
+    np.save(outdir / 'ais_logw', logw)
+    np.save(outdir / 'logZ', np.array([lZ, err]))
+
+    log("")
+    log(f"log Z = {lZ:.4f} +- {err:.4f}  (effective sample size "
+        f"{ess:.1f} of {len(logw)} walkers)")
+    log("Done!")
+
+    logfile.close()
+
 def subseqFreq(orig_args, args, log):
     descr = ('Compute relative frequency of subsequences at fixed positions')
     parser = configargparse.ArgumentParser(prog=progname + ' subseqFreq',
@@ -878,7 +1564,9 @@ def subseqFreq(orig_args, args, log):
     add('--iterbackgrounds', action='store_true', 
         help='use if backgrounds is small')
     addopt(parser, 'GPU options',         'nsteps wgsize '
-                                          'gpus profile beta')
+                                          'gpus backend ncpus sampler schedule '
+                                          'jlayout seqbits precision profile '
+                                          'beta')
     addopt(parser, 'Potts Model Options', 'alpha couplings L')
     addopt(parser,  None,                 'outdir')
     group = parser.add_argument_group('Sequence Options')
@@ -888,6 +1576,9 @@ def subseqFreq(orig_args, args, log):
 
     args = parser.parse_args(args)
     args.measurefperror = False
+    args.proposal = 'uniform'
+    args.gap_moves = 0
+    args.jumps = 0
 
     args.outdir.mkdir(parents=True, exist_ok=True)
     logfile = open(args.outdir / 'log', 'wt')
@@ -918,7 +1609,7 @@ def subseqFreq(orig_args, args, log):
         zpad = np.zeros((n_new - ns, L), dtype='u1')
         small = np.concatenate([small, zpad], axis=0)
     args.nwalkers = small.shape[0]
-    gpup = process_GPU_args(args, L, q, p.outdir, log)
+    gpup = process_GPU_args(args, L, q, p.outdir, log, alpha)
     p.update(gpup)
     gpus = setup_GPUs(p, log, splitwalkers=False)
     gpus.initMCMC(p.nsteps)
@@ -977,7 +1668,7 @@ def subseqFreq(orig_args, args, log):
 
 ################################################################################
 
-def process_GPU_args(args, L, q, outdir, log):
+def process_GPU_args(args, L, q, outdir, log, alpha=None):
     log("GPU setup")
     log("---------")
 
@@ -986,6 +1677,16 @@ def process_GPU_args(args, L, q, outdir, log):
                       'nwalkers': args.nwalkers,
                       'beta': args.beta,
                       'gpuspec': args.gpus,
+                      'backend': args.backend,
+                      'ncpus': args.ncpus,
+                      'sampler': args.sampler,
+                      'schedule': args.schedule,
+                      'proposal': args.proposal,
+                      'gapmoves': args.gap_moves,
+                      'jumps': args.jumps,
+                      'precision': args.precision,
+                      'jlayout': args.jlayout,
+                      'seqbits': args.seqbits,
                       'profile': args.profile,
                       'fperror': args.measurefperror})
 
@@ -993,10 +1694,32 @@ def process_GPU_args(args, L, q, outdir, log):
     p.update({'L': L, 'q': q, 'outdir': outdir})
 
     p['wgsize'] = wgsize_heuristic(p.q, p.wgsize)
+    p['seqbits'] = seqbits_heuristic(p.q, p.seqbits)
 
     log(f"Total GPU walkers: {p.nwalkers}")
     log(f"Work Group Size: {p.wgsize}")
     log(f"{p.nsteps} MC steps per MCMC kernel call")
+    log(f"Using {p.sampler} sampler with {p.schedule} position schedule")
+    if p.proposal != 'uniform':
+        if p.sampler == 'gibbs':
+            raise ValueError("the gibbs sampler does not use proposals")
+        log(f"Using {p.proposal} proposal distribution")
+    if p.gapmoves:
+        if p.gapmoves < 0:
+            raise ValueError("gap_moves must be nonnegative")
+        if alpha is None or args.gap_letter not in alpha:
+            raise ValueError(f"gap letter '{args.gap_letter}' is not in the "
+                             f"alphabet, so gap moves cannot be used")
+        p['gapres'] = alpha.index(args.gap_letter)
+        log(f"Making {p.gapmoves} gap-block moves per walker per MCMC kernel "
+            f"call, with gap letter '{args.gap_letter}'")
+    if p.jumps:
+        if not 0 < p.jumps <= 1:
+            raise ValueError("jumps must be a probability")
+        log(f"Proposing jumps with probability {p.jumps} per walker per MCMC "
+            f"kernel call")
+    if p.precision == 'half':
+        log("Using half precision couplings")
     if p.profile:
         log("Profiling Enabled")
     return p
@@ -1011,6 +1734,13 @@ def process_newton_args(args, log):
              'newtonSteps': args.newtonsteps,
              'newton_delta': args.newton_delta,
              'fracNeff': args.fracNeff,
+             'newton_batch': args.newton_batch,
+             'optimizer': args.optimizer,
+             'momentum': args.momentum,
+             'mbar_rounds': args.mbar_rounds,
+             'stop_floor': args.stop_floor,
+             'stop_plateau': args.stop_plateau,
+             'stop_window': args.stop_window,
              'gamma0': args.gamma,
              'pcdamping': args.damping,
              'reseed': args.reseed,
@@ -1022,6 +1752,24 @@ def process_newton_args(args, log):
     log(f"Updating J locally with gamma={p.gamma0}, "
         f"and pc-damping {p.pcdamping}")
     log(f"Running {p.newtonSteps} Newton update steps per round.")
+    if not 1 <= p.newton_batch <= jstep_log_max:
+        raise ValueError(f"newton_batch must be from 1 to {jstep_log_max}")
+    if p.optimizer != 'newton':
+        mstr = f" with momentum {p.momentum}" if p.optimizer == 'nesterov' else ''
+        log(f"Using the {p.optimizer} optimizer for coupling updates{mstr}.")
+    if p.stop_window < 2:
+        raise ValueError("stop_window must be at least 2")
+    if p.stop_floor is not None:
+        log(f"Stopping when the errors over the last {p.stop_window} rounds "
+            f"are within {p.stop_floor} times the statistical error.")
+    if p.stop_plateau is not None:
+        log(f"Stopping when the errors change by less than {p.stop_plateau} "
+            f"over the last {p.stop_window} rounds.")
+    if p.mbar_rounds < 1:
+        raise ValueError("mbar_rounds must be positive")
+    if p.mbar_rounds > 1:
+        log(f"Reweighting the samples of the last {p.mbar_rounds} rounds "
+            f"together using MBAR.")
     log(f"Using {p.distribute_jstep}-GPU mode for Newton-step calculations.")
 
     log(f"Reading target marginals from file {args.bimarg}")
@@ -1268,17 +2016,17 @@ def process_sequence_args(args, L, alpha, log, unimarg=None,
     return attrdict({'seedseq': seedseq,
                      'seqs': seqs})
 
-def generateSequences(gentype, L, q, nseqs, log, unimarg=None):
+def generateSequences(gentype, L, q, nseqs, log, unimarg=None, rng=np.random):
     if gentype == 'zero' or gentype == 'uniform':
         log(f"Generating {nseqs} random sequences...")
-        return randint(0, q, size=(nseqs, L)).astype('<u1')
+        return rng.randint(0, q, size=(nseqs, L)).astype('<u1')
     elif gentype == 'independent':
         log(f"Generating {nseqs} independent-model sequences...")
         if unimarg is None:
             raise Exception("marg must be provided to generate sequences")
         cumprob = np.cumsum(unimarg, axis=1)
         cumprob = cumprob/(cumprob[:,-1][:,None]) #correct fp errors?
-        return np.array([np.searchsorted(cp, rand(nseqs)) for cp in cumprob],
+        return np.array([np.searchsorted(cp, rng.rand(nseqs)) for cp in cumprob],
                      dtype='<u1').T
     raise Exception(f"Unknown sequence generation mode '{gentype}'")
 
@@ -1319,12 +2067,49 @@ def process_sample_args(args, log):
 
     if 'tempering' in args and args.tempering:
         try:
-            Bs = np.load(args.tempering)
+            Bs = np.load(args.tempering).astype('f4')
         except:
             Bs = np.array([x for x in args.tempering.split(",")], dtype='f4')
+        # neighboring temperatures are swapped, so sort them
+        Bs = np.sort(Bs)
+        if len(Bs) < 2 or np.any(Bs[1:] == Bs[:-1]):
+            raise ValueError("tempering requires at least two distinct "
+                             "inverse temperatures")
+        if args.beta is not None:
+            raise ValueError("beta cannot be used with tempering")
         p['tempering'] = Bs
         p['nswaps'] = args.nswaps_temp
 
+    if 'annealing' in args and args.annealing:
+        try:
+            Bs = np.load(args.annealing).astype('f4')
+        except:
+            Bs = np.array([x for x in args.annealing.split(",")], dtype='f4')
+        if np.any(Bs <= 0) or np.any(Bs[1:] <= Bs[:-1]):
+            raise ValueError("annealing schedule must be positive and "
+                             "increasing")
+        if 'tempering' in p:
+            raise ValueError("annealing cannot be used with tempering")
+        target = args.beta if args.beta is not None else 1
+        if Bs[-1] != np.float32(target):
+            if Bs[-1] > target:
+                raise ValueError(f"annealing schedule must end below the "
+                                 f"target inverse temperature {target}")
+            Bs = np.append(Bs, np.float32(target))
+        p['annealing'] = Bs
+        p['anneal_loops'] = args.anneal_loops
+
+    p['nsamples'] = 1
+    # only infer has --mbar_rounds, runMCMC checks it in every action
+    p['mbar_rounds'] = getattr(args, 'mbar_rounds', 1)
+    if 'nsamples' in args and args.nsamples != 1:
+        if args.nsamples < 1 or args.sample_loops < 1:
+            raise ValueError("nsamples and sample_loops must be positive")
+        if 'tempering' in p:
+            raise ValueError("nsamples cannot be used with tempering")
+        p['nsamples'] = int(args.nsamples)
+        p['sample_loops'] = int(args.sample_loops)
+
     log("MCMC Sampling Setup")
     log("-------------------")
 
@@ -1335,6 +2120,13 @@ def process_sample_args(args, log):
     if 'tempering' in p:
         log(f"Parallel tempering with inverse temperatures {args.tempering}, "
             f"swapping {p.nswaps} times per loop")
+    if 'annealing' in p:
+        log(f"Population annealing through inverse temperatures "
+            f"{', '.join(f'{b:g}' for b in p.annealing)}, with "
+            f"{p.anneal_loops} MCMC kernel calls per temperature")
+    if p.nsamples > 1:
+        log(f"Storing {p.nsamples} samples per walker after equilibration, "
+            f"every {p.sample_loops} MCMC kernel calls")
 
     if p.equiltime != 'auto' and p.trackequil != 0:
         if p.equiltime%p.trackequil != 0:
@@ -1362,6 +2154,8 @@ def main(args):
       'benchmark':   MCMCbenchmark,
       'subseq':      subseqFreq,
       'gen':         equilibrate,
+      'design':      design,
+      'logZ':        logZ,
      }
 
     descr = 'Perform biophysical Potts Model calculations on the GPU'
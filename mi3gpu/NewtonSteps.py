@@ -15,10 +15,10 @@
 # along with Mi3-GPU.  If not, see <http://www.gnu.org/licenses/>.
 #
 #Contact: allan.haldane _AT_ gmail.com
-import sys, os, errno, glob, argparse, time
+import sys, os, errno, glob, argparse, time, shutil
 import numpy as np
-from numpy.random import randint
 from scipy.stats import pearsonr, dirichlet, spearmanr
+from scipy.special import logsumexp
 import pyopencl as cl
 
 import mi3gpu
@@ -26,6 +26,18 @@ import mi3gpu.Mi3
 from mi3gpu.utils.changeGauge import fieldlessGaugeEven
 from mi3gpu.utils.seqload import writeSeqs, loadSeqs
 from mi3gpu.utils.potts_common import printsome, getLq, indepF
+from mi3gpu.utils.getSeqEnergies import E_potts
+
+# averaging rates of the 'adam' and 'rmsprop' (b1 = 0) optimizers
+adam_b1 = 0.9
+adam_b2 = 0.999
+# The 'linesearch' optimizer multiplies gamma by ls_grow after each batch of
+# coupling updates which decreases the predicted SSR, and otherwise undoes the
+# batch and retries it with gamma multiplied by ls_shrink, ending the updates
+# after ls_max_backtracks retries in a row.
+ls_grow = 1.25
+ls_shrink = 0.5
+ls_max_backtracks = 4
 
 ################################################################################
 #Helper funcs
@@ -40,18 +52,18 @@ def bimarg_stats(bimarg_target, bimarg_model):
 
     return ferr, ssr, maxd
 
+def Xstat(couplings, bimarg):
+    # sum of the couplings times the pairwise correlations
+    C = bimarg - indepF(bimarg)
+    return np.sum(couplings*C)
+
 def printstats(name, jstep, bicount, bimarg_target, bimarg_model, couplings,
                energies, e_rho, ptinfo):
     ferr, ssr, maxd = bimarg_stats(bimarg_target, bimarg_model)
     ferr, maxd = ferr*100, maxd*100
 
-    C = bimarg_model - indepF(bimarg_model)
-    X = np.sum(couplings*C, axis=1)
-
-    Co = bimarg_target - indepF(bimarg_target)
-    Xo = np.sum(couplings*Co, axis=1)
-
-    X = f"{np.sum(X): 6.1f} ({np.sum(Xo): 6.1f})"
+    X = f"{Xstat(couplings, bimarg_model): 6.1f} "\
+        f"({Xstat(couplings, bimarg_target): 6.1f})"
 
     rhostr = '(none)'
     if e_rho is not None:
@@ -69,7 +81,8 @@ def printstats(name, jstep, bicount, bimarg_target, bimarg_model, couplings,
 {name} E Autocorr vs time: {rhostr}"""
 
     if ptinfo != None:
-        disp += f"\n{name} PT swap rate: {ptinfo[1]}"
+        rates = np.array2string(ptinfo[1], precision=3, floatmode='fixed')
+        disp += f"\n{name} PT swap rates: {rates[1:-1]}"
 
     return disp
 
@@ -87,10 +100,6 @@ def writeStatus(name, Jstep, bimarg_target, bicount, bimarg_model, couplings,
     #np.save(outdir / name / 'energies', energies)
     writeSeqs(outdir / name / 'seqs', seqs, alpha, zipf=True)
 
-    if ptinfo != None:
-        for n,B in enumerate(ptinfo[0]):
-            np.save(outdir / f'Bs-{n}', B)
-
     log(dispstr)
 
 def sumarr(arrlist):
@@ -143,6 +152,78 @@ def predictNeff(Es, beta, beta_gen):
     logw = -(1-b)*(e - (bgen-b)*np.var(e))
     return getNeff(np.exp(logw - np.max(logw)))
 
+def mbar_logden(u, tol=1e-6, maxiter=1000):
+    # Solves the MBAR equations for samples drawn in equal numbers from K
+    # states, given the energy u[n,k] of each sample n in each state k, by
+    # self-consistent iteration. Returns the log of the MBAR denominator
+    # log sum_k exp(f_k - u[n,k]) of each sample, and the free energies f_k
+    # (with f_0 = 0), and whether the iteration converged.
+    f = np.zeros(u.shape[1])
+    for i in range(maxiter):
+        logden = logsumexp(f - u, axis=1)
+        newf = -logsumexp(-u - logden[:,None], axis=0)
+        newf -= newf[0]
+        converged = np.max(np.abs(newf - f)) < tol
+        f = newf
+        if converged:
+            break
+    return logden, f, converged
+
+def mbarOffsets(param, gpus, log):
+    # The walkers stored by storeRound in the last rounds, each sampled with
+    # the couplings J_k of its round, are reweighted together: with MBAR the
+    # weight of sample x for couplings J is
+    #     exp(-E_J(x)) / sum_k exp(f_k - E_k(x))
+    # which is computed in iterNewton as a per-sample energy offset added to
+    # the energies of dJ, with E_J(x) = E_dJ(x) + E_cur(x) for the couplings
+    # of the current round. Returns the offsets for each gpu, padded to the
+    # size of the large buffers, and the number of rounds used.
+    # The 'dJ' buffer is used as scratch space for the couplings J_k, and is
+    # zeroed after.
+    Js = [J for J in param.mbar_J if J is not None]
+    cur = (param.mbar_slot - 1) % param.mbar_rounds
+
+    # energies of the walkers not yet stored are left as 0, which keeps their
+    # weights 0 in the device sums over the whole large buffers
+    gpus.fillBuf('E large', 0)
+    gpus.fillBuf('weights large', 0)
+    u = []
+    for J in Js:
+        gpus.setBuf('dJ', J)
+        gpus.calcEnergies('large', 'dJ')
+        u.append(gpus.readBufs('E large'))
+    gpus.fillBuf('dJ', 0)
+    nseqs = [len(e) for e in u[0]]
+    u = np.column_stack([np.concatenate(e) for e in u]).astype('f8')
+
+    logden, f, converged = mbar_logden(u)
+    if not converged:
+        log("Warning: MBAR free energies did not converge")
+    offset = u[:,cur] + logden
+    offset = (offset - np.min(offset)).astype('f4')
+    Neff = getNeff(np.exp(-offset))
+
+    nrounds = len(Js)
+    offsets = np.split(offset, np.cumsum(nseqs)[:-1])
+    offsets = [np.concatenate([o, np.zeros(len(o)//nrounds*(
+                                         param.mbar_rounds - nrounds), 'f4')])
+               for o in offsets]
+    order = [(cur + 1 + k) % nrounds for k in range(nrounds)]
+    log(f"MBAR free energies of the last {nrounds} rounds (oldest first): "
+        f"{' '.join(f'{f[k] - f[cur]:.2f}' for k in order)}")
+    return offsets, nrounds, Neff
+
+def storeRound(gpus, couplings, param):
+    # Stores the walkers in the large buffer, which holds the walkers of the
+    # last param.mbar_rounds rounds as a ring of blocks, and keeps the
+    # couplings they were sampled with, for mbarOffsets.
+    slot = param.mbar_slot
+    gpus.setNStored(slot)
+    gpus.storeSeqs()
+    param.mbar_J[slot] = couplings
+    param.mbar_slot = (slot + 1) % param.mbar_rounds
+    gpus.setNStored(sum(J is not None for J in param.mbar_J))
+
 def NewtonStatus(n, trialJ, weights, bimarg_model, bimarg_target, log):
     ferr, ssr, maxd = bimarg_stats(bimarg_target, bimarg_model)
     ferr, maxd = ferr*100, maxd*100
@@ -159,10 +240,13 @@ def NewtonStatus(n, trialJ, weights, bimarg_model, bimarg_target, log):
 def iterNewton(param, bimarg_model, gpus, log):
     bimarg_target = param.bimarg
     gamma = param.gamma0
+    if param.optimizer == 'linesearch' and param.ls_gamma is not None:
+        gamma = param.ls_gamma  # last step size of the previous round
+    adam_t = param.adam_t or 0
     newtonSteps = param.newtonSteps
     pc = param.pcdamping
     Nfrac = param.fracNeff
-    N = param.nwalkers
+    N = param.nwalkers*param.nsamples
 
 
     log("")
@@ -174,10 +258,21 @@ def iterNewton(param, bimarg_model, gpus, log):
 
     head_node = gpus.head_node
 
+    # in the pre-optimization no rounds are stored yet
+    mbar = (param.mbar_rounds or 1) > 1 and param.mbar_J[0] is not None
+
     seqbuf = 'main'
     wbufname = 'weights'
     ebufname = 'E main'
     etmpname = 'E tmp'
+    if param.nsamples > 1 or mbar:
+        # use all the samples stored by sampleMCMC or storeRound
+        seqbuf = 'large'
+        wbufname = 'weights large'
+        ebufname = 'E large'
+        etmpname = 'E tmp large'
+    if param.tempering is not None:
+        Bs = gpus.collect('Bs')
     if param.distribute_jstep != 'all':
         seqs = gpus.collect('seq main')
 
@@ -203,49 +298,145 @@ def iterNewton(param, bimarg_model, gpus, log):
 
     N0 = N
     ref_dE = 0.0
-    if param.beta is not None:
+    reweight = param.beta is not None or param.tempering is not None
+    if reweight:
         E = gpus.readBufs(ebufname)
-        beta_mod = [-(param.beta-1)*x for x in E]
+        if param.tempering is None:
+            beta_mod = [-(param.beta-1)*x for x in E]
+        else:
+            # only the walkers at the lowest temperature are used, by giving
+            # the others infinite energy.
+            B0 = np.max(param.tempering)
+            Bs = np.split(Bs, np.cumsum([len(x) for x in E])[:-1])
+            beta_mod = [np.where(B == B0, -(B0-1)*x, np.inf).astype('f4')
+                        for x, B in zip(E, Bs)]
         dEB = np.concatenate(beta_mod)
         ref_dE = np.min(dEB)
         N0 = getNeff(np.exp(-(dEB - ref_dE)))
         gpus.setBuf(etmpname, beta_mod)
         log(f"Temperature reweight decreases Neff from {N} to {N0}")
-
-    # do coupling updates
-    lastNeff = 2*N0
-    for i in range(newtonSteps):
-        gpus.updateJ(gamma, pc)
-        if param.reg is not None:
-            gpus.reg(param.reg, (gamma, pc,) + param.regarg)
+    if mbar:
+        offsets, nrounds, N0 = mbarOffsets(param, gpus, log)
+        N = param.nwalkers*nrounds
+        gpus.setBuf(etmpname, offsets)
+        reweight = True
+        log(f"MBAR reweight of the walkers of {nrounds} rounds gives Neff "
+            f"{N0:.1f} of {N}")
+
+    def jstep(n, update=True):
+        # with update=False, only recompute the weights and marginals for dJ
+        if update:
+            if param.optimizer in ['rmsprop', 'adam']:
+                b1 = adam_b1 if param.optimizer == 'adam' else 0
+                gpus.updateJ_adam(gamma, pc, b1, adam_b2, adam_t + n + 1)
+            else:
+                gpus.updateJ(gamma, pc)
+            if param.reg is not None:
+                gpus.reg(param.reg, (gamma, pc,) + param.regarg)
         gpus.calcEnergies(seqbuf, 'dJ')
 
-        if param.beta is not None:
+        if reweight:
             gpus.addFloatBuf(ebufname, etmpname)
 
-        gpus.min_buf(ebufname)
-        mindE_fut = gpus.getBuf('minout')
-
-        gpus.dE_to_weights(seqbuf, ref_dE) # refdE is estimated from last round
+        gpus.dE_to_weights(seqbuf, ref_dE) # refdE is estimated from last batch
         gpus.weight_statistics(seqbuf)
-        w_fut = gpus.getBuf('weightstats')
+        gpus.logWeightStats(n)
 
         gpus.weightedMarg(seqbuf)
         gpus.merge_bimarg()
 
-        wsum, wsum2 = (np.sum(x) for x in zip(*(w.read() for w in w_fut)))
-        Neff = wsum**2/wsum2
-        if i%64 == 0 or abs(lastNeff - Neff)/N0 > 0.05 or Neff < Nfrac*N0:
-            relN = Neff/N0*100
-            log(f"J-step {i: 5d}   Neff: {Neff:.1f}   ({relN:.1f}% of {N0})")
-            lastNeff = Neff
+    # do coupling updates. These are queued on the GPUs in batches of
+    # newton_batch steps, and the host checks Neff for all steps of a batch
+    # at its end. If Neff fell below the threshold in the batch, the GPUs have
+    # already run past that step, so the batch is undone and replayed up to it.
+    lastNeff = 2*N0
+    if mbar:
+        # the marginals at dJ = 0 are those of the MBAR weights
+        jstep(0, update=False)
+    if param.optimizer == 'linesearch':
+        bi = gpus.head_gpu.readBufs('bi')[0]
+        last_ssr = np.sum((bimarg_target - bi)**2)
+        nback = 0
+    start = 0
+    while start < newtonSteps:
+        nsteps = min(param.newton_batch, newtonSteps - start)
+        gpus.saveJstep()
+        for n in range(nsteps):
+            jstep(n)
+
+        gpus.min_buf(ebufname)
+        mindE_fut = gpus.getBuf('minout')
+
+        wsum, wsum2 = np.sum(gpus.readBufs('weightstats log'), axis=0).T
+        for n in range(nsteps):
+            i = start + n
+            Neff = wsum[n]**2/wsum2[n]
+            if i%64 == 0 or abs(lastNeff - Neff)/N0 > 0.05 or Neff < Nfrac*N0:
+                relN = Neff/N0*100
+                log(f"J-step {i: 5d}   Neff: {Neff:.1f}   ({relN:.1f}% of {N0})")
+                lastNeff = Neff
+            if Neff < Nfrac*N0:
+                break
+
         if Neff < Nfrac*N0:
+            if param.optimizer == 'linesearch' and start == 0 and n == 0:
+                # the first step alone is too large, so retry it smaller
+                gpus.restoreJstep()
+                gamma = gamma*ls_shrink
+                nback += 1
+                if nback < ls_max_backtracks:
+                    log(f"J-step     0   Neff limit reached, retrying with "
+                        f"gamma {gamma:.3g}")
+                    continue
+                jstep(0, update=False)
+                log(f"Ending coupling updates because Neff/N < {Nfrac:.2f} "
+                    f"even for the smallest step tried")
+                break
+            if param.optimizer == 'linesearch' and start == 0:
+                # the round ended in its first batch, so gamma is too large
+                # to carry over unchanged
+                gamma = gamma*ls_shrink
+            if n < nsteps - 1:
+                gpus.restoreJstep()
+                for m in range(n + 1):
+                    jstep(m)
+            adam_t += n + 1
             log(f"Ending coupling updates because Neff/N < {Nfrac:.2f}")
             break
 
+        if param.optimizer == 'linesearch':
+            bi = gpus.head_gpu.readBufs('bi')[0]
+            ssr = np.sum((bimarg_target - bi)**2)
+            if not ssr <= last_ssr:  # also if nan
+                gpus.restoreJstep()
+                gamma = gamma*ls_shrink
+                nback += 1
+                log(f"J-step {i: 5d}   Predicted SSR increased, "
+                    f"backtracking to step {start} with gamma {gamma:.3g}")
+                if nback < ls_max_backtracks:
+                    continue
+                jstep(0, update=False)
+                i = max(start - 1, 0)
+                log("Ending coupling updates because the predicted SSR "
+                    "does not decrease")
+                break
+            last_ssr = ssr
+            nback = 0
+            gamma = gamma*ls_grow
+
         ref_dE = np.min([x.read()[()] for x in mindE_fut])
+        adam_t += nsteps
+        start += nsteps
 
     log(f"Performed {i} coupling update steps")
+    param.ls_gamma = gamma
+    param.adam_t = adam_t
+    if param.optimizer == 'linesearch':
+        log(f"Line search step size gamma is {gamma:.3g}")
+
+    if param.optimizer == 'nesterov':
+        # the predicted bimarg below do not include the momentum term
+        gpus.momentumStep(param.momentum)
 
     # print status
     bi, J, dJ = gpus.head_gpu.readBufs(['bi', 'J', 'dJ'])
@@ -295,75 +486,6 @@ def preOpt(param, gpus, log):
 
     return newJ, Jsteps
 
-def rand_f32(size):
-    """
-    Generate random float32 values [0, 1), assuming little-endian IEEE binary32
-
-    This is a speed optimization. In the IEEE binary32 floating point format,
-    such values all have the same exponent and only vary in the mantissa. So,
-    we only need to generate the 23 bit mantissa per uniform float32. It turns
-    out in numpy it is fastest to generate 32 bits and then drop the first 9.
-    """
-    x = randint(np.uint32(2**32-1), size=size, dtype=np.uint32)
-    shift, exppat = np.uint32(9), np.uint32(0x3F800000)
-    return ((x >> shift) | exppat).view('f4') - np.float32(1.0)
-
-def swapTemps(gpus, dummy, N):
-    # CPU implementation of PT swap
-    t1 = time.time()
-
-    for gpu in gpus:
-        gpu.calcEnergies('main')
-    es, Bs = map(np.concatenate, readGPUbufs(['E main', 'Bs'], gpus))
-    ns = len(es)
-
-    #Bs_orig = Bs.copy()
-    #r1 = logaddexp.reduce(-Bs*es)/len(Bs)
-
-    # swap consecutive replicas, where consecutive is in E order
-    order = np.argsort(es)
-    #order = arange(len(es))
-    es = es[order]
-    Bs = Bs[order]
-
-    deEvn = es[ :-1:2] - es[1::2]
-    deOdd = es[1:-1:2] - es[2::2]
-
-    # views of even and odd elements
-    eBs1, eBs2 = Bs[:-1:2], Bs[1::2]
-    oBs1, oBs2 = Bs[1:-1:2], Bs[2::2]
-
-    # swap matching inds in a, b, with PT swap prob
-    def swap(a, b, dE):
-        ind_diff = np.where(a != b)[0]
-        delta = dE[ind_diff]*(a[ind_diff] - b[ind_diff])
-        ind_lz = np.where(delta < 0)[0]
-        sind = np.ones(len(delta), dtype='bool')
-        sind[ind_lz] = np.exp(delta[ind_lz]) > rand_f32(len(ind_lz))
-        sind = ind_diff[sind]
-
-        a[sind], b[sind] = b[sind], a[sind]
-
-    # iterate the swaps, alternating left and right swaps
-    for n in range(N):
-        swap(eBs1, eBs2, deEvn)
-        swap(oBs1, oBs2, deOdd)
-
-    # get back to original order
-    Bs[order] = Bs.copy()
-
-    r = 0
-    #r = sum(Bs != Bs_orig)/float(len(Bs))
-    #r2 = logaddexp.reduce(-Bs*es)/len(Bs)
-
-    Bs = split(Bs, len(gpus))
-    for B,gpu in zip(Bs, gpus):
-        gpu.setBuf('Bs', B)
-
-    t2 = time.time()
-    #print(t2-t1)
-    return Bs, r
-
 def track_main_bufs(param, gpus, savedir=None, step=None):
     gpus.calcBicounts('main')
     gpus.calcEnergies('main')
@@ -382,16 +504,59 @@ def track_main_bufs(param, gpus, savedir=None, step=None):
                       param.alpha, zipf=True)
     return energies, bimarg_model
 
-def runMCMC(gpus, couplings, runName, param, log):
+def measureFPerror(gpus, couplings, param, log, maxseqs=65536):
+    """
+    Estimates the floating point error of the sampler, by comparing the
+    running walker energies kept by the sampler (which use couplings of the
+    same precision as the sampler, and accumulate rounding error between
+    exact recomputes) to exact float64 energies. The effect on the
+    model bimarg is estimated by reweighting the walkers from the device
+    energies to the exact energies, and comparing to the unweighted bimarg.
+    Only the first maxseqs walkers are used, since this is done on the host.
+    """
+    L, q = param.L, param.q
+    beta = param.beta if param.beta is not None else 1
+
+    gpus.calcEnergies('main')
+    seqs, es = gpus.collect(['seq main', 'E main'])
+    seqs, es = seqs[:maxseqs], es[:maxseqs].astype('f8')
+    N = len(seqs)
+
+    exact = E_potts(seqs, couplings.astype('f8'))
+    err = es - exact
+    log(f"Measuring FP error ({N} walkers)")
+    log(f"    Device E: {printsome(es)} ...")
+    log(f"     Exact E: {printsome(exact)} ...")
+    log(f"    Energy error: mean {np.mean(err):.3g}  std {np.std(err):.3g}  "
+        f"max {np.max(np.abs(err)):.3g}")
+
+    # a constant energy offset does not affect the sampled distribution
+    w = np.exp(beta*(err - np.max(err)))
+    bi = np.empty((L*(L-1)//2, q*q))
+    biw = np.empty((L*(L-1)//2, q*q))
+    s = seqs.astype('i4')
+    n = 0
+    for i in range(L-1):
+        for j in range(i+1, L):
+            code = q*s[:,i] + s[:,j]
+            bi[n] = np.bincount(code, minlength=q*q)
+            biw[n] = np.bincount(code, weights=w, minlength=q*q)
+            n += 1
+    bi /= N
+    biw /= np.sum(w)
+
+    ssr = np.sum((bi - biw)**2)
+    expect_SSR = np.sum(bi*(1-bi))/N
+    log(f"    Bimarg drift: SSR {ssr:.3g}  max {np.max(np.abs(bi - biw)):.3g}  "
+        f"(statistical SSR for {N} walkers: {expect_SSR:.3g})")
+
+def equilibrateMCMC(gpus, runName, param, log, mcmcloop):
+    # runs mcmcloop until equilibrated, or for the requested number of loops.
+    # Returns the number of loops and the energy autocorrelation e_rho
     nloop = param.equiltime
     trackequil = param.trackequil
     outdir = param.outdir
-    # assumes small sequence buffer is already filled
 
-    #get ready for MCMC
-    gpus.setBuf('J', couplings)
-
-    #equilibration MCMC
     if nloop == 'auto':
         if trackequil != 0:
             equil_dir = outdir / runName / 'equilibration'
@@ -401,14 +566,14 @@ def runMCMC(gpus, couplings, runName, param, log):
 
         loops = 8
         for i in range(loops):
-            gpus.runMCMC()
+            mcmcloop()
         step = loops
 
         equil_e = []
         last_p1 = 0
         while True:
             for i in range(loops):
-                gpus.runMCMC()
+                mcmcloop()
 
             step += loops
             energies, _ = track_main_bufs(param, gpus, equil_dir, step)
@@ -444,7 +609,7 @@ def runMCMC(gpus, couplings, runName, param, log):
     elif trackequil == 0:
         #keep nloop iterator on outside to avoid filling queue with only 1 gpu
         for i in range(nloop):
-            gpus.runMCMC()
+            mcmcloop()
 
         step = nloop
         e_rho = None
@@ -456,7 +621,7 @@ def runMCMC(gpus, couplings, runName, param, log):
         equil_e = []
         for j in range(nloop//trackequil):
             for i in range(trackequil):
-                gpus.runMCMC()
+                mcmcloop()
             energies, _ = track_main_bufs(param, gpus, equil_dir, j*trackequil)
             equil_e.append(energies)
 
@@ -464,9 +629,64 @@ def runMCMC(gpus, couplings, runName, param, log):
         # track how well different walkers are equilibrated. Should go to 0
         e_rho = [spearmanr(ei, equil_e[-1]) for ei in equil_e]
 
+    return step, e_rho
+
+def sampleMCMC(gpus, param, log, mcmcloop):
+    # Collects param.nsamples samples of each walker into the large buffer,
+    # starting with the equilibrated walkers and then every
+    # param.sample_loops further loops, so that the Newton steps can use more
+    # sequences than there are walkers without re-equilibrating. Returns the
+    # number of loops run.
+    log(f"Storing {param.nsamples} samples per walker, every "
+        f"{param.sample_loops} loops")
+    gpus.clearLargeSeqs()
+    gpus.storeSeqs()
+    for n in range(param.nsamples - 1):
+        for i in range(param.sample_loops):
+            mcmcloop()
+        gpus.storeSeqs()
+    return (param.nsamples - 1)*param.sample_loops
+
+def annealMCMC(gpus, param, log):
+    # Population annealing: run the walkers at each inverse temperature of
+    # the schedule in turn, and between temperatures resample them in
+    # proportion to their Boltzmann weights for the change in temperature,
+    # so that they start each stage close to its equilibrium. The
+    # resampling happens on the device. Ends at the target temperature.
+    log(f"Annealing through {len(param.annealing)} temperatures")
+    lastB = None
+    for B in param.annealing:
+        if lastB is not None:
+            gpus.resampleWalkers(B - lastB)
+        gpus.fillBuf('Bs', B)
+        for i in range(param.anneal_loops):
+            gpus.runMCMC()
+        lastB = B
+
+def runMCMC(gpus, couplings, runName, param, log):
+    # assumes small sequence buffer is already filled
+
+    #get ready for MCMC
+    gpus.setBuf('J', couplings)
+
+    if param.annealing is not None:
+        annealMCMC(gpus, param, log)
+
+    #equilibration MCMC
+    step, e_rho = equilibrateMCMC(gpus, runName, param, log, gpus.runMCMC)
+
+    # the model bimarg is computed from all the samples, but the returned
+    # energies are those of the walkers, which are used for reseeding
+    seqbuf = 'main'
+    if param.nsamples > 1:
+        step += sampleMCMC(gpus, param, log, gpus.runMCMC)
+        seqbuf = 'large'
+    if (param.mbar_rounds or 1) > 1:
+        storeRound(gpus, couplings, param)
+
     #process results
     if param.beta is None:
-        gpus.calcBicounts('main')
+        gpus.calcBicounts(seqbuf)
         gpus.calcEnergies('main')
         bicount, es = gpus.collect(['bicount', 'E main'])
         bimarg_model = (bicount/np.sum(bicount[0,:])).astype('f4')
@@ -474,123 +694,62 @@ def runMCMC(gpus, couplings, runName, param, log):
         # reweight our sequences
         log("Reweighting to account for modified temperature.")
         gpus.calcEnergies('main')
-        es = gpus.collect('E main')
-        gpus.fixed_beta_weights(np.min(es), 'main')
-        gpus.weightedMarg('main')
+        gpus.calcEnergies(seqbuf)
+        es, sample_es = gpus.collect(['E main', 'E ' + seqbuf])
+        gpus.fixed_beta_weights(np.min(sample_es), seqbuf)
+        gpus.weightedMarg(seqbuf)
         bimarg_model = gpus.collect('bi')
         bimarg_model /= np.sum(bimarg_model, axis=1, keepdims=True)
         bicount = None
 
+    if param.fperror:
+        measureFPerror(gpus, couplings, param, log)
+
     gpus.logProfile()
 
     return bimarg_model, bicount, es, e_rho, None, step
 
+def swapRates(gpus):
+    # fraction of accepted replica exchanges between each pair of neighboring
+    # temperatures, since the swap counts were cleared
+    accepted, tried = gpus.collect(['swaps accepted', 'swaps tried'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return accepted/tried
+
 def runMCMC_tempered(gpus, couplings, runName, param, log):
-    nloop = param.equiltime
-    trackequil = param.trackequil
-    outdir = param.outdir
+    # Like runMCMC, but after each MCMC kernel call the walkers' temperatures
+    # are exchanged, on the device. The energies used for equilibration are
+    # those of all walkers, so we wait for both the temperatures and energies
+    # to equilibrate: each walker is expected to visit most temperatures
+    # during the equilibration. The results are computed from the walkers at
+    # the lowest temperature, which are copied to the large buffers.
     # assumes small sequence buffer is already filled
 
-    B0 = np.max(param.tempering)
-
     #get ready for MCMC
-    for gpu in gpus:
-        gpu.setBuf('J', couplings)
-
-    #equilibration MCMC
-    if nloop == 'auto':
-        if trackequil != 0:
-            equil_dir = outdir / runName / 'equilibration'
-            equil_dir.mkdir(parents=True, exist_ok=True)
-        else:
-            equil_dir = None
-
-        loops = 8
-        for i in range(loops):
-            for gpu in gpus:
-                gpu.runMCMC()
-        step = loops
-
-        equil_e = []
-        while True:
-            for i in range(loops):
-                for gpu in gpus:
-                    gpu.runMCMC()
-                Bs,r = swapTemps(gpus, param.tempering, param.nswaps)
-
-            step += loops
-            energies, _ = track_main_bufs(param, gpus, equil_dir, step)
-            equil_e.append(energies)
-            np.save(outdir / runName / 'equilibration' / f'Bs_{step}',
-                    np.concatenate(Bs))
-
-            if len(equil_e) >= 3:
-                r1, p1 = spearmanr(equil_e[-1], equil_e[-2])
-                r2, p2 = spearmanr(equil_e[-1], equil_e[-3])
-
-                fmt = "({:.3f}, {:.2g})".format
-                rstr = f"Step {step}, r={fmt(r1, p1)} prev:{fmt(r2, p2)}"
-
-                # Note that we are testing the correlation for *all* walkers,
-                # no matter their temperature. In other words, we are waiting
-                # for both the temperatures and energies to equilibrate - each
-                # walker is expected to visit most temperatures during the
-                # equilibration.
-                if p1 > 0.02 and p2 > 0.02:
-                    log(rstr + ". Equilibrated.")
-                    break
-            else:
-                rstr = f"Step {step}"
-
-            loops = loops*2
-            log(rstr + ". Continuing.")
-
-        e_rho = [spearmanr(ei, equil_e[-1]) for ei in equil_e]
-    elif trackequil == 0:
-        #keep nloop iterator on outside to avoid filling queue with only 1 gpu
-        for i in range(nloop):
-            for gpu in gpus:
-                gpu.runMCMC()
-            Bs,r = swapTemps(gpus, param.tempering, param.nswaps)
-    else:
-        #note: sync necessary with trackequil (may slightly affect performance)
-        equil_dir = outdir / runName / 'equilibration'
-        equil_dir.mkdir(parents=True, exist_ok=True)
-        equil_e = []
-        for j in range(nloop//trackequil):
-            for i in range(trackequil):
-                for gpu in gpus:
-                    gpu.runMCMC()
-                Bs,r = swapTemps(gpus, param.tempering, param.nswaps)
-
-            energies, _ = track_main_bufs(param, gpus, equil_dir, step)
-            np.save(outdir / runName / 'equilibration' / f'Bs_{j}',
-                    np.concatenate(Bs))
-
-            equil_e.append(energies)
+    gpus.setBuf('J', couplings)
+    gpus.clearSwapCounts()
 
-        # track how well different walkers are equilibrated. Should go to 0
-        e_rho = [spearmanr(ei, equil_e[-1]) for ei in equil_e]
+    def mcmcloop():
+        gpus.runMCMC()
+        gpus.swapTemps(param.nswaps)
 
-    for B,gpu in zip(Bs,gpus):
-        gpu.markSeqs(B == B0)
-        gpu.clearLargeSeqs()
-        gpu.storeMarkedSeqs() #save seqs from smallbuf to largebuf
+    #equilibration MCMC
+    step, e_rho = equilibrateMCMC(gpus, runName, param, log, mcmcloop)
 
     #process results
-    for gpu in gpus:
-        gpu.calcBicounts('large')
-        gpu.calcEnergies('large')
-    res = readGPUbufs(['bicount', 'E large'], gpus)
-    bicount = sumarr(res[0])
-    # assert sum(bicount, axis=1) are all equal here
-    bimarg_model = (bicount/np.sum(bicount[0,:])).astype(np.float32)
-    sampledenergies = np.concatenate(res[1])
+    gpus.storeTempSeqs()
+    gpus.calcBicounts('large')
+    gpus.calcEnergies('large')
+    bicount, es, Bs = gpus.collect(['bicount', 'E large', 'Bs'])
+    bimarg_model = (bicount/np.sum(bicount[0,:])).astype('f4')
+    r = swapRates(gpus)
+
+    if param.fperror:
+        measureFPerror(gpus, couplings, param, log)
 
-    for gpu in gpus:
-        gpu.logProfile()
+    gpus.logProfile()
 
-    return bimarg_model, bicount, sampledenergies, e_rho, (Bs, r)
+    return bimarg_model, bicount, es, e_rho, (Bs, r), step
 
 def NewtonSteps(runName, param, bimarg_model, gpus, log):
     outdir = param.outdir
@@ -678,6 +837,14 @@ def MCMCstep(runName, Jstep, couplings, param, gpus, log):
     param.last_ssr = ssr
     param.min_ssr = min(ssr, param.min_ssr)
 
+    # error statistics for checkConvergence. The expected error of X is
+    # about the error of the mean energy of the walkers.
+    ferr = bimarg_stats(bimarg_target, bimarg_model)[0]
+    X = Xstat(couplings, bimarg_model)
+    Xerr = abs(X - Xstat(couplings, bimarg_target))
+    Xerr = Xerr/(np.std(sampledenergies)/np.sqrt(len(sampledenergies)))
+    param.round_stats.append((ssr, ferr, X, Xerr))
+
     Jsteps, newJ = NewtonSteps(runName, param, bimarg_model, gpus, log)
     param.newtonSteps = min(2048, Jsteps + ns_delta)
     log(f"Increasing newtonsteps to {param.newtonSteps}")
@@ -686,6 +853,62 @@ def MCMCstep(runName, Jstep, couplings, param, gpus, log):
 
     return Jstep + Jsteps, seqs, sampledenergies, newJ
 
+def checkConvergence(param, log):
+    # Tests whether to stop the inference, using the error statistics of the
+    # last param.stop_window rounds recorded by MCMCstep. The floor test
+    # compares their averages to the statistical error expected for the
+    # number of walkers. The plateau test fits a line to each over the window,
+    # and compares the change along it to the mean.
+    W = param.stop_window
+    if len(param.round_stats) < W:
+        return False
+    ssr, ferr, X, Xerr = np.array(param.round_stats[-W:]).T
+
+    if param.stop_floor is not None:
+        rssr = np.mean(ssr)/param.expect_SSR
+        rferr = np.mean(ferr)/param.expect_Ferr
+        rX = np.mean(Xerr)
+        log(f"Errors of the last {W} rounds relative to the statistical "
+            f"error: SSR: {rssr:.2f}   rel%: {rferr:.2f}   X: {rX:.2f}")
+        if max(rssr, rferr, rX) <= param.stop_floor:
+            log(f"Stopping because the errors are within {param.stop_floor} "
+                f"times the statistical error")
+            return True
+
+    if param.stop_plateau is not None:
+        def change(x):
+            slope = np.polyfit(np.arange(W), x, 1)[0]
+            return slope*(W - 1)/abs(np.mean(x))
+        dssr, dferr, dX = change(ssr), change(ferr), change(X)
+        log(f"Relative change over the last {W} rounds: SSR: {dssr:+.3f}   "
+            f"rel%: {dferr:+.3f}   X: {dX:+.3f}")
+        tol = param.stop_plateau
+        if -dssr < tol and -dferr < tol and abs(dX) < tol:
+            log(f"Stopping because the errors changed by less than {tol}")
+            return True
+
+    return False
+
+def growWalkers(param, gpus, log):
+    # While the SSR is well above its statistical value for the current
+    # number of walkers it is dominated by the error of the model, and more
+    # walkers would not help. Once it gets within param.grow_ssr times the
+    # statistical value, the walkers are doubled, up to param.max_walkers.
+    ssr = param.round_stats[-1][0]
+    if ssr > param.grow_ssr*param.expect_SSR:
+        return
+
+    gpus.doubleWalkers()
+    param.nwalkers = 2*param.nwalkers
+    param.expect_SSR = param.expect_SSR/2
+    param.expect_Ferr = param.expect_Ferr/np.sqrt(2)
+    if param.seedmsa is not None:
+        param.seedmsa = [np.concatenate([s, s]) for s in param.seedmsa]
+    # the convergence tests start over with the new walkers
+    param.round_stats = []
+    log(f"SSR is within {param.grow_ssr} times its statistical value, "
+        f"doubling the walkers to {param.nwalkers}")
+
 def newtonMCMC(param, gpus, start_run, Jstep, log, unimarg):
     J = param.couplings
 
@@ -693,16 +916,17 @@ def newtonMCMC(param, gpus, start_run, Jstep, log, unimarg):
     gpus.setBuf('bi target', param.bimarg)
 
     if param.tempering is not None:
-        if param.nwalkers % len(param.tempering) != 0:
-            raise Exception("# of temperatures must evenly divide # walkers")
-        B0 = np.max(param.tempering)
-        Bs = concatenate([
-             full(param.nwalkers/len(param.tempering), b, dtype='f4')
-                          for b in param.tempering])
-        Bs = split(Bs, len(gpus))
-        for B,gpu in zip(Bs, gpus):
-            gpu.setBuf('Bs', B)
-            gpu.markSeqs(B == B0)
+        gpus.initTempering(param.tempering)
+
+    if param.annealing is not None:
+        gpus.initAnnealing()
+
+    if param.optimizer != 'newton':
+        gpus.initOptimizer(param.optimizer)
+
+    if param.mbar_rounds > 1:
+        param.mbar_J = [None]*param.mbar_rounds
+        param.mbar_slot = 0
 
     # setup up regularization if needed
     if param.reg == 'Xij':
@@ -719,11 +943,16 @@ def newtonMCMC(param, gpus, start_run, Jstep, log, unimarg):
     seqs = param.seqs
     seedseq = param.seedseq
     if seqs is not None and param.reseed == 'single_best':
-        gpus.calcEnergies()
+        gpus.calcEnergies('main')
         es = gpus.collect('E main')
 
     param.max_newtonSteps = param.newtonSteps
     param.min_ssr = np.inf
+    param.round_stats = []
+
+    # host rng for the reseed options (may be set per model, see
+    # Mi3.inverseIsingBatch)
+    rng = param.rng if param.rng is not None else np.random
 
     # solve using newton-MCMC
     Jstep += Jsteps
@@ -739,11 +968,12 @@ def newtonMCMC(param, gpus, start_run, Jstep, log, unimarg):
         elif param.reseed == 'single_indep':
             seed = mi3gpu.Mi3.generateSequences('independent',
                                                 param.L, param.q, 1,
-                                                log, unimarg = unimarg)[0] 
+                                                log, unimarg=unimarg,
+                                                rng=rng)[0]
         elif param.reseed == 'single_random':
             #choose random seed from the final sequences from last round
             nseq = np.sum(s.shape[0] for s in seqs)
-            seed = seqs[randint(0, nseq)]
+            seed = seqs[rng.randint(0, nseq)]
         elif param.reseed == 'single_best':
             seed = seqs[np.argmin(es)]
 
@@ -765,3 +995,12 @@ def newtonMCMC(param, gpus, start_run, Jstep, log, unimarg):
 
         Jstep, seqs, es, J = MCMCstep(runname, Jstep, J, param, gpus, log)
 
+        if param.max_walkers is not None and param.nwalkers < param.max_walkers:
+            growWalkers(param, gpus, log)
+        elif checkConvergence(param, log):
+            # the final model is the last one sampled, whose errors were
+            # tested, rather than the untested perturbed couplings
+            shutil.copyfile(rundir / 'J.npy', param.outdir / 'J_final.npy')
+            log(f"Wrote final model {runname}/J.npy to J_final.npy")
+            break
+
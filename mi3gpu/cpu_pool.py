@@ -0,0 +1,321 @@
+# Copyright 2020 Allan Haldane.
+#
+# This file is part of Mi3-GPU.
+#
+# Mi3-GPU is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# Mi3-GPU is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mi3-GPU.  If not, see <http://www.gnu.org/licenses/>.
+#
+#Contact: allan.haldane _AT_ gmail.com
+
+import os, atexit
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+from mi3gpu.node_manager import GPU_node
+from mi3gpu.mcmcCPU import MCMCCPU, FutureBuf, CPUDevice, cpu_name
+
+# This file contains a GPU_node-like manager for running the CPU backend over
+# a pool of worker processes, one per core, each of which runs an MCMCCPU
+# instance on its own slice of the walkers, much like GPU_node splits walkers
+# across GPUs.
+#
+# All MCMCCPU buffers (sequences, J, bimarg, ...) are allocated in named
+# shared memory by the manager process, and the workers attach to the same
+# segments. Commands are sent to the workers through pipes and run
+# asynchronously, like calls to an OpenCL queue, but buffer data is never
+# pickled: setBuf/getBuf read and write the shared memory directly once the
+# worker is idle, and the reductions over workers (bimarg, bicounts) are done
+# in place in the shared buffers.
+#
+# CPU_worker is the manager-side handle for one worker process, which
+# provides the MCMCCPU interface expected by GPU_node. CPU_pool_node is the
+# GPU_node subclass which manages the set of workers.
+
+class SharedMCMCCPU(MCMCCPU):
+    """
+    MCMCCPU whose buffers are in named shared memory. The manager process
+    creates the segments (create=True), and the worker attaches to them.
+    Both sides allocate buffers by running the same init methods, so the
+    buffer shapes agree.
+    """
+    def __init__(self, shmprefix, create, *args, **kwds):
+        self.shmprefix = shmprefix
+        self.create = create
+        self.shm = {}
+        super().__init__(*args, **kwds)
+
+    def _freeBuffer(self, bufname):
+        super()._freeBuffer(bufname)
+        shm = self.shm.pop(bufname)
+        shm.close()
+        if self.create:
+            shm.unlink()
+
+    def _allocBuffer(self, bufname, buftype, bufshape):
+        name = self.shmprefix + bufname.replace(' ', '_')
+        size = max(np.dtype(buftype).itemsize*int(np.prod(bufshape)), 1)
+        shm = SharedMemory(name, create=self.create, size=size)
+        self.shm[bufname] = shm
+
+        buf = np.ndarray(bufshape, dtype=buftype, buffer=shm.buf)
+        if self.create:
+            buf.fill(0)
+        return buf
+
+    def close(self):
+        self.bufs.clear()
+        self.seqbufs.clear()
+        self.Ebufs.clear()
+        for shm in self.shm.values():
+            shm.close()
+            if self.create:
+                shm.unlink()
+        self.shm.clear()
+
+def cpu_worker_main(conn, shmprefix, cpuinfo, L, q, nseq, outdir, seed, beta,
+                    profile, sampler, schedule, precision, proposal,
+                    gapmoves, gapres):
+    mcmc = SharedMCMCCPU(shmprefix, False, cpuinfo, L, q, nseq, outdir,
+                         seed, beta, profile, sampler=sampler,
+                         schedule=schedule, precision=precision,
+                         proposal=proposal, gapmoves=gapmoves, gapres=gapres)
+
+    # Errors in asynchronous commands are reported at the next synchronous
+    # command, and later commands are skipped until then.
+    err = None
+    while True:
+        meth, args, reply = conn.recv()
+        if meth == 'exit':
+            break
+
+        res = None
+        if err is None:
+            try:
+                res = getattr(mcmc, meth)(*args)
+            except Exception as e:
+                err = e
+
+        if reply:
+            conn.send((err, res))
+            err = None
+
+    mcmc.close()
+    conn.close()
+
+class CPU_worker:
+    # manager-side handle of a worker process. Computations are forwarded to
+    # the worker, while buffer transfers are done through shared memory.
+
+    def __init__(self, ctx, cpunum, L, q, nseq, outdir, seed, beta, profile,
+                 sampler, schedule, precision, proposal, gapmoves, gapres):
+        self.gpunum = cpunum
+        self.device = CPUDevice('{} (numpy, process {})'.format(cpu_name(),
+                                                                cpunum))
+        self.nwalkers = nseq
+
+        shmprefix = 'mi3_{}_{}_'.format(os.getpid(), cpunum)
+        self.local = SharedMCMCCPU(shmprefix, True, (self.device, cpunum),
+                                   L, q, nseq, None, seed, beta, profile,
+                                   sampler=sampler, schedule=schedule,
+                                   precision=precision, proposal=proposal,
+                                   gapmoves=gapmoves, gapres=gapres)
+
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=cpu_worker_main, daemon=True,
+                                args=(child_conn, shmprefix,
+                                      (self.device, cpunum), L, q, nseq,
+                                      outdir, seed, beta, profile, sampler,
+                                      schedule, precision, proposal,
+                                      gapmoves, gapres))
+        self.proc.start()
+        child_conn.close()
+
+    @property
+    def nseq(self):
+        return self.local.nseq
+
+    @property
+    def bufs(self):
+        return self.local.bufs
+
+    def _call(self, meth, *args):
+        self.conn.send((meth, args, False))
+
+    def _sync(self, meth='wait', *args):
+        self.conn.send((meth, args, True))
+        err, res = self.conn.recv()
+        if err is not None:
+            raise Exception("Error in CPU worker {}".format(self.gpunum)) \
+                  from err
+        return res
+
+    def wait(self):
+        self._sync()
+
+    def close(self):
+        if self.proc.is_alive():
+            self.conn.send(('exit', (), False))
+            self.proc.join()
+        self.local.close()
+
+    # these allocate buffers, so are run on both sides
+    def _init(self, meth, *args):
+        getattr(self.local, meth)(*args)
+        self._call(meth, *args)
+
+    def initMCMC(self, nsteps, rng_offset, rng_span):
+        self._init('initMCMC', nsteps, rng_offset, rng_span)
+
+    def initLargeBufs(self, nseq_large):
+        self._init('initLargeBufs', nseq_large)
+
+    def initSubseq(self):
+        self._init('initSubseq')
+
+    def initJstep(self):
+        self._init('initJstep')
+
+    def initTempering(self, betas):
+        self._init('initTempering', betas)
+
+    def initAnnealing(self):
+        self._init('initAnnealing')
+
+    def initJumps(self, jumprate, unimarg=None, msaseqs=None):
+        self._init('initJumps', jumprate, unimarg, msaseqs)
+
+    def initDesign(self):
+        self._init('initDesign')
+
+    def initClamp(self, clampseq, marks):
+        self._init('initClamp', clampseq, marks)
+
+    def initAIS(self, dJ):
+        self._init('initAIS', dJ)
+
+    def initOptimizer(self, optimizer):
+        self._init('initOptimizer', optimizer)
+
+    def doubleWalkers(self):
+        # the buffers are reallocated, so the worker must be idle
+        self.wait()
+        self._init('doubleWalkers')
+        self.nwalkers = self.local.nwalkers
+
+    def __getattr__(self, meth):
+        # all other MCMCCPU computations are sent to the worker
+        if meth.startswith('_') or not hasattr(MCMCCPU, meth):
+            raise AttributeError(meth)
+        return lambda *args: self._call(meth, *args)
+
+    def getBuf(self, bufname, truncateLarge=True):
+        self.wait()
+        mem = self.bufs[bufname].copy()
+
+        if bufname in self.local.largebufs and truncateLarge:
+            mem = mem[:self._sync('_nseqs', 'large')]
+        return FutureBuf(mem)
+
+    def setBuf(self, bufname, buf):
+        self.wait()
+        self.local.setBuf(bufname, buf)
+        self._call('_bufchanged', bufname)
+
+    def addBiBuffer(self, bufname, otherbuf):
+        # otherbuf is in shared memory, so sum in place here
+        self.wait()
+        self.bufs[bufname] += otherbuf
+
+class CPU_pool_node(GPU_node):
+    """
+    GPU_node for a set of CPU_workers. Most methods are inherited, which
+    send the command to each worker in turn, so that they run in parallel.
+    """
+
+    def reduce_node_bimarg(self):
+        # sum the bimarg of all workers into the first, directly in shared
+        # memory, once all workers are done.
+        self.wait()
+        bi = self.gpus[0].bufs['bi']
+        for g in self.gpus[1:]:
+            bi += g.bufs['bi']
+
+    def merge_bimarg(self):
+        if len(self.gpus) == 1:
+            self.gpus[0].renormalize_bimarg()
+            return
+
+        self.reduce_node_bimarg()
+
+        bi = self.gpus[0].bufs['bi']
+        bi /= np.sum(bi, axis=1, keepdims=True)
+        for g in self.gpus[1:]:
+            g.bufs['bi'][...] = bi
+
+    def collect(self, bufs):
+        # bicounts are summed in place from shared memory rather than
+        # copying each worker's buffer first
+        if isinstance(bufs, str):
+            return self.collect([bufs])[0]
+
+        ret = []
+        for bufname in bufs:
+            if bufname == 'bicount' and len(self.gpus) > 1:
+                self.wait()
+                bicount = self.gpus[0].bufs['bicount'].copy()
+                for g in self.gpus[1:]:
+                    bicount += g.bufs['bicount']
+                ret.append(bicount)
+            else:
+                ret.append(super().collect([bufname])[0])
+        return ret
+
+    def setSeqs(self, bufname, seqs, log=None):
+        # workers may have different numbers of walkers
+        if isinstance(seqs, np.ndarray) or len(seqs) == 1:
+            if not isinstance(seqs, np.ndarray):
+                seqs = seqs[0]
+            sizes = [g.nseq[bufname] for g in self.gpus]
+            if seqs.shape[0] != sum(sizes):
+                raise Exception(("Expected {} total sequences, got {}").format(
+                                 sum(sizes), seqs.shape[0]))
+            seqs = np.split(seqs, np.cumsum(sizes)[:-1])
+        super().setSeqs(bufname, seqs, log)
+
+    def close(self):
+        for g in self.gpus:
+            g.close()
+
+def start_cpu_pool(ncpus, cpuwalkers, param, log):
+    # use spawn so that workers do not inherit OpenCL or MPI state
+    ctx = mp.get_context('spawn')
+
+    workers = []
+    try:
+        for n, nwalk in enumerate(cpuwalkers):
+            workers.append(CPU_worker(ctx, n, param.L, param.q, nwalk,
+                                      param.outdir, param.rngseed,
+                                      param.beta, param.profile,
+                                      param.sampler or 'metropolis',
+                                      param.schedule or 'random',
+                                      param.precision or 'single',
+                                      param.proposal or 'uniform',
+                                      param.gapmoves or 0, param.gapres))
+    except:
+        for w in workers:
+            w.close()
+        raise
+
+    node = CPU_pool_node(workers)
+    atexit.register(node.close)
+    return node
@@ -31,18 +31,41 @@ float uniformMap(uint i) {
 }
 
 #define NCOUPLE ((L*(L-1)*q*q)/2)
-#define SWORDS ((L-1)/4+1)
 
-#define getbyte(mem, n) (((uchar*)(mem))[n])
-#define setbyte(mem, n, val) {(((uchar*)(mem))[n]) = val;}
+// Sequences are stored with SEQBITS bits per residue, packed into uints of
+// RPW residues each, residue n of a word being in bits SEQBITS*n and up.
+// SEQBITS must be 8, 4 or 2, and 2^SEQBITS must be at least q.
+#ifndef SEQBITS
+#define SEQBITS 8
+#endif
+#define RPW (32/SEQBITS)
+#define SWORDS ((L-1)/RPW+1)
+#define RESMASK ((1u << SEQBITS) - 1)
+
+#define getres(word, n) (((word) >> (SEQBITS*(n))) & RESMASK)
+#define setres(word, n, val) {(word) = ((word) & ~(RESMASK << (SEQBITS*(n)))) \
+                                       | ((uint)(val) << (SEQBITS*(n)));}
 
 // WGSIZE must be pow of 2
 #define WGMASK(x) (x&(~(WGSIZE-1)))  // round down to multiple of WGSIZE
 
+// Storage type of the unpacked couplings used by the samplers. With JHALF
+// they are stored as 16 bit floats to halve the memory traffic of the
+// coupling loads, but all arithmetic is still done in 32 bit floats.
+#ifdef JHALF
+#define jtype half
+#define loadJ(J, i) vload_half((i), (J))
+#define storeJ(J, i, v) vstore_half((v), (i), (J))
+#else
+#define jtype float
+#define loadJ(J, i) ((J)[i])
+#define storeJ(J, i, v) {(J)[i] = (v);}
+#endif
+
 //expands couplings stored in a (nPair x q*q) form to an (L*L x q*q) form
 __kernel //to be called with group size q*q, with nPair groups
 void unpackfV(__global float *v,
-              __global float *vp) {
+              __global jtype *vp) {
     uint li = get_local_id(0);
     uint gi = get_group_id(0);
 
@@ -60,9 +83,18 @@ void unpackfV(__global float *v,
     __local float lv[q*q];
     lv[li] = v[gi*q*q + li];
     barrier(CLK_LOCAL_MEM_FENCE);
-    vp[q*q*(L*i+j) + li] = lv[li];
-    vp[q*q*(i+L*j) + li] = lv[q*(li%q) + li/q];
+    storeJ(vp, q*q*(L*i+j) + li, lv[li]);
+    storeJ(vp, q*q*(i+L*j) + li, lv[q*(li%q) + li/q]);
+}
+
+#ifdef JHALF
+// converts the packed couplings to half precision, for getEnergies_half
+__kernel
+void packHalf(__global float *v,
+              __global half *vh) {
+    vstore_half(v[get_global_id(0)], get_global_id(0), vh);
 }
+#endif
 
 // copies sequences in smallbuf to end of largebuf
 __kernel
@@ -108,15 +140,16 @@ void copySubseq(__global uint *smallbuf,
 
     for (pos = 0; pos < L; pos++) {
         if (fixedpos[pos]) {
-            if (pos/4 != lastmod/4) {
-                sbl = largebuf[(pos/4)*get_global_size(0) + get_global_id(0)];
-                sbs = smallbuf[(pos/4)*nsmallbuf + seqnum];
+            if (pos/RPW != lastmod/RPW) {
+                sbl = largebuf[(pos/RPW)*get_global_size(0) +
+                               get_global_id(0)];
+                sbs = smallbuf[(pos/RPW)*nsmallbuf + seqnum];
             }
-            setbyte(&sbl, pos%4, getbyte(&sbs, pos%4));
+            setres(sbl, pos%RPW, getres(sbs, pos%RPW));
             lastmod = pos;
         }
-        if ( (((pos+1)%4 == 0) || (pos+1 == L)) && lastmod/4 == pos/4) {
-            largebuf[(pos/4)*get_global_size(0) + get_global_id(0)] = sbl;
+        if ((((pos+1)%RPW == 0) || (pos+1 == L)) && lastmod/RPW == pos/RPW) {
+            largebuf[(pos/RPW)*get_global_size(0) + get_global_id(0)] = sbl;
         }
     }
 }
@@ -130,11 +163,12 @@ void copySubseq(__global uint *smallbuf,
 //         row1:   a1 b1 c1 d1 e1 f1 ...
 //         row2:   a2 b2 c2 d2 e2 f2 ...
 //  (which is the transpose of seq array in CPU)
+// (shown for SEQBITS=8. In general each uint holds RPW residues)
 __kernel
 void unpackseqs1T(__global uint *buf4,
                            uint  buf4len, //nseq uints rows
                   __global uint *buf1,
-                           uint  buf1len) //nseq/4 uints
+                           uint  buf1len) //nseq/RPW uints
 {
     uint i4 = get_group_id(0);
     uint li = get_local_id(0);
@@ -145,23 +179,23 @@ void unpackseqs1T(__global uint *buf4,
         scratch[li] = buf4[i4*buf4len + n + li];
         barrier(CLK_LOCAL_MEM_FENCE);
 
-        // repartition bytes in each group of 4 wu. Avoid bank conflicts.
+        // repartition residues in each group of RPW wu. Avoid bank conflicts.
         uint tmp = 0, s;
         #pragma unroll
-        for (int i = 0; i < 4; i++) {
-            s = scratch[4*(li/4) + ((li+i)%4)];
-            setbyte(&tmp, (li+i)%4, getbyte(&s, li%4));
+        for (int i = 0; i < RPW; i++) {
+            s = scratch[RPW*(li/RPW) + ((li+i)%RPW)];
+            setres(tmp, (li+i)%RPW, getres(s, li%RPW));
         }
         barrier(CLK_LOCAL_MEM_FENCE);
 
-        // reorganize the 256 uints into 4 grous of 64
-        scratch[64*(li%4) + (li/4)] = tmp;
+        // reorganize the 256 uints into RPW grous of 256/RPW
+        scratch[(256/RPW)*(li%RPW) + (li/RPW)] = tmp;
         barrier(CLK_LOCAL_MEM_FENCE);
 
-        // write back 64 values to each of 4 rows of seqs
-        uint outrow = 4*i4 + li/64;
+        // write back 256/RPW values to each of RPW rows of seqs
+        uint outrow = RPW*i4 + li/(256/RPW);
         if (outrow < L) { //account for trailing padding in buf4
-            buf1[buf1len*outrow + (n/4) + (li%64)] = scratch[li];
+            buf1[buf1len*outrow + (n/RPW) + (li%(256/RPW))] = scratch[li];
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
@@ -225,19 +259,19 @@ void gen_indep(__global uint *buf4,
         }
 
         // bot specifies mutres now 
-        setbyte(&sbn, pos%4, bot);
+        setres(sbn, pos%RPW, bot);
 
-        if ((pos+1)%4 == 0) {
-            buf4[(pos/4)*buf4len + gi] = sbn;
+        if ((pos+1)%RPW == 0) {
+            buf4[(pos/RPW)*buf4len + gi] = sbn;
         }
     }
     // write out final uint if needed
-    if (pos%4 != 0) {
-        // zero out padding bytes (may be unnecessary..)
-        for (int l = pos%4; l < 4; l++) {
-            setbyte(&sbn, l, 0);
+    if (pos%RPW != 0) {
+        // zero out padding residues (may be unnecessary..)
+        for (int l = pos%RPW; l < RPW; l++) {
+            setres(sbn, l, 0);
         }
-        buf4[(pos/4)*buf4len + gi] = sbn;
+        buf4[(pos/RPW)*buf4len + gi] = sbn;
     }
 
     rngstates[gi] = rstate;
@@ -245,8 +279,12 @@ void gen_indep(__global uint *buf4,
 
 // ****************************** Energy computation **************************
 
-// this function expects J in "packed" form, with nPair*q*q elements
+// this function expects J in "packed" form, with nPair*q*q elements.
+// Exactly one of J and Jh should be non-null: Jh holds the couplings in half
+// precision, which are converted to float on load.
+#define loadJf(i) (Jh ? vload_half((i), Jh) : J[i])
 inline float getEnergiesf(__global float *J,
+                          __global  half *Jh,
                           __global  uint *seqmem,
                                     uint  buflen,
                           __local  float *lJ) {
@@ -279,14 +317,14 @@ inline float getEnergiesf(__global float *J,
 
     // load 2*WGSIZE worth of couplings
     uint Jmem_offset = 0;
-    lJ[get_local_id(0)] = J[Jmem_offset + get_local_id(0)];
+    lJ[get_local_id(0)] = loadJf(Jmem_offset + get_local_id(0));
     Jmem_offset += WGSIZE;
-    lJ[get_local_id(0) + WGSIZE] = J[Jmem_offset + get_local_id(0)];
+    lJ[get_local_id(0) + WGSIZE] = loadJf(Jmem_offset + get_local_id(0));
     Jmem_offset += WGSIZE;
     barrier(CLK_LOCAL_MEM_FENCE);
 
     // prefetch next WGSIZE couplings
-    float Jprefetch = J[Jmem_offset + get_local_id(0)];
+    float Jprefetch = loadJf(Jmem_offset + get_local_id(0));
     Jmem_offset += WGSIZE;
 
     uint lJ_offset = 0;
@@ -296,19 +334,19 @@ inline float getEnergiesf(__global float *J,
 
     uint n, sbn;
     for (n = 0; n < L-1; n++) {
-        if (n%4 == 0) {
-            sbn = seqmem[(n/4)*buflen + get_global_id(0)];
+        if (n%RPW == 0) {
+            sbn = seqmem[(n/RPW)*buflen + get_global_id(0)];
         }
 
-        uint seqn = getbyte(&sbn, n%4);
+        uint seqn = getres(sbn, n%RPW);
 
         uint m, sbm = sbn;
         for (m = n+1; m < L; m++) {
-            if (m%4 == 0) {
-                sbm = seqmem[(m/4)*buflen + get_global_id(0)];
+            if (m%RPW == 0) {
+                sbm = seqmem[(m/RPW)*buflen + get_global_id(0)];
             }
 
-            uint seqm = getbyte(&sbm, m%4);
+            uint seqm = getres(sbm, m%RPW);
 
             // Kahan summation for extra precision (should be essentially
             // no performance hit since hidden by memory latency of J loads)
@@ -325,7 +363,7 @@ inline float getEnergiesf(__global float *J,
                 barrier(CLK_LOCAL_MEM_FENCE);
 
                 // start next prefetch
-                Jprefetch = J[Jmem_offset + get_local_id(0)];
+                Jprefetch = loadJf(Jmem_offset + get_local_id(0));
                 Jmem_offset += WGSIZE;
             }
 
@@ -341,8 +379,20 @@ void getEnergies(__global float *J,
                           uint  buflen,
                  __global float *energies) {
     __local float lJ[2*WGSIZE];
-    energies[get_global_id(0)] = getEnergiesf(J, seqmem, buflen, lJ);
+    energies[get_global_id(0)] = getEnergiesf(J, 0, seqmem, buflen, lJ);
+}
+
+#ifdef JHALF
+__kernel
+void getEnergies_half(__global half *Jh,
+                      __global uint *seqmem,
+                               uint  buflen,
+                      __global float *energies) {
+    __local float lJ[2*WGSIZE];
+    energies[get_global_id(0)] = getEnergiesf(0, Jh, seqmem, buflen, lJ);
 }
+#endif
+#undef loadJf
 
 // ****************************** Metropolis sampler **************************
 
@@ -355,23 +405,97 @@ void initRNG2(__global mwc64xvec2_state_t *rngstates,
     rngstates[get_global_id(0)] = rstate;
 }
 
+// Position schedules, see MCMCGPU.updateRngPos
+#define SCHEDULE_RANDOM 0
+#define SCHEDULE_SWEEP 1
+#define SCHEDULE_PERMUTATION 2
+
+// returns successive 32 bit values of a vec2 stream
+inline uint nextPosRand(mwc64xvec2_state_t *rstate, uint2 *rng, uint *n) {
+    if ((*n)++ % 2 == 0) {
+        *rng = MWC64XVEC2_NextUint2(rstate);
+        return rng->x;
+    }
+    return rng->y;
+}
+
+// Fills the position list with L positions per work unit, using one
+// position rng stream per work unit. The position streams are seeded the
+// same way on all GPUs, so that all GPUs get the same positions.
+__kernel
+void genPositions(__global mwc64xvec2_state_t *posrng,
+                  __global uint *position_list,
+                           uint schedule) {
+    mwc64xvec2_state_t rstate = posrng[get_global_id(0)];
+    __global uint *pos = &position_list[get_global_id(0)*L];
+    uint2 rng;
+    uint i, n = 0;
+
+    if (schedule == SCHEDULE_RANDOM) {
+        for (i = 0; i < L; i++) {
+            uint r = nextPosRand(&rstate, &rng, &n);
+            pos[i] = ((ulong)r*L) >> 32;
+        }
+    }
+    else {
+        for (i = 0; i < L; i++) {
+            pos[i] = i;
+        }
+    }
+
+    if (schedule == SCHEDULE_PERMUTATION) {
+        // Fisher-Yates shuffle
+        for (i = L-1; i > 0; i--) {
+            uint r = nextPosRand(&rstate, &rng, &n);
+            uint j = ((ulong)r*(i+1)) >> 32;
+            uint tmp = pos[i];
+            pos[i] = pos[j];
+            pos[j] = tmp;
+        }
+    }
+
+    posrng[get_global_id(0)] = rstate;
+}
+
+// The samplers index the couplings as if they were in the unpacked
+// (L*L, q*q) form, where row (pos, m) holds the couplings of pos with m.
+// If packedJ is set, J is instead in the packed (nPairs, q*q) form, which
+// needs about half the memory, and this maps an unpacked index to the packed
+// one. Rows (pos, m) with m < pos are the transpose of packed row (m, pos).
+// Diagonal rows and indices past the end are never used, and map to 0.
+inline uint packedJindex(uint u) {
+    uint i = u/(L*q*q);
+    uint j = (u/(q*q))%L;
+    uint ab = u%(q*q);
+
+    if (i < j) {
+        return ((i*(2*L-i-1))/2 + j-i-1)*q*q + ab;
+    }
+    if (j < i && i < L) {
+        return ((j*(2*L-j-1))/2 + i-j-1)*q*q + q*(ab%q) + ab/q;
+    }
+    return 0;
+}
+#define loadJu(J, packedJ, u) loadJ(J, (packedJ) ? packedJindex(u) : (u))
+
 // This function is the bottleneck of the entire MCMC analysis.
 // It is IO bound by the sequence loads and J loads.
-inline float DeltaEnergy(__local float *lJ, __global float *J,
+inline float DeltaEnergy(__local float *lJ, __global jtype *J, uint packedJ,
                           global uint *seqmem, uint nseqs,
                           uint pos, uint seqp, uchar mutres) {
     uint Jmem_offset = WGMASK(pos*L*q*q);
     uint lJ_offset = pos*L*q*q - Jmem_offset;;
 
     // load 2*WGSIZE worth of couplings
-    lJ[get_local_id(0)] = J[Jmem_offset + get_local_id(0)];
+    lJ[get_local_id(0)] = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
     Jmem_offset += WGSIZE;
-    lJ[get_local_id(0) + WGSIZE] = J[Jmem_offset + get_local_id(0)];
+    lJ[get_local_id(0) + WGSIZE] = loadJu(J, packedJ,
+                                          Jmem_offset + get_local_id(0));
     barrier(CLK_LOCAL_MEM_FENCE);
 
     // prefetch next WGSIZE couplings
     Jmem_offset += WGSIZE;
-    float Jprefetch = J[Jmem_offset + get_local_id(0)];
+    float Jprefetch = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
 
     float dE = 0;
 
@@ -381,15 +505,15 @@ inline float DeltaEnergy(__local float *lJ, __global float *J,
         //loop through seq, changing energy by changed coupling with pos
 
         // load sequence data
-        if (m%4 == 0) {
+        if (m%RPW == 0) {
             sbm = sbm_prefetch;
-            if (m+4 < L) {
-                sbm_prefetch = seqmem[((m+4)/4)*nseqs + get_global_id(0)];
+            if (m+RPW < L) {
+                sbm_prefetch = seqmem[((m+RPW)/RPW)*nseqs + get_global_id(0)];
             }
         }
 
         if (m != pos) {
-            uint seqm = getbyte(&sbm, m%4);
+            uint seqm = getres(sbm, m%RPW);
             dE += (lJ[(lJ_offset + q*mutres + seqm)%(2*WGSIZE)] -
                    lJ[(lJ_offset + q*seqp   + seqm)%(2*WGSIZE)]);
         }
@@ -403,7 +527,7 @@ inline float DeltaEnergy(__local float *lJ, __global float *J,
 
             // start next prefetch
             Jmem_offset += WGSIZE;
-            Jprefetch = J[Jmem_offset + get_local_id(0)];
+            Jprefetch = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
         }
 
         lJ_offset = (lJ_offset + q*q)%(2*WGSIZE);
@@ -412,15 +536,66 @@ inline float DeltaEnergy(__local float *lJ, __global float *J,
     return dE;
 }
 
+#ifdef PROPOSAL
+// Draws the proposed residue at pos from the proposal distribution, a (L, q)
+// table of probabilities, using the random number r. Sets *hastings to the
+// Hastings factor p(seqp)/p(mutres) of the move, which multiplies the
+// Boltzmann factor in the acceptance test.
+inline uint proposeRes(__global float *proposal, uint pos, uint seqp, uint r,
+                       float *hastings) {
+    __global float *p = &proposal[pos*q];
+    float u = uniformMap(r), cumprob = 0;
+    uint a, mutres = q-1;
+    for (a = 0; a < q-1; a++) {
+        cumprob += p[a];
+        if (u < cumprob) {
+            mutres = a;
+            break;
+        }
+    }
+    *hastings = p[seqp]/p[mutres];
+    return mutres;
+}
+#endif
+
+#ifdef ADAPT_PROPOSAL
+// counts of tried and accepted proposals of each residue at each position,
+// used by adaptProposal
+#define countProposal(propcounts, pos, mutres, seqp, accepted) \
+    if (mutres != seqp) { \
+        atomic_inc(&propcounts[pos*q + mutres]); \
+        if (accepted) { \
+            atomic_inc(&propcounts[(L + pos)*q + mutres]); \
+        } \
+    }
+#else
+#define countProposal(propcounts, pos, mutres, seqp, accepted)
+#endif
+
+// The metropolis samplers propose a uniformly random residue, or if PROPOSAL
+// is defined one drawn from the 'proposal' buffer (see proposeRes).
+// propcounts is only used with ADAPT_PROPOSAL, and both may be NULL
+// otherwise. If CLAMP is defined, moves at the positions marked in markpos
+// are rejected, so their residues are never changed. These steps are not
+// skipped, as branching around the local memory barriers is not safe on all
+// devices. All the samplers keep the walker energies up to date, by adding
+// the energy change of every accepted move to energies, which must hold the
+// energies of the walkers on entry. Float rounding makes these drift slowly
+// from the exact energies, so the host recomputes them every few calls.
 __kernel
-void metropolis(__global float *J,
+void metropolis(__global jtype *J,
+                         uint packedJ,
                 __global mwc64xvec2_state_t *rngstates,
                          uint position_offset,
                 __global uint *position_list,
                          uint nsteps, // must be multiple of L
-                __global float *energies, //ony used to measure fp error
+                __global float *energies,
                 __global float *betas,
-                __global uint *seqmem) {
+                __global uint *seqmem,
+                __global uint *naccept,
+                __global float *proposal,
+                __global uint *propcounts,
+                __global uchar *markpos) {
 
     uint nseqs = get_global_size(0);
     mwc64xvec2_state_t rstate = rngstates[get_global_id(0)];
@@ -434,27 +609,884 @@ void metropolis(__global float *J,
     const float B = BETA;
 #endif
 
-    uint i;
+    uint i, nacc = 0;
+    float E = energies[get_global_id(0)];
     for (i = 0; i < nsteps; i++) {
         uint pos = position_list[i + position_offset];
         uint2 rng = MWC64XVEC2_NextUint2(&rstate);
-        rng.x = rng.x%q;         // small error here if MAX_INT%q != 0
-        #define mutres  (rng.x)  // of order q/MAX_INT in marginals
-        uint sbn = seqmem[(pos/4)*nseqs + get_global_id(0)];
-        uint seqp = getbyte(&sbn, pos%4);
+        uint sbn = seqmem[(pos/RPW)*nseqs + get_global_id(0)];
+        uint seqp = getres(sbn, pos%RPW);
+#ifdef PROPOSAL
+        float hastings;
+        uint mutres = proposeRes(proposal, pos, seqp, rng.x, &hastings);
+#else
+        const float hastings = 1;
+        uint mutres = rng.x%q;   // small error here if MAX_INT%q != 0
+                                 // of order q/MAX_INT in marginals
+#endif
 
-        float dE = DeltaEnergy(lJ, J, seqmem, nseqs, pos, seqp, mutres);
+        float dE = DeltaEnergy(lJ, J, packedJ, seqmem, nseqs,
+                               pos, seqp, mutres);
 
         //apply MC criterion and possibly update
-        if (exp(-B*dE) > uniformMap(rng.y)) {
-            setbyte(&sbn, pos%4, mutres);
-            seqmem[(pos/4)*nseqs + get_global_id(0)] = sbn;
+        bool accept = exp(-B*dE)*hastings > uniformMap(rng.y);
+#ifdef CLAMP
+        accept = accept && !markpos[pos];
+#endif
+        if (accept) {
+            setres(sbn, pos%RPW, mutres);
+            seqmem[(pos/RPW)*nseqs + get_global_id(0)] = sbn;
+            nacc += (mutres != seqp);
+            E += dE;
         }
+        countProposal(propcounts, pos, mutres, seqp, accept);
+    }
+
+    rngstates[get_global_id(0)] = rstate;
+    naccept[get_global_id(0)] = nacc;
+    energies[get_global_id(0)] = E;
+}
+
+// Computes the energy of every residue at pos given the rest of the
+// sequence (up to a constant), in a single pass through the couplings of
+// pos. Uses the same local memory scheme as DeltaEnergy.
+inline void ConditionalEnergies(__local float *lJ, __global jtype *J,
+                                uint packedJ,
+                                global uint *seqmem, uint nseqs,
+                                uint pos, float *condE) {
+    uint Jmem_offset = WGMASK(pos*L*q*q);
+    uint lJ_offset = pos*L*q*q - Jmem_offset;
+    uint a;
+
+    // load 2*WGSIZE worth of couplings
+    lJ[get_local_id(0)] = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
+    Jmem_offset += WGSIZE;
+    lJ[get_local_id(0) + WGSIZE] = loadJu(J, packedJ,
+                                          Jmem_offset + get_local_id(0));
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // prefetch next WGSIZE couplings
+    Jmem_offset += WGSIZE;
+    float Jprefetch = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
 
-        #undef mutres
+    for (a = 0; a < q; a++) {
+        condE[a] = 0;
+    }
+
+    uint m, sbm;
+    uint sbm_prefetch = seqmem[get_global_id(0)];
+    for (m = 0; m < L; m++) {
+        // load sequence data
+        if (m%RPW == 0) {
+            sbm = sbm_prefetch;
+            if (m+RPW < L) {
+                sbm_prefetch = seqmem[((m+RPW)/RPW)*nseqs + get_global_id(0)];
+            }
+        }
+
+        if (m != pos) {
+            uint seqm = getres(sbm, m%RPW);
+            for (a = 0; a < q; a++) {
+                condE[a] += lJ[(lJ_offset + q*a + seqm)%(2*WGSIZE)];
+            }
+        }
+
+        // load couplings
+        if (lJ_offset + q*q >= WGMASK(lJ_offset) + WGSIZE) {
+            // store prefetched values in their place
+            barrier(CLK_LOCAL_MEM_FENCE);
+            lJ[WGMASK(lJ_offset) + get_local_id(0)] = Jprefetch;
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            // start next prefetch
+            Jmem_offset += WGSIZE;
+            Jprefetch = loadJu(J, packedJ, Jmem_offset + get_local_id(0));
+        }
+
+        lJ_offset = (lJ_offset + q*q)%(2*WGSIZE);
+    }
+}
+
+// Heat-bath (Gibbs) sampler: same arguments as metropolis, but instead of
+// proposing a single mutation, the residue at pos is resampled from its
+// conditional distribution given the rest of the sequence. This costs about
+// the same memory traffic as a metropolis step, since the whole row of
+// couplings of pos is loaded either way, but never rejects.
+__kernel
+void gibbs(__global jtype *J,
+                    uint packedJ,
+           __global mwc64xvec2_state_t *rngstates,
+                    uint position_offset,
+           __global uint *position_list,
+                    uint nsteps, // must be multiple of L
+           __global float *energies,
+           __global float *betas,
+           __global uint *seqmem,
+           __global uint *naccept,
+           __global uchar *markpos) {
+
+    uint nseqs = get_global_size(0);
+    mwc64xvec2_state_t rstate = rngstates[get_global_id(0)];
+
+    //set up local mem
+    __local float lJ[2*WGSIZE];
+
+#ifdef TEMPERING
+    float B = betas[get_global_id(0)];
+#else
+    const float B = BETA;
+#endif
+
+    uint i, a, nacc = 0;
+    float E = energies[get_global_id(0)];
+    float condE[q];
+    for (i = 0; i < nsteps; i++) {
+        uint pos = position_list[i + position_offset];
+        uint2 rng = MWC64XVEC2_NextUint2(&rstate);
+        uint sbn = seqmem[(pos/RPW)*nseqs + get_global_id(0)];
+        uint seqp = getres(sbn, pos%RPW);
+
+        ConditionalEnergies(lJ, J, packedJ, seqmem, nseqs, pos, condE);
+
+        // unnormalized probabilities, shifted to avoid overflow. These are
+        // recomputed in the search below so condE keeps the energies.
+        float Emin = condE[0];
+        for (a = 1; a < q; a++) {
+            Emin = min(Emin, condE[a]);
+        }
+        float Z = 0;
+        for (a = 0; a < q; a++) {
+            Z += exp(-B*(condE[a] - Emin));
+        }
+
+        // linear search through the cumulative probabilities
+        float r = uniformMap(rng.x)*Z;
+        float cumprob = 0;
+        uint mutres = q-1;
+        for (a = 0; a < q-1; a++) {
+            cumprob += exp(-B*(condE[a] - Emin));
+            if (r < cumprob) {
+                mutres = a;
+                break;
+            }
+        }
+
+#ifdef CLAMP
+        if (markpos[pos]) {
+            mutres = seqp;
+        }
+#endif
+        if (mutres != seqp) {
+            setres(sbn, pos%RPW, mutres);
+            seqmem[(pos/RPW)*nseqs + get_global_id(0)] = sbn;
+            nacc++;
+            E += condE[mutres] - condE[seqp];
+        }
     }
 
     rngstates[get_global_id(0)] = rstate;
+    naccept[get_global_id(0)] = nacc;
+    energies[get_global_id(0)] = E;
+}
+
+// Metropolis sampler using a per-walker table of local fields,
+//     fields[pos,a] = sum_{m != pos} J[pos,m][a, seq[m]]
+// stored as (L*q, nseqs) so accesses are coalesced, so that the energy change
+// of a proposal is a difference of two table entries instead of a pass over
+// the coupling row of pos. The table is only updated (O(L*q) work) when a
+// mutation is accepted, so this is faster than metropolis when few proposals
+// are accepted. The table is recomputed at the start of each call, since
+// the sequences and couplings may have changed since the last call, which
+// also bounds the accumulated floating-point error. Proposals and rng use are
+// the same as in metropolis.
+__kernel
+void metropolis_fields(__global jtype *J,
+                                uint packedJ,
+                       __global mwc64xvec2_state_t *rngstates,
+                                uint position_offset,
+                       __global uint *position_list,
+                                uint nsteps, // must be multiple of L
+                       __global float *energies,
+                       __global float *betas,
+                       __global uint *seqmem,
+                       __global uint *naccept,
+                       __global float *proposal,
+                       __global uint *propcounts,
+                       __global float *fields,
+                       __global uchar *markpos) {
+
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+    mwc64xvec2_state_t rstate = rngstates[gid];
+
+    //set up local mem
+    __local float lJ[2*WGSIZE];
+
+#ifdef TEMPERING
+    float B = betas[gid];
+#else
+    const float B = BETA;
+#endif
+
+    uint i, m, a, nacc = 0;
+    float E = energies[gid];
+
+    // fill in the field table
+    float condE[q];
+    for (m = 0; m < L; m++) {
+        ConditionalEnergies(lJ, J, packedJ, seqmem, nseqs, m, condE);
+        for (a = 0; a < q; a++) {
+            fields[(m*q + a)*nseqs + gid] = condE[a];
+        }
+    }
+
+    for (i = 0; i < nsteps; i++) {
+        uint pos = position_list[i + position_offset];
+        uint2 rng = MWC64XVEC2_NextUint2(&rstate);
+        uint sbn = seqmem[(pos/RPW)*nseqs + gid];
+        uint seqp = getres(sbn, pos%RPW);
+#ifdef PROPOSAL
+        float hastings;
+        uint mutres = proposeRes(proposal, pos, seqp, rng.x, &hastings);
+#else
+        const float hastings = 1;
+        uint mutres = rng.x%q;
+#endif
+
+        float dE = fields[(pos*q + mutres)*nseqs + gid] -
+                   fields[(pos*q + seqp)*nseqs + gid];
+
+        //apply MC criterion and possibly update
+        bool accept = exp(-B*dE)*hastings > uniformMap(rng.y);
+#ifdef CLAMP
+        accept = accept && !markpos[pos];
+#endif
+        countProposal(propcounts, pos, mutres, seqp, accept);
+        if (accept && mutres != seqp) {
+            setres(sbn, pos%RPW, mutres);
+            seqmem[(pos/RPW)*nseqs + gid] = sbn;
+            nacc++;
+            E += dE;
+
+            // update the fields of all other positions (fields[pos] does
+            // not depend on seq[pos])
+            for (m = 0; m < L; m++) {
+                if (m == pos) {
+                    continue;
+                }
+                uint Jm = (m*L + pos)*q*q;
+                for (a = 0; a < q; a++) {
+                    float dJ = loadJu(J, packedJ, Jm + q*a + mutres) -
+                               loadJu(J, packedJ, Jm + q*a + seqp);
+                    fields[(m*q + a)*nseqs + gid] += dJ;
+                }
+            }
+        }
+    }
+
+    rngstates[gid] = rstate;
+    naccept[gid] = nacc;
+    energies[gid] = E;
+}
+
+#ifdef ADAPT_PROPOSAL
+// Adapts the proposal distribution of the metropolis samplers from the
+// proposal counts since the last call, which are then cleared: the
+// probability of each residue is multiplied by the square root of its
+// (regularized) acceptance rate, and the result is mixed with the uniform
+// distribution with weight unif so that every residue stays reachable.
+// Call with L work units.
+__kernel
+void adaptProposal(__global float *proposal,
+                   __global uint *propcounts,
+                            float unif) {
+    uint pos = get_global_id(0);
+    if (pos >= L) {
+        return;
+    }
+
+    float p[q];
+    float Z = 0;
+    uint a;
+    for (a = 0; a < q; a++) {
+        float tried = propcounts[pos*q + a];
+        float accepted = propcounts[(L + pos)*q + a];
+        p[a] = proposal[pos*q + a]*sqrt((accepted + 1)/(tried + 1));
+        Z += p[a];
+        propcounts[pos*q + a] = 0;
+        propcounts[(L + pos)*q + a] = 0;
+    }
+    for (a = 0; a < q; a++) {
+        proposal[pos*q + a] = (1 - unif)*p[a]/Z + unif/q;
+    }
+}
+#endif
+
+// ****************************** Parallel tempering **************************
+
+#ifdef NTEMPS
+// Replica exchange between neighboring temperatures. The walkers are divided
+// into independent chains of NTEMPS replicas, one at each inverse temperature
+// tempB[k] (in increasing order). walkers[k*nchains + c] is the walker of
+// chain c which is currently at temperature k. Rather than exchanging the
+// sequences, a swap exchanges the betas of the two walkers. Swaps alternate
+// between the even and odd neighbor pairs, starting with the pairs of the
+// given parity. Energies must be up to date. Call with nchains work units.
+__kernel
+void swapTemps(__global float *energies,
+               __global float *betas,
+               __global uint *walkers,
+               __constant float *tempB,
+               __global mwc64xvec2_state_t *rngstates,
+                        uint nswaps,
+                        uint parity,
+               __global uint *nswapped,
+               __global uint *ntried) {
+    uint c = get_global_id(0);
+    uint nchains = get_global_size(0);
+    mwc64xvec2_state_t rstate = rngstates[c];
+
+    uint wk[NTEMPS], nacc[NTEMPS], ntry[NTEMPS];
+    float Ek[NTEMPS];
+    uint k, n;
+    for (k = 0; k < NTEMPS; k++) {
+        wk[k] = walkers[k*nchains + c];
+        Ek[k] = energies[wk[k]];
+        nacc[k] = 0;
+        ntry[k] = 0;
+    }
+
+    for (n = 0; n < nswaps; n++) {
+        for (k = (n + parity)%2; k+1 < NTEMPS; k += 2) {
+            uint2 rng = MWC64XVEC2_NextUint2(&rstate);
+            float delta = (tempB[k] - tempB[k+1])*(Ek[k] - Ek[k+1]);
+            ntry[k]++;
+            if (exp(delta) > uniformMap(rng.x)) {
+                uint w = wk[k];
+                wk[k] = wk[k+1];
+                wk[k+1] = w;
+                float E = Ek[k];
+                Ek[k] = Ek[k+1];
+                Ek[k+1] = E;
+                nacc[k]++;
+            }
+        }
+    }
+
+    for (k = 0; k < NTEMPS; k++) {
+        walkers[k*nchains + c] = wk[k];
+        betas[wk[k]] = tempB[k];
+    }
+    for (k = 0; k+1 < NTEMPS; k++) {
+        atomic_add(&nswapped[k], nacc[k]);
+        atomic_add(&ntried[k], ntry[k]);
+    }
+    rngstates[c] = rstate;
+}
+
+// copies the walkers at temperature k to the large buffer, after offset.
+// Call with nchains work units.
+__kernel
+void storeTempSeqs(__global uint *smallbuf,
+                            uint  nsmallbuf,
+                   __global uint *largebuf,
+                            uint  nlargebuf,
+                            uint  offset,
+                   __global uint *walkers,
+                            uint  k) {
+    uint w;
+    uint n = get_global_id(0);
+    uint walker = walkers[k*get_global_size(0) + n];
+
+    for (w = 0; w < SWORDS; w++) {
+        largebuf[w*nlargebuf + offset + n] = smallbuf[w*nsmallbuf + walker];
+    }
+}
+#endif
+
+// ****************************** Population annealing ************************
+
+// Population annealing resampling step: chooses nseq parent walkers in
+// proportion to exp(-dB*E), using systematic resampling. The weights are
+// computed relative to the lowest energy, and their cumulative sum is stored
+// in cumw. Uses the rng state of walker 0. Call with 1 group of size VSIZE,
+// must be power of two.
+__kernel
+void annealParents(__global float *energies,
+                            float  dB,
+                            uint   nseq,
+                   __global float *cumw,
+                   __global uint  *parents,
+                   __global mwc64xvec2_state_t *rngstates,
+                   __local  float *scratch) {
+    uint li = get_local_id(0);
+    uint vsize = get_local_size(0);
+    uint n, m;
+
+    // find lowest energy
+    scratch[li] = INFINITY;
+    for (n = li; n < nseq; n += vsize) {
+        scratch[li] = fmin(energies[n], scratch[li]);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (n = vsize/2; n > 0; n >>= 1) {
+        if (li < n) {
+            scratch[li] = fmin(scratch[li], scratch[li + n]);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    float Emin = scratch[0];
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // cumulative sum of the weights, in chunks of vsize
+    float total = 0;
+    for (m = 0; m < nseq; m += vsize) {
+        n = m + li;
+        scratch[li] = n < nseq ? exp(-dB*(energies[n] - Emin)) : 0;
+        barrier(CLK_LOCAL_MEM_FENCE);
+        for (uint s = 1; s < vsize; s <<= 1) {
+            float x = li >= s ? scratch[li - s] : 0;
+            barrier(CLK_LOCAL_MEM_FENCE);
+            scratch[li] += x;
+            barrier(CLK_LOCAL_MEM_FENCE);
+        }
+        if (n < nseq) {
+            cumw[n] = total + scratch[li];
+        }
+        total += scratch[vsize-1];
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    barrier(CLK_GLOBAL_MEM_FENCE);
+
+    // offset of the systematic resampling grid
+    if (li == 0) {
+        mwc64xvec2_state_t rstate = rngstates[0];
+        scratch[0] = uniformMap(MWC64XVEC2_NextUint2(&rstate).x);
+        rngstates[0] = rstate;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    float u = scratch[0];
+
+    // binary search for the first walker with cumw above each grid point
+    for (n = li; n < nseq; n += vsize) {
+        float t = (n + u)*total/nseq;
+        uint lo = 0, hi = nseq - 1;
+        while (lo < hi) {
+            uint mid = (lo + hi)/2;
+            if (cumw[mid] > t) {
+                hi = mid;
+            }
+            else {
+                lo = mid + 1;
+            }
+        }
+        parents[n] = lo;
+    }
+}
+
+// copies the parent of each walker into resampled. Call with nseq work units.
+__kernel
+void copyParents(__global uint *seqmem,
+                 __global uint *resampled,
+                 __global uint *parents) {
+    uint w;
+    uint nseqs = get_global_size(0);
+    uint n = get_global_id(0);
+    uint parent = parents[n];
+
+    for (w = 0; w < SWORDS; w++) {
+        resampled[w*nseqs + n] = seqmem[w*nseqs + parent];
+    }
+}
+
+// ****************************** Gap-block moves *****************************
+
+#ifdef GAPRES
+// Energy change of setting seq[pos] to res, given the rest of seq, computed
+// from the coupling row of pos.
+inline float siteDeltaE(__global jtype *J, uint packedJ, uchar *seq,
+                        uint pos, uint res) {
+    uint m, seqp = seq[pos];
+    float dE = 0;
+    for (m = 0; m < L; m++) {
+        if (m != pos) {
+            uint row = (pos*L + m)*q*q;
+            dE += (loadJu(J, packedJ, row + q*res  + seq[m]) -
+                   loadJu(J, packedJ, row + q*seqp + seq[m]));
+        }
+    }
+    return dE;
+}
+
+// draws a non-gap residue at pos from the gapfill table
+inline uint fillRes(__global float *gapfill, uint pos, uint r) {
+    __global float *p = &gapfill[pos*q];
+    float u = uniformMap(r), cumprob = 0;
+    uint a, res = (GAPRES == q-1) ? q-2 : q-1;
+    for (a = 0; a < q-1; a++) {
+        cumprob += p[a];
+        if (u < cumprob) {
+            res = a;
+            break;
+        }
+    }
+    return res;
+}
+
+// Moves of contiguous blocks of gaps (residue GAPRES), which the single-site
+// samplers can only make through improbable intermediate sequences. Each of
+// the nmoves moves picks a position pos, a direction d and a length k in
+// 1..GAPBLOCK, and with equal probability either
+//   toggles the k sites from pos in direction d, which gaps them if they are
+//   all non-gaps, or fills them with residues drawn from gapfill if they are
+//   all gaps, or
+//   shifts a block of k gaps by one site, turning the k+1 sites from pos in
+//   direction d from [gap x k, res] to [res', gap x k] or back, where res' is
+//   drawn from gapfill,
+// and is rejected otherwise. The reverse of each move is made by the same
+// choice of pos, d and k, so it is accepted with the Metropolis-Hastings
+// probability using the gapfill probabilities of the residues created and
+// destroyed. gapfill is a (L, q) table of the non-gap residue probabilities
+// at each position. Call with one work unit per walker.
+__kernel
+void gapMoves(__global jtype *J,
+                       uint packedJ,
+              __global mwc64xvec2_state_t *rngstates,
+                       uint nmoves,
+              __global float *betas,
+              __global uint *seqmem,
+              __global float *energies,
+              __global float *gapfill,
+              __global uint *gapaccept) {
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+    mwc64xvec2_state_t rstate = rngstates[gid];
+
+#ifdef TEMPERING
+    float B = betas[gid];
+#else
+    const float B = BETA;
+#endif
+
+    uchar seq[L], old[GAPBLOCK+1];
+    uint i, j, w, nacc = 0;
+    float E = energies[gid];
+
+    for (i = 0; i < L; i++) {
+        seq[i] = getres(seqmem[(i/RPW)*nseqs + gid], i%RPW);
+    }
+
+    for (i = 0; i < nmoves; i++) {
+        uint2 r1 = MWC64XVEC2_NextUint2(&rstate);
+        uint2 r2 = MWC64XVEC2_NextUint2(&rstate);
+        int pos = ((ulong)r1.x*L) >> 32;
+        uint k = 1 + (((ulong)r1.y*GAPBLOCK) >> 32);
+        int d = (r2.x & 1) ? 1 : -1;
+        bool shift = (r2.x >> 1) & 1;
+        uint n = shift ? k+1 : k;
+
+        // the window is the n sites pos + j*d
+        int end = pos + (int)(n-1)*d;
+        if (end < 0 || end >= L) {
+            continue;
+        }
+
+        uint ngap = 0;
+        for (j = 0; j < n; j++) {
+            ngap += seq[pos + (int)j*d] == GAPRES;
+        }
+        bool firstgap = seq[pos] == GAPRES;
+        if (shift ? (ngap != k || (firstgap && seq[end] == GAPRES))
+                  : (ngap != 0 && ngap != k)) {
+            continue;
+        }
+
+        // make the move site by site, accumulating the energy change and
+        // the Hastings factor
+        float dE = 0, hastings = 1;
+        for (j = 0; j < n; j++) {
+            uint site = pos + (int)j*d;
+            uint seqp = seq[site];
+            old[j] = seqp;
+
+            uint res;
+            if (shift) {
+                // [gap x k, res] -> [res', gap x k], or the reverse
+                bool newgap = firstgap ? (j != 0) : (j != n-1);
+                if (newgap == (seqp == GAPRES)) {
+                    continue;
+                }
+                res = newgap ? GAPRES
+                             : fillRes(gapfill, site,
+                                       MWC64XVEC2_NextUint2(&rstate).x);
+            }
+            else {
+                res = ngap ? fillRes(gapfill, site,
+                                     MWC64XVEC2_NextUint2(&rstate).x)
+                           : GAPRES;
+            }
+            if (res == GAPRES) {
+                hastings *= gapfill[site*q + seqp];
+            }
+            else {
+                hastings /= gapfill[site*q + res];
+            }
+
+            dE += siteDeltaE(J, packedJ, seq, site, res);
+            seq[site] = res;
+        }
+
+        if (exp(-B*dE)*hastings > uniformMap(r2.y)) {
+            nacc++;
+            E += dE;
+        }
+        else {
+            for (j = 0; j < n; j++) {
+                seq[pos + (int)j*d] = old[j];
+            }
+        }
+    }
+
+    for (w = 0; w < SWORDS; w++) {
+        uint sbn = seqmem[w*nseqs + gid];
+        for (j = 0; j < RPW && w*RPW + j < L; j++) {
+            setres(sbn, j, seq[w*RPW + j]);
+        }
+        seqmem[w*nseqs + gid] = sbn;
+    }
+
+    rngstates[gid] = rstate;
+    gapaccept[gid] = nacc;
+    energies[gid] = E;
+}
+#endif
+
+// ****************************** Independence jumps *************************
+
+#ifdef JUMPS
+// draws a residue from the probabilities p[0..q-1] using the random number r
+inline uint jumpRes(__global float *p, uint r) {
+    float u = uniformMap(r), cumprob = 0;
+    uint a;
+    for (a = 0; a < q-1; a++) {
+        cumprob += p[a];
+        if (u < cumprob) {
+            return a;
+        }
+    }
+    return q-1;
+}
+
+#define logaddexp(a, b) (fmax(a, b) + log1p(exp(-fabs((a) - (b)))))
+
+// Proposes a global move of each walker, with probability jumprate, to a
+// sequence drawn independently of its current one: either from the
+// independent model jumpp (a (L, q) table of residue probabilities), or if
+// nmsa > 0 a random msa sequence with each residue redrawn from jumpp with
+// probability mut. The proposals are stored in jumpseqs (walkers which do not
+// jump get a copy of their sequence), and dlogg is set to the log of the
+// Hastings factor g(seq)/g(jump) of the proposal distribution g, or to
+// -infinity for walkers which do not jump. For msa jumps g sums over the
+// msa, so these cost O(nmsa*L) per jumping walker. The moves are accepted
+// or rejected by jumpAccept, after the energies of both buffers have been
+// computed. Call with one work unit per walker.
+__kernel
+void jumpPropose(__global mwc64xvec2_state_t *rngstates,
+                          float jumprate,
+                 __global uint *seqmem,
+                 __global uint *jumpseqs,
+                 __global uint *msa,
+                          uint nmsa,
+                 __global float *jumpp,
+                          float mut,
+                 __global float *dlogg) {
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+    mwc64xvec2_state_t rstate = rngstates[gid];
+    uint i, j, n, w;
+
+    uint2 r = MWC64XVEC2_NextUint2(&rstate);
+    if (uniformMap(r.x) >= jumprate) {
+        for (w = 0; w < SWORDS; w++) {
+            jumpseqs[w*nseqs + gid] = seqmem[w*nseqs + gid];
+        }
+        dlogg[gid] = -INFINITY;
+        rngstates[gid] = rstate;
+        return;
+    }
+
+    uchar seq[L], jump[L];
+    uint m = ((ulong)r.y*nmsa) >> 32;
+    for (i = 0; i < L; i++) {
+        uint2 ri = MWC64XVEC2_NextUint2(&rstate);
+        seq[i] = getres(seqmem[(i/RPW)*nseqs + gid], i%RPW);
+        if (nmsa == 0 || uniformMap(ri.x) < mut) {
+            jump[i] = jumpRes(&jumpp[i*q], ri.y);
+        }
+        else {
+            jump[i] = getres(msa[(i/RPW)*nmsa + m], i%RPW);
+        }
+    }
+
+    float logg = 0;
+    if (nmsa == 0) {
+        for (i = 0; i < L; i++) {
+            logg += log(jumpp[i*q + seq[i]]) - log(jumpp[i*q + jump[i]]);
+        }
+    }
+    else {
+        // log g(s) = sum_i log(mut*p_i(s_i)) + log(sum_n exp(sum_i b_i)) + C,
+        // summing b_i = log((1 - mut + mut*p_i(s_i))/(mut*p_i(s_i))) over
+        // the sites where msa sequence n matches s
+        float bseq[L], bjump[L];
+        for (i = 0; i < L; i++) {
+            float ps = mut*jumpp[i*q + seq[i]];
+            float pj = mut*jumpp[i*q + jump[i]];
+            bseq[i] = log((1 - mut + ps)/ps);
+            bjump[i] = log((1 - mut + pj)/pj);
+            logg += log(ps) - log(pj);
+        }
+
+        float Sseq = -INFINITY, Sjump = -INFINITY;
+        for (n = 0; n < nmsa; n++) {
+            float sseq = 0, sjump = 0;
+            for (w = 0; w < SWORDS; w++) {
+                uint sbn = msa[w*nmsa + n];
+                for (j = 0; j < RPW && w*RPW + j < L; j++) {
+                    uint a = getres(sbn, j);
+                    i = w*RPW + j;
+                    sseq += (a == seq[i]) ? bseq[i] : 0;
+                    sjump += (a == jump[i]) ? bjump[i] : 0;
+                }
+            }
+            Sseq = logaddexp(Sseq, sseq);
+            Sjump = logaddexp(Sjump, sjump);
+        }
+        logg += Sseq - Sjump;
+    }
+
+    for (w = 0; w < SWORDS; w++) {
+        uint sbn = 0;
+        for (j = 0; j < RPW && w*RPW + j < L; j++) {
+            setres(sbn, j, jump[w*RPW + j]);
+        }
+        jumpseqs[w*nseqs + gid] = sbn;
+    }
+    dlogg[gid] = logg;
+    rngstates[gid] = rstate;
+}
+
+// Metropolis-Hastings test of the jumps proposed by jumpPropose, given the
+// energies of the current and proposed sequences. Accepted jumps are copied
+// into seqmem, along with their energies. Call with one work unit per walker.
+__kernel
+void jumpAccept(__global mwc64xvec2_state_t *rngstates,
+                __global float *betas,
+                __global uint *seqmem,
+                __global uint *jumpseqs,
+                __global float *energies,
+                __global float *jumpenergies,
+                __global float *dlogg,
+                __global uint *jumpaccept) {
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+    uint w, acc = 0;
+
+#ifdef TEMPERING
+    float B = betas[gid];
+#else
+    const float B = BETA;
+#endif
+
+    float logg = dlogg[gid];
+    if (logg != -INFINITY) {
+        mwc64xvec2_state_t rstate = rngstates[gid];
+        uint2 r = MWC64XVEC2_NextUint2(&rstate);
+        rngstates[gid] = rstate;
+
+        float dE = jumpenergies[gid] - energies[gid];
+        if (exp(-B*dE + logg) > uniformMap(r.x)) {
+            for (w = 0; w < SWORDS; w++) {
+                seqmem[w*nseqs + gid] = jumpseqs[w*nseqs + gid];
+            }
+            energies[gid] = jumpenergies[gid];
+            acc = 1;
+        }
+    }
+    jumpaccept[gid] = acc;
+}
+#endif
+
+// ****************************** Sequence design ***************************
+
+// Keeps the lowest-energy sequence seen by each walker: if the walker's
+// energy is below bestenergies, copies it and its sequence into bestseqs.
+// The energies must be current (the samplers keep them so). Call with one
+// work unit per walker.
+__kernel
+void updateBest(__global uint *seqmem,
+                __global float *energies,
+                __global uint *bestseqs,
+                __global float *bestenergies) {
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+    uint w;
+
+    float E = energies[gid];
+    if (E < bestenergies[gid]) {
+        for (w = 0; w < SWORDS; w++) {
+            bestseqs[w*nseqs + gid] = seqmem[w*nseqs + gid];
+        }
+        bestenergies[gid] = E;
+    }
+}
+
+// Greedy descent: in each of nsweeps sweeps through the positions in order,
+// sets the residue at each position to the one of lowest conditional energy
+// (keeping the current residue on ties), so walkers move to a local minimum
+// under single mutations. Updates energies like the samplers, and sets
+// naccept to the number of changed residues. Call like metropolis.
+__kernel
+void greedyDescent(__global jtype *J,
+                            uint packedJ,
+                            uint nsweeps,
+                   __global float *energies,
+                   __global uint *seqmem,
+                   __global uint *naccept) {
+    uint nseqs = get_global_size(0);
+    uint gid = get_global_id(0);
+
+    //set up local mem
+    __local float lJ[2*WGSIZE];
+
+    uint i, pos, a, nacc = 0;
+    float E = energies[gid];
+    float condE[q];
+    for (i = 0; i < nsweeps; i++) {
+        for (pos = 0; pos < L; pos++) {
+            uint sbn = seqmem[(pos/RPW)*nseqs + gid];
+            uint seqp = getres(sbn, pos%RPW);
+
+            ConditionalEnergies(lJ, J, packedJ, seqmem, nseqs, pos, condE);
+
+            uint best = seqp;
+            for (a = 0; a < q; a++) {
+                if (condE[a] < condE[best]) {
+                    best = a;
+                }
+            }
+
+            if (best != seqp) {
+                setres(sbn, pos%RPW, best);
+                seqmem[(pos/RPW)*nseqs + gid] = sbn;
+                nacc++;
+                E += condE[best] - condE[seqp];
+            }
+        }
+    }
+
+    naccept[gid] = nacc;
+    energies[gid] = E;
 }
 
 // ****************************** Histogram Code **************************
@@ -489,10 +1521,10 @@ void countBivariate(__global uint *bicount,
     uint tmp;
     // loop through all sequences
     for (n = li; n < nseq; n += nhist) {
-        tmp = seqmem[(i/4)*buflen + n];
-        uint seqi = ((uchar*)&tmp)[i%4];
-        tmp = seqmem[(j/4)*buflen + n];
-        uint seqj = ((uchar*)&tmp)[j%4];
+        tmp = seqmem[(i/RPW)*buflen + n];
+        uint seqi = getres(tmp, i%RPW);
+        tmp = seqmem[(j/RPW)*buflen + n];
+        uint seqj = getres(tmp, j%RPW);
         hist[nhist*(q*seqi + seqj) + li]++;
     }
     barrier(CLK_LOCAL_MEM_FENCE);
@@ -680,19 +1712,22 @@ void weightedMarg(__global float *bimarg_new,
         hist[n] = 0;
     }
 
-    //loop through all sequences
-    for (n = li; n < nseq/4; n += HISTWS) {
-        sid[li] = seqmem[i*buflen + n];
-        sjd[li] = seqmem[j*buflen + n];
+    //loop through all sequences, RPW*HISTWS at a time. Sequences past nseq
+    //(if nseq is not a multiple of that) are given 0 weight.
+    for (m = 0; m < nseq/RPW; m += HISTWS) {
+        n = m + li;
+        sid[li] = n < nseq/RPW ? seqmem[i*buflen + n] : 0;
+        sjd[li] = n < nseq/RPW ? seqmem[j*buflen + n] : 0;
         #pragma unroll
-        for (uint k = 0; k < 4; k++) {
-            w[li] = weights[HISTWS*(4*(n/HISTWS) + k) + li];
+        for (uint k = 0; k < RPW; k++) {
+            uint nw = RPW*m + HISTWS*k + li;
+            w[li] = nw < nseq ? weights[nw] : 0;
             barrier(CLK_LOCAL_MEM_FENCE);
             if (li < NHIST) {
                 for (uint l = li; l < HISTWS; l += NHIST) {
-                    uint si = sid[(HISTWS*k + l)/4];
-                    uint sj = sjd[(HISTWS*k + l)/4];
-                    uint bin = q*((uint)getbyte(&si, l%4)) + getbyte(&sj, l%4);
+                    uint si = sid[(HISTWS*k + l)/RPW];
+                    uint sj = sjd[(HISTWS*k + l)/RPW];
+                    uint bin = q*getres(si, l%RPW) + getres(sj, l%RPW);
                     hist[NHIST*bin + li] += w[l];
                 }
             }
@@ -700,12 +1735,14 @@ void weightedMarg(__global float *bimarg_new,
         }
     }
 
-    //merge histograms. Every nhist/2 wu does a reduce over nhist elements
+    //merge histograms. Every nhist/2 wu does a reduce over nhist elements.
+    //All wu loop the same number of times, so they all reach the barriers.
     uint x = li%(NHIST/2);
-    for (n = li/(NHIST/2); n < q*q; n += HISTWS/(NHIST/2)) {
+    for (i = 0; i < q*q; i += HISTWS/(NHIST/2)) {
+        n = i + li/(NHIST/2);
         // since NHIST is pow of two we can use simpler reduction code (no odd)
         for (m = NHIST/2; m > 0; m >>= 1) {
-            if (x < m) {
+            if (x < m && n < q*q) {
                 hist[NHIST*n + x] = hist[NHIST*n + x] + hist[NHIST*n + x + m];
             }
             barrier(CLK_LOCAL_MEM_FENCE);
@@ -726,6 +1763,16 @@ void addFloatBufs(__global float *dst, __global float *src, int buflen) {
     dst[n] += src[n];
 }
 
+__kernel
+void addScaledFloatBufs(__global float *dst, __global float *src,
+                        float scale, int buflen) {
+    uint n = get_global_id(0);
+    if (n >= buflen) {
+        return;
+    }
+    dst[n] += scale*src[n];
+}
+
 // expects to be called with work-group size of q*q
 // Local scratch memory must be provided:
 // sums is q*q elements
@@ -842,6 +1889,52 @@ void updatedJ(__global float *bimarg_target,
     Jo[n] = Ji[n] - gamma*(bimarg_target[n] - bimarg[n])/(bimarg[n] + pc);
 }
 
+// Like updatedJ, but the step is the Adam (or RMSprop, for b1 = 0) update
+// computed from running averages m and s of the quasi-Newton step direction
+// and of its square, which are updated in place. c1 and c2 are the bias
+// corrections 1 - b1^t and 1 - b2^t, for the t-th update.
+#define ADAM_EPS 1e-8f
+__kernel
+void updatedJ_adam(__global float *bimarg_target,
+                   __global float *bimarg,
+                            float gamma,
+                            float pc,
+                            float b1,
+                            float b2,
+                            float c1,
+                            float c2,
+                   __global float *m,
+                   __global float *s,
+                   __global float *dJ) {
+    uint n = get_global_id(0);
+
+    if (n >= NCOUPLE) {
+        return;
+    }
+
+    float r = (bimarg_target[n] - bimarg[n])/(bimarg[n] + pc);
+    float mn = b1*m[n] + (1-b1)*r;
+    float sn = b2*s[n] + (1-b2)*r*r;
+    m[n] = mn;
+    s[n] = sn;
+    dJ[n] = dJ[n] - gamma*(mn/c1)/(sqrt(sn/c2) + ADAM_EPS);
+}
+
+// Nesterov momentum for the coupling update of each round: accumulates dJ
+// into the velocity v, and adds the momentum term to dJ.
+__kernel
+void momentumdJ(float mu, __global float *v, __global float *dJ) {
+    uint n = get_global_id(0);
+
+    if (n >= NCOUPLE) {
+        return;
+    }
+
+    float vn = mu*v[n] + dJ[n];
+    v[n] = vn;
+    dJ[n] = dJ[n] + mu*vn;
+}
+
 __kernel
 void reg_l1z(__global float *bimarg,
                       float gamma,
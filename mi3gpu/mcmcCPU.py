@@ -0,0 +1,1585 @@
+# Copyright 2020 Allan Haldane.
+#
+# This file is part of Mi3-GPU.
+#
+# Mi3-GPU is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# Mi3-GPU is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mi3-GPU.  If not, see <http://www.gnu.org/licenses/>.
+#
+#Contact: allan.haldane _AT_ gmail.com
+
+import time, platform, collections
+import numpy as np
+from numpy.random import RandomState
+from scipy.special import logsumexp
+
+from mi3gpu.utils.potts_common import posrng_streams
+
+try:
+    import mi3gpu.utils.seqtools as seqtools
+except ImportError:
+    seqtools = None
+
+################################################################################
+
+# MCMCCPU is a drop-in replacement for MCMCGPU which performs all computations
+# on the host using numpy, vectorized over all walkers at once. It implements
+# the same methods with the same buffer names so that GPU_node and NewtonSteps
+# can drive it unchanged, which is useful on machines without GPUs and for
+# small models.
+#
+# The main differences from MCMCGPU are in how buffers are stored:
+#   * Buffers are plain numpy arrays, kept in self.bufs.
+#   * Sequence buffers are stored unpacked, as (nseq, L) uint8 arrays, which is
+#     the same format getBuf/setBuf use for the GPU.
+#   * Instead of the transposed 'seqL' buffers, we cache the flattened
+#     (pair, residue-pair) index of every sequence, used to compute energies
+#     and marginals with a single gather/bincount. Like the 'seqL' buffers,
+#     the cache is invalidated whenever the sequences change.
+#
+# If the seqtools C extension is available, the MCMC sampling and energy
+# computations are done using its compiled sampler and getEnergies
+# functions, which take the packed sequence layout and rng state of the GPU
+# kernels, so that the sampled sequences are the same as with MCMCGPU for the
+# same seed.
+# Otherwise a slower numpy implementation of the sampler is used.
+#
+# All methods run synchronously, so FutureBuf.read() returns immediately.
+
+# max number of cached pair-index elements, above which they are recomputed
+# in chunks each time they are needed (limits memory use to ~512MB)
+paircode_cache_max = 1 << 27
+# number of pair-index elements to process at a time when not cached
+paircode_chunk = 1 << 22
+# size of the position buffer in multiples of nsteps, and the position
+# schedules, same as in mcmcGPU
+rng_buf_mul = 1024
+schedules = {'random': 0, 'sweep': 1, 'permutation': 2}
+# The 'auto' sampler uses the local-field sampler when the acceptance rate is
+# below fields_accept_max/q, and switches back above twice that, as in
+# mcmcGPU. The local-field table is small on the CPU (seqtools keeps it per
+# block of walkers), so there is no memory limit.
+fields_accept_max = 0.5
+# proposal distributions of the metropolis samplers, as in mcmcGPU
+proposals = ['uniform', 'indep', 'adaptive']
+proposal_unif = 0.05
+# longest block of gaps moved by the gap-block moves, as in mcmcGPU
+gap_block_max = 8
+# residue redraw probability of the jumps to MSA sequences, as in mcmcGPU
+jump_mut = 0.05
+# sampler calls between exact recomputes of the running energies, as in
+# mcmcGPU
+energy_resync = 16
+# rows of 'weightstats log', as in mcmcGPU
+jstep_log_max = 256
+
+CPUDevice = collections.namedtuple('CPUDevice', 'name')
+
+class FutureBuf:
+    def __init__(self, buffer, postprocess=None):
+        self.buffer = buffer
+        self.postfunc = postprocess
+
+        self.shape = buffer.shape
+        self.dtype = buffer.dtype
+
+    def read(self):
+        if self.postfunc != None:
+            return self.postfunc(self.buffer)
+        return self.buffer
+
+class MCMCCPU:
+    def __init__(self, cpuinfo, L, q, nseq, outdir, seed, beta=None,
+                 profile=False, nthreads=1, sampler='metropolis',
+                 schedule='random', precision='single', proposal='uniform',
+                 gapmoves=0, gapres=None):
+        if sampler not in ['metropolis', 'gibbs', 'fields', 'auto']:
+            raise ValueError("Unknown sampler '{}'".format(sampler))
+        if proposal not in proposals:
+            raise ValueError("Unknown proposal '{}'".format(proposal))
+        if proposal != 'uniform' and sampler == 'gibbs':
+            raise ValueError("The gibbs sampler does not use proposals")
+        if schedule not in schedules:
+            raise ValueError("Unknown position schedule '{}'".format(schedule))
+        if precision not in ['single', 'half']:
+            raise ValueError("Unknown J precision '{}'".format(precision))
+        if gapmoves > 0 and gapres is None:
+            raise ValueError("gap moves require a gap residue")
+
+        self.L = L
+        self.q = q
+        self.nPairs = L*(L-1)//2
+        self.SWORDS = ((L-1)//4+1)     #num words needed to store a sequence
+        self.nthreads = nthreads
+        self.sampler = sampler
+        self.usefields = sampler == 'fields'
+        self.schedule = schedule
+        self.precision = precision
+        self.proposal = proposal
+        self.gapmoves = gapmoves
+        self.gapres = gapres
+        self.events = collections.deque()
+        self.nseq = {'main': nseq}
+        self.nwalkers = nseq
+        self.beta = np.float32(beta if beta is not None else 1)
+
+        device, cpunum = cpuinfo
+        self.gpunum = cpunum
+        self.device = device
+
+        # outdir of None disables logging
+        self.logfn = None
+        if outdir is not None:
+            self.logfn = outdir / 'cpu-{}.log'.format(cpunum)
+            with open(self.logfn, "wt") as f:
+                print("  Device '{}'".format(device.name), file=f)
+
+        self.seed = int(seed)
+        self.rngstate = RandomState(seed)
+        self.profile = profile
+
+        self.initted = []
+
+        self.bufs = {}
+        self.buf_spec = {}
+        self.seqbufs = {}
+        self.Ebufs = {}
+        self.largebufs = []
+
+        # index arrays used to convert packed couplings to pairs i,j
+        self.pairi, self.pairj = np.triu_indices(L, k=1)
+
+        # setup essential buffers
+        nPairs = self.nPairs
+        self._setupBuffer(        'J', '<f4', (nPairs, q*q))
+        self._setupBuffer(       'bi', '<f4', (nPairs, q*q)),
+        self._setupBuffer(  'bicount', '<u4', (nPairs, q*q)),
+        self._setupBuffer( 'seq main', '<u1', (self.nseq['main'], L)),
+        self._setupBuffer(    'cprob', '<f4', (L, (q-1))),
+        self._setupBuffer(   'E main', '<f4', (self.nseq['main'],)),
+        self._setupBuffer(   'minout', '<f4', (1,))
+        self.unpackedJ = None #(L*L, q*q) couplings used by metropolis
+        self.paircodes = {}   #cached pair indices, see _paircodes
+        self.packedseqs = {}  #cached packed sequences used by seqtools
+        # sampler calls since 'E main' was last computed exactly, or None if
+        # it is out of date, see mcmcGPU.runMCMC
+        self.runningE = None
+
+    def log(self, msg):
+        #logs are rare, so just open the file every time
+        if self.logfn is None:
+            return
+        with open(self.logfn, "at") as f:
+            print("{: 10.3f}".format(time.process_time()), msg, file=f)
+
+    def logevt(self, name, start, nbytes=None):
+        # mimics MCMCGPU.logevt, so the output can be analyzed by
+        # analyze_gpu_profiling.py. Times are in ns.
+        if self.profile:
+            end = time.perf_counter_ns()
+            if nbytes:
+                self.events.append((name, start, end, nbytes))
+            else:
+                self.events.append((name, start, end))
+
+    def logProfile(self):
+        if not self.profile:
+            return
+
+        with open(self.logfn, "at") as f:
+            while len(self.events) != 0:
+                dat = self.events.popleft()
+                name, start, end = dat[:3]
+                size = dat[3] if len(dat) == 4 else ''
+                print("EVT", name, start, end, size, file=f)
+
+    def _allocBuffer(self, bufname, buftype, bufshape):
+        return np.zeros(bufshape, dtype=buftype)
+
+    def _freeBuffer(self, bufname):
+        self.bufs.pop(bufname)
+        self.buf_spec.pop(bufname)
+        names = bufname.split()
+        if len(names) > 1:
+            bufs = {'seq': self.seqbufs, 'E': self.Ebufs}
+            if names[0] in bufs:
+                bufs[names[0]].pop(names[1])
+
+    def _setupBuffer(self, bufname, buftype, bufshape):
+        buf = self._allocBuffer(bufname, buftype, bufshape)
+
+        self.bufs[bufname] = buf
+        self.buf_spec[bufname] = (buftype, bufshape)
+
+        # add it to convenience dicts if applicable
+        names = bufname.split()
+        if len(names) > 1:
+            bufs = {'seq': self.seqbufs, 'E': self.Ebufs}
+            if names[0] in bufs:
+                bufs[names[0]][names[1]] = buf
+
+    def require(self, *reqs):
+        for r in reqs:
+            if r not in self.initted:
+                raise Exception("{} not initialized".format(r))
+
+    def _initcomponent(self, cmp):
+        if cmp in self.initted:
+            raise Exception("Already initialized {}".format(cmp))
+        self.initted.append(cmp)
+
+    def initMCMC(self, nsteps, rng_offset, rng_span):
+        self._initcomponent('MCMC')
+
+        self.nsteps = int(nsteps)
+        self._setupBuffer('Bs', '<f4', (self.nseq['main'],)),
+        self._setupBuffer('naccept', '<u4', (self.nseq['main'],)),
+        self.setBuf('Bs', np.full(self.nseq['main'], self.beta, dtype='<f4'))
+        self.initPosRNG()
+
+        L, q = self.L, self.q
+        if self.proposal != 'uniform':
+            self._setupBuffer('proposal', '<f4', (L, q))
+            self.setBuf('proposal', np.full((L, q), 1/q, dtype='<f4'))
+        if self.proposal == 'adaptive':
+            self._setupBuffer('proposal counts', '<u4', (2, L, q))
+        if self.gapmoves > 0:
+            self._setupBuffer(  'gapfill', '<f4', (L, q))
+            self._setupBuffer('gapaccept', '<u4', (self.nseq['main'],))
+            self.setBuf('gapfill', self._gapfill())
+
+        # The walker rng must differ across devices, so seed it using the
+        # rng offset assigned to this device, like initRNG2 on the GPU.
+        rng_offset = int(rng_offset)
+        self.walker_rng = RandomState([self.seed, rng_offset >> 32,
+                                       rng_offset & 0xffffffff])
+        if seqtools is not None:
+            # the compiled sampler uses the GPU rng, see MCMCGPU._initMCMC_RNG
+            nwalkers = int(self.nseq['main'])
+            walker_span = int(rng_span)//(2*nwalkers)
+            self._setupBuffer('rngstates', '<2u8', (nwalkers,)),
+            seqtools.initRNG2(self.bufs['rngstates'], rng_offset, walker_span)
+            self.rng_offset, self.walker_span = rng_offset, walker_span
+
+    def initJumps(self, jumprate, unimarg=None, msaseqs=None):
+        """
+        Set up the independence-sampler jumps made after each MCMC round, like
+        MCMCGPU.initJumps.
+        """
+        self.require('MCMC')
+        self._initcomponent('Jumps')
+        L, q, nseq = self.L, self.q, self.nseq['main']
+
+        self.jumprate = jumprate
+        self.nseq['jump'] = nseq
+        self._setupBuffer(  'seq jump', '<u1', (nseq, L))
+        self._setupBuffer(    'E jump', '<f4', (nseq,))
+        self._setupBuffer('jumpaccept', '<u4', (nseq,))
+        self._setupBuffer(    'jump p', '<f4', (L, q))
+
+        p = np.full((L, q), 1/q)
+        if unimarg is not None:
+            p = unimarg/np.sum(unimarg, axis=1, keepdims=True)
+            p = (1 - proposal_unif)*p + proposal_unif/q
+        self.setBuf('jump p', p.astype('<f4'))
+
+        if msaseqs is not None:
+            self.nseq['jumpmsa'] = msaseqs.shape[0]
+            self._setupBuffer('seq jumpmsa', '<u1', msaseqs.shape)
+            self.setBuf('seq jumpmsa', msaseqs)
+
+    def initLargeBufs(self, nseq_large):
+        self._initcomponent('Large')
+
+        self.nseq['large'] = nseq_large
+        self._setupBuffer(    'seq large', '<u1', (nseq_large, self.L))
+        self._setupBuffer(      'E large', '<f4', (nseq_large,))
+        self._setupBuffer(  'E tmp large', '<f4', (nseq_large,)),
+        self._setupBuffer('weights large', '<f4', (nseq_large,))
+
+        self.largebufs.extend(['seq large', 'E large', 'weights large'])
+        self.nstoredseqs = 0
+
+    def initSubseq(self):
+        self.require('Large')
+        self._initcomponent('Subseq')
+        self._setupBuffer('markpos', '<u1',  (self.L,))
+        self.markPos(np.zeros(self.L, '<u1'))
+
+    def initClamp(self, clampseq, marks):
+        """
+        Clamp the positions marked in marks to their residues in clampseq,
+        like MCMCGPU.initClamp.
+        """
+        self.require('MCMC')
+        self._initcomponent('Clamp')
+        self.nseq['clamp'] = 1
+        self._setupBuffer('seq clamp', '<u1', (1, self.L))
+        if 'markpos' not in self.bufs:
+            self._setupBuffer('markpos', '<u1',  (self.L,))
+        self.setBuf('seq clamp', clampseq.reshape((1, self.L)))
+        self.markPos(marks)
+
+    def initTempering(self, betas):
+        """
+        Set up parallel tempering over the (increasing) inverse temperatures
+        betas, like MCMCGPU.initTempering.
+        """
+        self.require('MCMC')
+        self._initcomponent('Tempering')
+
+        nseq, ntemps = self.nseq['main'], len(betas)
+        if nseq % ntemps != 0:
+            raise ValueError("The number of temperatures must evenly divide "
+                             "the number of walkers per CPU")
+        self.ntemps = ntemps
+        self.nchains = nseq//ntemps
+        self.swapparity = 0
+
+        self._setupBuffer(  'temp betas', '<f4', (ntemps,))
+        self._setupBuffer('temp walkers', '<u4', (ntemps, self.nchains))
+        self._setupBuffer('swaps accepted', '<u4', (ntemps-1,))
+        self._setupBuffer(   'swaps tried', '<u4', (ntemps-1,))
+
+        betas = np.asarray(betas, dtype='<f4')
+        self.setBuf('temp betas', betas)
+        self.setBuf('temp walkers', np.arange(nseq, dtype='<u4').reshape(
+                                               (ntemps, self.nchains)))
+        self.setBuf('Bs', np.repeat(betas, self.nchains))
+        self.clearSwapCounts()
+
+        if 'Large' not in self.initted:
+            self.initLargeBufs(nseq)
+        elif self.nseq['large'] < self.nchains:
+            raise Exception("large buffer is too small for tempering")
+
+    def initAnnealing(self):
+        self.require('MCMC')
+        self._initcomponent('Annealing')
+
+    def initDesign(self):
+        """
+        Set up the 'best' buffers used for sequence design, like
+        MCMCGPU.initDesign.
+        """
+        self.require('MCMC')
+        self._initcomponent('Design')
+
+        nseq = self.nseq['main']
+        self.nseq['best'] = nseq
+        self._setupBuffer('seq best', '<u1', (nseq, self.L))
+        self._setupBuffer(  'E best', '<f4', (nseq,))
+        self.fillBuf('E best', np.inf)
+
+    def initOptimizer(self, optimizer):
+        """Set up the coupling update optimizer state, like
+        MCMCGPU.initOptimizer"""
+        self.require('Jstep')
+        self._initcomponent('Optimizer')
+
+        nPairs, q = self.nPairs, self.q
+        if optimizer in ['rmsprop', 'adam']:
+            for name in ['adam m', 'adam s']:
+                self._setupBuffer(name, '<f4', (nPairs, q*q))
+                self._setupBuffer(name + ' saved', '<f4', (nPairs, q*q))
+                self.fillBuf(name, 0)
+        elif optimizer == 'nesterov':
+            self._setupBuffer('momentum', '<f4', (nPairs, q*q))
+            self.fillBuf('momentum', 0)
+
+    def initAIS(self, dJ):
+        """
+        Set up annealed importance sampling along the couplings J + b*dJ, like
+        MCMCGPU.initAIS.
+        """
+        self.require('MCMC')
+        self._initcomponent('AIS')
+
+        nPairs, q = self.nPairs, self.q
+        self._setupBuffer(  'ais dJ', '<f4', (nPairs, q*q))
+        self._setupBuffer('ais logw', '<f4', (self.nseq['main'],))
+        self.setBuf('ais dJ', dJ)
+        self.fillBuf('ais logw', 0)
+
+    def initJstep(self):
+        self._initcomponent('Jstep')
+
+        nPairs, q = self.nPairs, self.q
+        self._setupBuffer(         'dJ', '<f4', (nPairs, q*q))
+        self._setupBuffer(  'bi target', '<f4', (nPairs, q*q))
+        self._setupBuffer(       'Creg', '<f4', (nPairs, q*q))
+        self._setupBuffer(   'Xlambdas', '<f4', (nPairs,))
+        self._setupBuffer(    'weights', '<f4', (self.nseq['main'],))
+        self._setupBuffer('weightstats', '<f4', (2,))
+        self._setupBuffer('weightstats log', '<f4', (jstep_log_max, 2))
+        self._setupBuffer(      'E tmp', '<f4', (self.nseq['main'],)),
+        self._setupBuffer(   'dJ saved', '<f4', (nPairs, q*q))
+        self._setupBuffer(   'bi saved', '<f4', (nPairs, q*q))
+
+    def doubleWalkers(self):
+        """Doubles the number of walkers, like MCMCGPU.doubleWalkers"""
+        self.require('MCMC')
+        for cmp in ['Large', 'Tempering', 'Design', 'AIS']:
+            if cmp in self.initted:
+                raise Exception("Cannot change the number of walkers after "
+                                "initializing {}".format(cmp))
+        self.log("doubleWalkers")
+
+        nseq = self.nseq['main']
+        old = {}
+        # the walker index is the first dimension of all these buffers
+        for name in ['seq main', 'E main', 'rngstates', 'Bs', 'naccept',
+                     'gapaccept', 'weights', 'E tmp', 'seq jump', 'E jump',
+                     'jumpaccept']:
+            if name not in self.bufs:
+                continue
+            buftype, bufshape = self.buf_spec[name]
+            old[name] = self.bufs[name].copy()
+            self._freeBuffer(name)
+            self._setupBuffer(name, buftype, (2*bufshape[0],) + bufshape[1:])
+
+        self.nseq['main'] = self.nwalkers = 2*nseq
+        if 'jump' in self.nseq:
+            self.nseq['jump'] = 2*nseq
+
+        for name in ['seq main', 'Bs']:
+            self.bufs[name][...] = np.concatenate([old[name], old[name]])
+        if 'rngstates' in old:
+            ws = self.walker_span
+            self.bufs['rngstates'][:nseq] = old['rngstates']
+            seqtools.initRNG2(self.bufs['rngstates'][nseq:],
+                              self.rng_offset + ws//2, ws)
+            self.walker_span = ws//2
+        self._bufchanged('seq main')
+
+    def _nseqs(self, seqbufname):
+        # number of valid sequences in a seq buffer
+        if 'seq ' + seqbufname not in self.largebufs:
+            return self.nseq[seqbufname]
+        return self.nstoredseqs
+
+    def _seqschanged(self, seqbufname):
+        self.paircodes.pop(seqbufname, None)
+        self.packedseqs.pop(seqbufname, None)
+
+    def _packedseqs(self, seqbufname):
+        # sequences in the (SWORDS, nseq) uint32 layout of the GPU buffers
+        if seqbufname not in self.packedseqs:
+            seqs = self.seqbufs[seqbufname]
+            self.packedseqs[seqbufname] = packseqs(seqs, self.SWORDS)
+        return self.packedseqs[seqbufname]
+
+    def _paircodes_chunks(self, seqbufname):
+        """
+        Yields (slice, codes) where codes[n, p] is the index into a flattened
+        (nPairs*q*q) coupling/bimarg array for the residues of sequence n at
+        pair p. The result is cached until the sequence buffer changes,
+        if small enough.
+        """
+        if seqbufname in self.paircodes:
+            yield slice(None), self.paircodes[seqbufname]
+            return
+
+        q, nPairs = self.q, self.nPairs
+        seqs = self.seqbufs[seqbufname][:self._nseqs(seqbufname)]
+        nseq = seqs.shape[0]
+        pairoffset = (q*q*np.arange(nPairs, dtype='u4'))
+        pi, pj = self.pairi, self.pairj
+
+        cache = nseq*nPairs <= paircode_cache_max
+        if cache:
+            allcodes = np.empty((nseq, nPairs), dtype='u4')
+
+        nchunk = max(1, paircode_chunk//nPairs)
+        for n in range(0, nseq, nchunk):
+            s = seqs[n:n+nchunk].astype('u4')
+            codes = pairoffset + q*s[:,pi] + s[:,pj]
+            if cache:
+                allcodes[n:n+nchunk] = codes
+            else:
+                yield slice(n, n+nchunk), codes
+
+        if cache:
+            self.paircodes[seqbufname] = allcodes
+            yield slice(None), allcodes
+
+    def _pairhist(self, seqbufname, weights=None):
+        # histogram of residue-pairs, flattened to nPairs*q*q
+        q, nPairs = self.q, self.nPairs
+        hist = np.zeros(nPairs*q*q, dtype='f8' if weights is not None else 'u8')
+        for sl, codes in self._paircodes_chunks(seqbufname):
+            if weights is None:
+                w = None
+            else:
+                w = np.repeat(weights[sl].astype('f8'), nPairs)
+            hist += np.bincount(codes.ravel(), weights=w,
+                                minlength=nPairs*q*q).astype(hist.dtype)
+        return hist.reshape((nPairs, q*q))
+
+    def prepare_indep(self, unimarg):
+        cprob = np.cumsum(unimarg, axis=1)
+        cprob = (cprob[:,:-1]/cprob[:,-1,None]).copy()
+        self.setBuf('cprob', cprob.astype('<f4'))
+
+        # the metropolis proposals also start from these marginals
+        if 'proposal' in self.bufs:
+            prop = unimarg/np.sum(unimarg, axis=1, keepdims=True)
+            prop = (1 - proposal_unif)*prop + proposal_unif/self.q
+            self.setBuf('proposal', prop.astype('<f4'))
+        if 'gapfill' in self.bufs:
+            self.setBuf('gapfill', self._gapfill(unimarg))
+
+    def _gapfill(self, unimarg=None):
+        # probabilities of the residues filled into gapped sites, as in
+        # mcmcGPU
+        nongap = np.ones(self.q)
+        nongap[self.gapres] = 0
+        unif = np.tile(nongap/(self.q - 1), (self.L, 1))
+        if unimarg is None:
+            return unif.astype('<f4')
+        p = unimarg*nongap
+        Z = np.sum(p, axis=1, keepdims=True)
+        p = np.where(Z > 0, p/np.where(Z > 0, Z, 1), unif)
+        return ((1 - proposal_unif)*p + proposal_unif*unif).astype('<f4')
+
+    def gen_indep(self, bufname):
+        self.log("gen_indep")
+        t = time.perf_counter_ns()
+
+        seqs = self.seqbufs[bufname]
+        r = self.walker_rng.rand(seqs.shape[0], self.L).astype('f4')
+        cprob = self.bufs['cprob']
+        # count how many cumulative probs we are above, like the binary search
+        # in the gen_indep kernel
+        for pos in range(self.L):
+            seqs[:,pos] = np.searchsorted(cprob[pos], r[:,pos], side='right')
+        self._seqschanged(bufname)
+        if bufname == 'main':
+            self.runningE = None
+        self.logevt('gen_indep', t)
+
+    def unpackJ(self):
+        """convert J from format where every row is a unique ij pair (L choose 2
+        rows) to format with every pair, all orders (L^2 rows), like the
+        'Junpacked' GPU buffer. In half precision mode the couplings are
+        rounded to float16, to give the same results as the GPU kernels
+        (arithmetic is still done in float32 either way)."""
+
+        # quit if J already loaded/unpacked
+        if self.unpackedJ is not None:
+            return self.unpackedJ
+
+        self.log("unpackJ")
+        t = time.perf_counter_ns()
+
+        L, q = self.L, self.q
+        J = self._samplerJ().reshape((self.nPairs, q, q))
+        Ju = np.zeros((L, L, q, q), dtype='<f4')
+        Ju[self.pairi, self.pairj] = J
+        Ju[self.pairj, self.pairi] = J.transpose((0, 2, 1))
+        self.unpackedJ = Ju.reshape((L*L, q*q))
+        self.logevt('unpackJ', t)
+        return self.unpackedJ
+
+    def _samplerJ(self):
+        # packed couplings at the precision used by the samplers
+        if self.precision == 'half':
+            return self.bufs['J'].astype('<f2').astype('<f4')
+        return self.bufs['J']
+
+    def runMCMC(self):
+        """Performs a single round of mcmc sampling (nsteps MC steps)"""
+        self.require('MCMC')
+        self.log("runMCMC")
+        t = time.perf_counter_ns()
+
+        sampler = self.sampler
+        if sampler in ['fields', 'auto']:
+            sampler = 'metropolis_fields' if self.usefields else 'metropolis'
+
+        # the samplers update 'E main', so it must be current on entry
+        if self.runningE is not None and self.runningE >= energy_resync:
+            self.runningE = None
+        self.calcEnergies('main')
+        self.runningE += 1
+
+        positions = self.updateRngPos()
+        if seqtools is not None:
+            seqmem = self._packedseqs('main')
+            sample = getattr(seqtools, sampler)
+            kwds = {}
+            if sampler != 'gibbs':
+                kwds = {'proposal': self.bufs.get('proposal'),
+                        'propcounts': self.bufs.get('proposal counts')}
+            sample(self.unpackJ(), self.bufs['rngstates'], positions,
+                   self.bufs['Bs'], seqmem, nthreads=self.nthreads,
+                   naccept=self.bufs['naccept'], energies=self.Ebufs['main'],
+                   markpos=self._clampmarks(), **kwds)
+            self.seqbufs['main'][...] = unpackseqs(seqmem, self.L)
+            self.paircodes.pop('main', None)
+        else:
+            sample = {'metropolis': self._runMCMC_numpy,
+                      'metropolis_fields': self._runFields_numpy,
+                      'gibbs': self._runGibbs_numpy}[sampler]
+            marks = self._clampmarks()
+            if marks is not None:
+                # all moves at the clamped positions are rejected
+                positions = positions[marks[positions] == 0]
+            sample(positions)
+            self._seqschanged('main')
+        self.logevt('mcmc', t)
+
+        if self.sampler == 'auto':
+            self._autoSampler()
+        if self.proposal == 'adaptive':
+            self._adaptProposal()
+        if self.gapmoves > 0:
+            t = time.perf_counter_ns()
+            self._gapMoves()
+            self._seqschanged('main')
+            self.logevt('gapMoves', t)
+        if 'Jumps' in self.initted:
+            self._jumpWalkers()
+
+    def _clampmarks(self):
+        # the clamped positions, see initClamp
+        if 'Clamp' not in self.initted:
+            return None
+        return self.bufs['markpos']
+
+    def _propose(self, pos, seqp):
+        # proposed residues and Hastings factors of the metropolis samplers,
+        # like proposeRes in mcmc.cl
+        nseq = self.nseq['main']
+        rng = self.walker_rng
+        if self.proposal == 'uniform':
+            return rng.randint(0, self.q, size=nseq).astype('i4'), 1
+        p = self.bufs['proposal'][pos]
+        r = rng.rand(nseq).astype('f4')
+        mutres = np.minimum(np.searchsorted(np.cumsum(p), r, side='right'),
+                            self.q-1).astype('i4')
+        return mutres, p[seqp]/p[mutres]
+
+    def _countProposals(self, pos, mutres, seqp, accept):
+        if self.proposal != 'adaptive':
+            return
+        counts = self.bufs['proposal counts']
+        tried = mutres != seqp
+        counts[0, pos] += np.bincount(mutres[tried], minlength=self.q
+                                      ).astype('u4')
+        counts[1, pos] += np.bincount(mutres[tried & accept],
+                                      minlength=self.q).astype('u4')
+
+    def _adaptProposal(self):
+        # tune the proposals from the acceptance counts, like the
+        # adaptProposal kernel in mcmc.cl
+        counts = self.bufs['proposal counts']
+        tried, accepted = counts.astype('f4')
+        p = self.bufs['proposal']*np.sqrt((accepted + 1)/(tried + 1))
+        p /= np.sum(p, axis=1, keepdims=True)
+        p[...] = (1 - proposal_unif)*p + proposal_unif/self.q
+        self.bufs['proposal'][...] = p
+        counts.fill(0)
+
+    def _gapMoves(self):
+        # gap-block moves, like the gapMoves kernel in mcmc.cl. Each walker
+        # makes its own choice of move, so the window sites differ by walker,
+        # and windows of fewer than gap_block_max+1 sites are masked.
+        L, q, g, K = self.L, self.q, self.gapres, gap_block_max
+        nseq = self.nseq['main']
+        Ju = self.unpackJ().ravel()
+        fill = self.bufs['gapfill']
+        seqs = self.seqbufs['main']
+        B = self.bufs['Bs']
+        rng = self.walker_rng
+        naccept = self.bufs['gapaccept']
+        naccept.fill(0)
+
+        walkers = np.arange(nseq)
+        j = np.arange(K+1)
+        cols = np.arange(L)*q*q
+        cfill = np.cumsum(fill, axis=1)
+        lastres = q-2 if g == q-1 else q-1
+        for i in range(self.gapmoves):
+            pos = rng.randint(0, L, size=nseq)
+            k = rng.randint(1, K+1, size=nseq)
+            d = np.where(rng.rand(nseq) < 0.5, 1, -1)
+            shift = rng.rand(nseq) < 0.5
+            n = k + shift
+
+            # the window is the n sites pos + j*d
+            end = pos + (n-1)*d
+            valid = (end >= 0) & (end < L)
+            inwin = j < n[:,None]
+            sites = np.clip(pos[:,None] + j*d[:,None], 0, L-1)
+            old = seqs[walkers[:,None], sites].astype('i4')
+            isgap = old == g
+            ngap = np.sum(isgap & inwin, axis=1)
+            firstgap = isgap[:,0]
+            lastgap = isgap[walkers, n-1]
+            valid &= np.where(shift, (ngap == k) & ~(firstgap & lastgap),
+                                     (ngap == 0) | (ngap == k))
+
+            # [gap x k, res] <-> [res', gap x k] for shifts, else toggle
+            newgap = np.where(shift[:,None],
+                              np.where(firstgap[:,None], j != 0,
+                                       j != (n-1)[:,None]),
+                              (ngap == 0)[:,None])
+            r = rng.rand(nseq, K+1).astype('f4')
+            drawn = np.minimum(np.sum(cfill[sites] <= r[...,None], axis=2),
+                               lastres)
+            new = np.where(newgap, g, drawn).astype('i4')
+            changed = inwin & valid[:,None] & (newgap != isgap)
+
+            hastings = (np.prod(np.where(changed & newgap, fill[sites, old], 1),
+                                axis=1) /
+                        np.prod(np.where(changed & ~newgap, fill[sites, new], 1),
+                                axis=1))
+
+            # make the moves site by site, accumulating the energy change
+            dE = np.zeros(nseq, dtype='f4')
+            for jj in range(K+1):
+                w = walkers[changed[:,jj]]
+                s = sites[w,jj]
+                rowJ = (s*L*q*q)[:,None] + cols + seqs[w]
+                dE[w] += np.sum(Ju.take(rowJ + q*new[w,jj,None]) -
+                                Ju.take(rowJ + q*old[w,jj,None]), axis=1)
+                seqs[w, s] = new[w,jj]
+
+            accept = valid & (np.exp(-B*dE)*hastings >
+                              rng.rand(nseq).astype('f4'))
+            naccept += accept
+            self.Ebufs['main'][accept] += dE[accept]
+            w, jj = np.nonzero(changed & ~accept[:,None])
+            seqs[w, sites[w, jj]] = old[w, jj]
+
+    def _jumpWalkers(self):
+        # independence-sampler jumps, like the jumpPropose and jumpAccept
+        # kernels in mcmc.cl
+        t = time.perf_counter_ns()
+        L, q = self.L, self.q
+        nseq = self.nseq['main']
+        rng = self.walker_rng
+        seqs, jump = self.seqbufs['main'], self.seqbufs['jump']
+
+        w = np.nonzero(rng.rand(nseq) < self.jumprate)[0]
+        cp = np.cumsum(self.bufs['jump p'], axis=1)
+        r = rng.rand(len(w), L)
+        new = np.minimum(np.sum(cp <= r[...,None], axis=2), q-1)
+        if 'jumpmsa' in self.seqbufs:
+            msa = self.seqbufs['jumpmsa']
+            base = msa[rng.randint(0, msa.shape[0], size=len(w))]
+            new = np.where(rng.rand(len(w), L) < jump_mut, new, base)
+        jump[...] = seqs
+        jump[w] = new
+        self._seqschanged('jump')
+        dlogg = self._logJumpProposal(seqs[w]) - self._logJumpProposal(new)
+
+        self.calcEnergies('main')
+        self.calcEnergies('jump')
+        dE = self.Ebufs['jump'][w] - self.Ebufs['main'][w]
+        accept = (np.exp(-self.bufs['Bs'][w]*dE + dlogg) >
+                  rng.rand(len(w)).astype('f4'))
+        w = w[accept]
+        seqs[w] = jump[w]
+        self.Ebufs['main'][w] = self.Ebufs['jump'][w]
+        self._seqschanged('main')
+        self.bufs['jumpaccept'].fill(0)
+        self.bufs['jumpaccept'][w] = 1
+        self.logevt('jumpWalkers', t)
+
+    def _logJumpProposal(self, seqs):
+        # log probability of seqs under the jump proposals, up to a constant
+        p = self.bufs['jump p'][np.arange(self.L), seqs].astype('f8')
+        if 'jumpmsa' not in self.seqbufs:
+            return np.sum(np.log(p), axis=1)
+
+        # sum over the msa of the probability of redrawing each sequence
+        msa = self.seqbufs['jumpmsa']
+        p = jump_mut*p
+        bonus = np.log((1 - jump_mut + p)/p)
+        logg = np.sum(np.log(p), axis=1)
+        chunk = max(1, (1 << 24)//msa.size)
+        for i in range(0, len(seqs), chunk):
+            sl = slice(i, i + chunk)
+            match = seqs[sl,None,:] == msa[None,:,:]
+            logg[sl] += logsumexp(np.sum(match*bonus[sl,None,:], axis=2),
+                                  axis=1)
+        return logg
+
+    def updateBest(self):
+        """Store each walker's sequence if it is the lowest-energy one it
+        has reached so far, like the updateBest kernel in mcmc.cl"""
+        self.require('Design')
+        self.log("updateBest")
+
+        self.calcEnergies('main')
+        E = self.Ebufs['main']
+        better = E < self.Ebufs['best']
+        self.Ebufs['best'][better] = E[better]
+        self.seqbufs['best'][better] = self.seqbufs['main'][better]
+        self._seqschanged('best')
+
+    def greedyDescent(self, nsweeps):
+        """Greedily lower the walker energies by nsweeps sweeps of single
+        mutations, like the greedyDescent kernel in mcmc.cl"""
+        self.require('MCMC')
+        self.log("greedyDescent")
+        t = time.perf_counter_ns()
+
+        L, q = self.L, self.q
+        self.calcEnergies('main')
+        Ju = self.unpackJ()
+        seqs = self.seqbufs['main']
+        E = self.Ebufs['main']
+        naccept = self.bufs['naccept']
+        naccept.fill(0)
+        walkers = np.arange(self.nseq['main'])
+
+        cols = np.arange(L, dtype='i4')*q*q + seqs
+        for i in range(nsweeps):
+            for pos in range(L):
+                Jrow = Ju[pos*L:(pos+1)*L].ravel()
+                condE = np.stack([np.sum(Jrow.take(q*a + cols), axis=1)
+                                  for a in range(q)], axis=1)
+
+                # keep the current residue unless another is strictly better
+                best = np.argmin(condE, axis=1)
+                dE = condE[walkers, best] - condE[walkers, seqs[:, pos]]
+                w = np.flatnonzero(dE < 0)
+                naccept[w] += 1
+                E[w] += dE[w]
+                seqs[w, pos] = best[w]
+                cols[w, pos] = pos*q*q + best[w]
+
+        self._seqschanged('main')
+        self.logevt('greedyDescent', t)
+
+    def _autoSampler(self):
+        # choose the sampler for the next call from the acceptance rate
+        rate = np.sum(self.bufs['naccept'], dtype=np.float64)
+        rate = rate/(self.nseq['main']*self.nsteps)
+        if not self.usefields and rate < fields_accept_max/self.q:
+            self.log("Acceptance rate {:.4f}, switching to "
+                     "metropolis_fields".format(rate))
+            self.usefields = True
+        elif self.usefields and rate > 2*fields_accept_max/self.q:
+            self.log("Acceptance rate {:.4f}, switching to "
+                     "metropolis".format(rate))
+            self.usefields = False
+
+    def initPosRNG(self):
+        # all devices use the same position rng streams, seeded and drawn in
+        # blocks of L positions as in MCMCGPU.initPosRNG, so with seqtools
+        # runs give the same positions as on the GPU. The position buffer is
+        # the same on all devices, so is not a shared buffer.
+        L = self.L
+        nblocks, offset, block_span = posrng_streams(
+                                    L, rng_buf_mul*self.nsteps, self.seed)
+        self.randpos = np.zeros(nblocks*L, dtype='u4')
+        self.randpos_offset = rng_buf_mul*self.nsteps
+
+        if seqtools is not None:
+            self.posrng = np.zeros(nblocks, dtype='<2u8')
+            seqtools.initRNG2(self.posrng, offset, block_span)
+
+    def _genPositions_numpy(self):
+        L, nblocks = self.L, len(self.randpos)//self.L
+        pos = self.randpos.reshape((nblocks, L))
+        if self.schedule == 'random':
+            pos[...] = self.rngstate.randint(0, L, size=(nblocks, L))
+        elif self.schedule == 'sweep':
+            pos[...] = np.arange(L)
+        else:
+            pos[...] = np.argsort(self.rngstate.rand(nblocks, L), axis=1)
+
+    def updateRngPos(self):
+        bufsize = rng_buf_mul*self.nsteps
+        if self.randpos_offset + self.nsteps > bufsize:
+            if seqtools is not None:
+                seqtools.genPositions(self.posrng, self.randpos, self.L,
+                                      schedules[self.schedule])
+            else:
+                self._genPositions_numpy()
+            self.randpos_offset = 0
+        positions = self.randpos[self.randpos_offset:
+                                 self.randpos_offset + self.nsteps]
+        self.randpos_offset += self.nsteps
+        return positions
+
+    def _runMCMC_numpy(self, positions):
+        L, q = self.L, self.q
+        nseq = self.nseq['main']
+        Ju = self.unpackJ()
+        seqs = self.seqbufs['main']
+        B = self.bufs['Bs']
+        rng = self.walker_rng
+
+        # flat index of each walker's residue in a row of Ju. Note the
+        # diagonal couplings are 0, so the pos==m terms drop out.
+        E = self.Ebufs['main']
+        naccept = self.bufs['naccept']
+        naccept.fill(0)
+
+        cols = np.arange(L, dtype='i4')*q*q + seqs
+        for pos in positions:
+            Jrow = Ju[pos*L:(pos+1)*L].ravel()
+            seqp = seqs[:,pos].astype('i4')
+            mutres, hastings = self._propose(pos, seqp)
+
+            dE = np.sum(Jrow.take(q*mutres[:,None] + cols) -
+                        Jrow.take(q*seqp[:,None] + cols), axis=1)
+
+            #apply MC criterion and possibly update
+            accept = np.exp(-B*dE)*hastings > rng.rand(nseq).astype('f4')
+            self._countProposals(pos, mutres, seqp, accept)
+            naccept += accept & (mutres != seqp)
+            E[accept] += dE[accept]
+            seqs[accept, pos] = mutres[accept]
+            cols[accept, pos] = pos*q*q + mutres[accept]
+
+    def _runFields_numpy(self, positions):
+        L, q = self.L, self.q
+        nseq = self.nseq['main']
+        J4 = self.unpackJ().reshape((L, L, q, q))
+        seqs = self.seqbufs['main']
+        B = self.bufs['Bs']
+        rng = self.walker_rng
+        E = self.Ebufs['main']
+        naccept = self.bufs['naccept']
+        naccept.fill(0)
+        walkers = np.arange(nseq)
+
+        # local fields of each residue at each position, as in the
+        # metropolis_fields kernel. The diagonal couplings are 0.
+        fields = np.zeros((nseq, L, q), dtype='f4')
+        for k in range(L):
+            fields += J4[:, k, :, seqs[:,k]]
+
+        for pos in positions:
+            seqp = seqs[:,pos].astype('i4')
+            mutres, hastings = self._propose(pos, seqp)
+
+            dE = fields[walkers, pos, mutres] - fields[walkers, pos, seqp]
+
+            #apply MC criterion and possibly update
+            accept = np.exp(-B*dE)*hastings > rng.rand(nseq).astype('f4')
+            self._countProposals(pos, mutres, seqp, accept)
+            acc = np.flatnonzero(accept & (mutres != seqp))
+            Jpos = J4[:, pos]
+            fields[acc] += (Jpos[:, :, mutres[acc]] -
+                            Jpos[:, :, seqp[acc]]).transpose((2, 0, 1))
+            seqs[acc, pos] = mutres[acc]
+            naccept[acc] += 1
+            E[acc] += dE[acc]
+
+    def _runGibbs_numpy(self, positions):
+        L, q = self.L, self.q
+        nseq = self.nseq['main']
+        Ju = self.unpackJ()
+        seqs = self.seqbufs['main']
+        B = self.bufs['Bs']
+        rng = self.walker_rng
+        E = self.Ebufs['main']
+        naccept = self.bufs['naccept']
+        naccept.fill(0)
+        walkers = np.arange(nseq)
+
+        cols = np.arange(L, dtype='i4')*q*q + seqs
+        for pos in positions:
+            Jrow = Ju[pos*L:(pos+1)*L].ravel()
+
+            # energy of each residue at pos given the rest of the sequence
+            condE = np.stack([np.sum(Jrow.take(q*a + cols), axis=1)
+                              for a in range(q)], axis=1)
+            condE -= np.min(condE, axis=1, keepdims=True)
+            cumprob = np.cumsum(np.exp(-B[:,None]*condE), axis=1)
+
+            r = rng.rand(nseq).astype('f4')*cumprob[:,-1]
+            mutres = np.minimum(np.sum(cumprob <= r[:,None], axis=1), q-1)
+            naccept += mutres != seqs[:, pos]
+            E += condE[walkers, mutres] - condE[walkers, seqs[:, pos]]
+            seqs[:, pos] = mutres
+            cols[:, pos] = pos*q*q + mutres
+
+    def calcBicounts(self, seqbufname):
+        self.log("calcBicounts " + seqbufname)
+        t = time.perf_counter_ns()
+
+        self.bufs['bicount'][...] = self._pairhist(seqbufname)
+        self.logevt('calcBicounts', t)
+
+    def bicounts_to_bimarg(self, seqbufname='main'):
+        self.log("bicounts_to_bimarg ")
+
+        nseq = self._nseqs(seqbufname)
+        self.bufs['bi'][...] = self.bufs['bicount']/np.float32(nseq)
+
+    def calcEnergies(self, seqbufname, Jbufname='J'):
+        # the running energies of the walkers need no work, see runMCMC
+        if seqbufname == 'main':
+            if Jbufname == 'J' and self.runningE is not None:
+                return
+            self.runningE = 0 if Jbufname == 'J' else None
+
+        self.log("calcEnergies " + seqbufname)
+        t = time.perf_counter_ns()
+
+        energies = self.Ebufs[seqbufname]
+        # like getEnergies_half, energies of J use the sampler's couplings
+        J = self._samplerJ() if Jbufname == 'J' else self.bufs[Jbufname]
+        if seqtools is not None:
+            seqtools.getEnergies(J,
+                                 self._packedseqs(seqbufname),
+                                 energies[:self._nseqs(seqbufname)],
+                                 nthreads=self.nthreads)
+            self.logevt('getEnergies', t)
+            return
+
+        J = J.ravel()
+        for sl, codes in self._paircodes_chunks(seqbufname):
+            if sl == slice(None):
+                sl = slice(0, codes.shape[0])
+            energies[sl] = np.sum(J.take(codes), axis=1, dtype='f8')
+        self.logevt('getEnergies', t)
+
+    def min_buf(self, buf):
+        self.require('Jstep')
+        self.log("min_buf")
+
+        # like the minFloats kernel, result is never more than 0
+        self.bufs['minout'][0] = min(0, np.min(self.bufs[buf]))
+
+    def _weightbufs(self, buf):
+        if buf == 'main':
+            return self.bufs['E main'], self.bufs['weights']
+        n = self.nstoredseqs
+        return self.bufs['E large'][:n], self.bufs['weights large'][:n]
+
+    def weight_statistics(self, buf='main'):
+        self.require('Jstep')
+        self.log("weight_statistics")
+
+        w = self._weightbufs(buf)[1]
+        self.bufs['weightstats'][:] = (np.sum(w, dtype='f8'),
+                                       np.sum(w.astype('f8')**2))
+
+    def logWeightStats(self, n):
+        self.require('Jstep')
+        self.log("logWeightStats")
+        self.bufs['weightstats log'][n] = self.bufs['weightstats']
+
+    def saveJstep(self):
+        """Save 'dJ', 'bi' and the Adam state, like MCMCGPU.saveJstep"""
+        self.require('Jstep')
+        self.log("saveJstep")
+        for name in ['dJ', 'bi', 'adam m', 'adam s']:
+            if name in self.bufs:
+                self.bufs[name + ' saved'][...] = self.bufs[name]
+
+    def restoreJstep(self):
+        """Restore the buffers saved by saveJstep"""
+        self.require('Jstep')
+        self.log("restoreJstep")
+        for name in ['dJ', 'bi', 'adam m', 'adam s']:
+            if name in self.bufs:
+                self.bufs[name][...] = self.bufs[name + ' saved']
+
+    def dE_to_weights(self, buf='main', offset=0.):
+        self.require('Jstep')
+        self.log("dE_to_weights")
+
+        dE, weights = self._weightbufs(buf)
+        np.exp(-dE + np.float32(offset), out=weights)
+
+    def fixed_beta_weights(self, ref_E, seqbufname='main'):
+        self.require('Jstep')
+        self.log("FixedBetaWeights")
+
+        energies, weights = self._weightbufs(seqbufname)
+        np.exp((self.beta - 1)*(energies - np.float32(ref_E)), out=weights)
+
+    def weightedMarg(self, seqbufname='main'):
+        self.require('Jstep')
+        self.log("weightedMarg")
+        t = time.perf_counter_ns()
+
+        weights = self._weightbufs(seqbufname)[1]
+        self.bufs['bi'][...] = self._pairhist(seqbufname, weights)
+        self.logevt('weightedMarg', t)
+
+    def renormalize_bimarg(self):
+        self.log("renormalize_bimarg")
+        bi = self.bufs['bi']
+        bi /= np.sum(bi, axis=1, keepdims=True)
+
+    def addFloatBuf(self, dstname, srcname):
+        self.log("addbuf")
+
+        dst = self.bufs[dstname]
+        src = self.bufs[srcname]
+        if dst.size != src.size:
+            raise Exception('Tried to add bufs of different sizes')
+        dst += src
+        if dstname == 'E main':
+            self.runningE = None
+
+    def aisStep(self, dB):
+        """Annealed importance sampling step from b to b+dB, like
+        MCMCGPU.aisStep"""
+        self.require('AIS')
+        self.log("aisStep")
+
+        self.calcEnergies('main', 'ais dJ')
+        self.bufs['ais logw'] += np.float32(-dB)*self.Ebufs['main']
+        self.bufs['J'] += np.float32(dB)*self.bufs['ais dJ']
+        self._bufchanged('J')
+
+    def addBiBuffer(self, bufname, otherbuf):
+        # used for combining results from different devices, where otherbuf
+        # is a buffer "belonging" to another device
+        self.log("addbibuf")
+
+        selfbuf = self.bufs[bufname]
+        if selfbuf.size != otherbuf.size:
+            raise Exception('Tried to add bufs of different sizes')
+        selfbuf += otherbuf
+
+    def updateJ(self, gamma, pc, Jbuf='dJ'):
+        self.require('Jstep')
+        self.log("updateJ")
+
+        bi, target = self.bufs['bi'], self.bufs['bi target']
+        J = self.bufs[Jbuf]
+        J -= np.float32(gamma)*(target - bi)/(bi + np.float32(pc))
+        if Jbuf == 'J':
+            self.unpackedJ = None
+            self.runningE = None
+
+    def updateJ_adam(self, gamma, pc, b1, b2, t):
+        """Adam update of 'dJ', like MCMCGPU.updateJ_adam"""
+        self.require('Jstep', 'Optimizer')
+        self.log("updateJ_adam")
+
+        bi, target = self.bufs['bi'], self.bufs['bi target']
+        m, s = self.bufs['adam m'], self.bufs['adam s']
+        b1, b2 = np.float32(b1), np.float32(b2)
+        r = (target - bi)/(bi + np.float32(pc))
+        m[...] = b1*m + (1 - b1)*r
+        s[...] = b2*s + (1 - b2)*r*r
+        c1, c2 = np.float32(1 - b1**t), np.float32(1 - b2**t)
+        self.bufs['dJ'] -= (np.float32(gamma)*(m/c1) /
+                            (np.sqrt(s/c2) + np.float32(1e-8)))
+
+    def momentumStep(self, mu):
+        """Nesterov momentum step, like MCMCGPU.momentumStep"""
+        self.require('Jstep', 'Optimizer')
+        self.log("momentumStep")
+
+        v, dJ = self.bufs['momentum'], self.bufs['dJ']
+        v[...] = np.float32(mu)*v + dJ
+        dJ += np.float32(mu)*v
+
+    # The regularization functions below are vectorized versions of the
+    # corresponding kernels in mcmc.cl, operating on (nPairs, q, q) arrays.
+
+    def _regbufs(self):
+        q, nPairs = self.q, self.nPairs
+        shape = (nPairs, q, q)
+        return (self.bufs['bi'].reshape(shape), self.bufs['J'].reshape(shape),
+                self.bufs['dJ'].reshape(shape))
+
+    def reg_l1z(self, gamma, pc, lJ):
+        self.require('Jstep')
+        self.log("reg_l1z")
+
+        bi, J, dJ = self._regbufs()
+        J0 = zeroGauge(J + dJ)
+        R = -lJ*np.sign(J0)*gamma/(bi + pc)
+        # to reduce numerical fluctuations, if the regularization step
+        # would change the sign of J0, instead set J0 to 0.
+        dJ[...] = np.where(np.sign(J0) != np.sign(J0 + R), dJ - J0, dJ + R)
+
+    def reg_l2z(self, gamma, pc, lJ):
+        self.require('Jstep')
+        self.log("reg_l2z")
+
+        bi, J, dJ = self._regbufs()
+        J0 = zeroGauge(J + dJ)
+        R = -lJ*J0*gamma/(bi + pc)
+        dJ[...] = np.where(np.sign(J0) != np.sign(J0 + R), dJ - J0, dJ + R)
+
+    def reg_SCADJ(self, gamma, pc, lJ, a):
+        self.require('Jstep')
+        self.log("reg_SCADJ")
+
+        bi, J, dJ = self._regbufs()
+        J0 = zeroGauge(J + dJ)
+        absJ0 = np.abs(J0)
+        R = np.where(absJ0 < lJ, np.minimum(lJ, absJ0/gamma),
+                     np.where(absJ0 < a*lJ, (a*lJ - absJ0)/(a-1), 0))
+        dJ -= (R*gamma*np.sign(J0)/(bi + pc)).astype('f4')
+
+    def reg_Xij(self, gamma, pc):
+        self.require('Jstep')
+        self.log("reg Xij")
+
+        lX = self.bufs['Xlambdas'][:,None,None]
+        self._reg_X(gamma, pc, lX)
+
+    def reg_X(self, gamma, pc, lX):
+        self.require('Jstep')
+        self.log("reg X")
+        self._reg_X(gamma, pc, lX)
+
+    def _reg_X(self, gamma, pc, lX):
+        bi, J, dJ = self._regbufs()
+        C = bi - indepmarg(bi)
+        X = np.sum((J + dJ)*C, axis=(1,2), keepdims=True)
+        Xnorm = np.sum(C*C/(bi + pc), axis=(1,2), keepdims=True)
+        lX = np.minimum(lX, np.abs(X)/(Xnorm*gamma))
+        dJ -= (gamma*lX*C*np.sign(X)/(bi + pc)).astype('f4')
+
+    def reg_SCADX(self, gamma, pc, s, r, a):
+        self.require('Jstep')
+        self.log("reg_SCADX")
+
+        bi, J, dJ = self._regbufs()
+        Jt = J + dJ
+        C = bi - indepmarg(bi)
+        X = np.sum(Jt*C, axis=(1,2), keepdims=True)
+        Xnorm = np.sum(C*C/(bi + pc), axis=(1,2), keepdims=True)
+        absX = np.abs(X)
+
+        # see comment for reg_SCADX in mcmc.cl
+        rc = np.minimum(r, absX/(Xnorm*gamma*s))
+        R = np.where(absX < r, rc*np.sign(X),
+                     np.where(absX < a*r, (a*r*np.sign(X) - X)/(a-1), 0))
+        R = R*gamma*s*(C + bi*(X - getXijab(Jt, bi)))/(bi + pc)
+        dJ -= R.astype('f4')
+
+    def reg_expX(self, gamma, pc, lam):
+        self.require('Jstep')
+        self.log("reg_expX")
+
+        bi, J, dJ = self._regbufs()
+        Jt = J + dJ
+        C = bi - indepmarg(bi)
+        X = np.sum(Jt*C, axis=(1,2), keepdims=True)
+        R = np.sign(X)*np.exp(-np.abs(X)/lam)*(C + bi*(X - getXijab(Jt, bi)))
+        dJ -= (gamma*R/(bi + pc)).astype('f4')
+
+    def _ddE_signs(self, Jt, scad_r=None):
+        # sum over all the double-mutant ddE involving each coupling, as in
+        # the reg_ddE and reg_SCADddE kernels
+        q = self.q
+        b, a = np.meshgrid(np.arange(q), np.arange(q))
+        dR = np.zeros(Jt.shape, dtype='f4')
+        for g in range(1, q):
+            jr = Jt[:,a,b] - Jt[:,(a+g)%q,b]
+            for d in range(1, q):
+                jc = -Jt[:,a,(b+d)%q] + Jt[:,(a+g)%q,(b+d)%q]
+                ddE = jr + jc
+                if scad_r is None:
+                    dR += np.sign(ddE)
+                else:
+                    scale, absD = 4, np.abs(ddE)
+                    R = np.where(absD < scad_r, 1,
+                                 np.where(absD < scale*scad_r,
+                                     (scale*scad_r - absD)/(scale*scad_r - scad_r),
+                                     0))
+                    dR += np.sign(ddE)*R
+        return dR/((q-1)*(q-1))
+
+    def reg_ddE(self, gamma, pc, lam):
+        self.require('Jstep')
+        self.log("reg ddE")
+
+        bi, J, dJ = self._regbufs()
+        dR = self._ddE_signs(J + dJ)
+        dJ -= (lam*dR*gamma/(bi + pc)).astype('f4')
+
+    def reg_SCADddE(self, gamma, pc, lam, r):
+        self.require('Jstep')
+        self.log("reg SCADddE")
+
+        bi, J, dJ = self._regbufs()
+        dR = lam*self._ddE_signs(J + dJ, scad_r=r)
+        dJ -= (gamma*dR/(bi + pc)).astype('f4')
+
+    def getBuf(self, bufname, truncateLarge=True):
+        """get buffer data. truncateLarge means only return the
+        computed part of the large buffer (rest may be uninitialized)"""
+
+        self.log("getBuf " + bufname)
+        t = time.perf_counter_ns()
+        mem = self.bufs[bufname].copy()
+        self.logevt('getBuf', t, mem.nbytes)
+
+        if bufname in self.largebufs and truncateLarge:
+            nret = self.nstoredseqs
+            return FutureBuf(mem, lambda b: b[:nret])
+
+        return FutureBuf(mem)
+
+    def setBuf(self, bufname, buf):
+        self.log("setBuf " + bufname)
+        t = time.perf_counter_ns()
+
+        bufspec = self.buf_spec[bufname]
+        buftype, bufshape = bufspec[0], bufspec[1]
+        if not isinstance(buf, np.ndarray):
+            buf = np.array(buf, dtype=buftype)
+
+        if np.dtype(buftype) != buf.dtype:
+            raise ValueError("Buffer dtype mismatch.Expected {}, got {}".format(
+                             np.dtype(buftype), buf.dtype))
+        if bufshape != buf.shape and not (bufshape == (1,) or buf.size == 1):
+            raise ValueError("Buffer size mismatch. Expected {}, got {}".format(
+                            bufshape, buf.shape))
+
+        self.bufs[bufname][...] = buf
+        self.logevt('setBuf', t, buf.nbytes)
+        self._bufchanged(bufname)
+
+    def _bufchanged(self, bufname):
+        # invalidate anything derived from a buffer after it is overwritten
+
+        #unset packedJ flag if we modified that J buf
+        if bufname.split()[0] == 'J':
+            self.unpackedJ = None
+            self.runningE = None
+        if bufname in ['seq main', 'E main']:
+            self.runningE = None
+        if bufname == 'seq large':
+            self.nstoredseqs = self.nseq['large']
+        if bufname.split()[0] == 'seq':
+            self._seqschanged(bufname.split()[1])
+
+    def fillBuf(self, bufname, val):
+        self.log("fillBuf " + bufname)
+        self.bufs[bufname][...] = val
+        self._bufchanged(bufname)
+
+    def markPos(self, marks):
+        if 'Clamp' not in self.initted:
+            self.require('Subseq')
+        return self.setBuf('markpos', marks.astype('<u1')[:self.L])
+
+    def fillSeqs(self, startseq, seqbufname='main'):
+        self.log("fillSeqs " + seqbufname)
+        self.seqbufs[seqbufname][...] = startseq
+        self._seqschanged(seqbufname)
+        if seqbufname == 'main':
+            self.runningE = None
+
+    def storeSeqs(self, seqs=None):
+        """
+        If seqs is None, stores main to large seq buffer. Otherwise
+        stores seqs to large buffer
+        """
+
+        self.require('Large')
+
+        offset = self.nstoredseqs
+        self.log("storeSeqs " + str(offset))
+
+        if seqs is not None:
+            nseq, L = seqs.shape
+            if L != self.L:
+                raise Exception(
+                    "Sequences have wrong length: {} vs {}".format(L, self.L))
+            assert(seqs.dtype == np.dtype('u1'))
+        else:
+            seqs = self.seqbufs['main']
+            nseq = self.nseq['main']
+
+        if offset + nseq > self.nseq['large']:
+            raise Exception("cannot store seqs past end of large buffer")
+        self.seqbufs['large'][offset:offset+nseq] = seqs
+
+        self.nstoredseqs += nseq
+        self._seqschanged('large')
+
+    def clearLargeSeqs(self):
+        self.require('Large')
+        self.nstoredseqs = 0
+        self._seqschanged('large')
+
+    def setNStored(self, nstores):
+        self.require('Large')
+        self.nstoredseqs = nstores*self.nseq['main']
+        self._seqschanged('large')
+
+    def restoreSeqs(self):
+        """copies the last stored block of sequences back to main"""
+        self.require('Large')
+        nseq = self.nseq['main']
+        offset = self.nstoredseqs - nseq
+        self.log("restoreSeqs " + str(offset))
+
+        if offset < 0:
+            raise Exception("not enough seqs stored in large buffer")
+
+        self.seqbufs['main'][...] = self.seqbufs['large'][offset:offset+nseq]
+        self._seqschanged('main')
+        self.runningE = None
+
+    def swapTemps(self, nswaps):
+        """
+        Performs nswaps rounds of replica exchange between neighboring
+        temperatures, like the swapTemps kernel. Updates 'E main' first.
+        """
+        self.require('Tempering')
+        self.calcEnergies('main')
+        self.log("swapTemps")
+        t = time.perf_counter_ns()
+
+        walkers = self.bufs['temp walkers']
+        tempB = self.bufs['temp betas']
+        E = self.Ebufs['main'][walkers]
+        for n in range(nswaps):
+            k = np.arange((n + self.swapparity)%2, self.ntemps-1, 2)
+            delta = (tempB[k] - tempB[k+1])[:,None]*(E[k] - E[k+1])
+            with np.errstate(divide='ignore'):
+                r = np.log(self.walker_rng.rand(*delta.shape))
+            acc = r < delta
+
+            ki, c = np.nonzero(acc)
+            ki = k[ki]
+            walkers[ki,c], walkers[ki+1,c] = walkers[ki+1,c], walkers[ki,c]
+            E[ki,c], E[ki+1,c] = E[ki+1,c], E[ki,c]
+            self.bufs['swaps accepted'][k] += np.sum(acc, axis=1,
+                                                     dtype='u4')
+            self.bufs['swaps tried'][k] += np.uint32(self.nchains)
+
+        self.swapparity = (self.swapparity + nswaps)%2
+        self.bufs['Bs'][walkers] = tempB[:,None]
+        self.logevt('swapTemps', t)
+
+    def resampleWalkers(self, dB):
+        """
+        Population annealing step for an increase dB of the inverse
+        temperature, like MCMCGPU.resampleWalkers.
+        """
+        self.require('Annealing')
+        self.calcEnergies('main')
+        self.log("resampleWalkers")
+        t = time.perf_counter_ns()
+
+        nseq = self.nseq['main']
+        E = self.Ebufs['main'].astype('f8')
+        cumw = np.cumsum(np.exp(-dB*(E - np.min(E))))
+        grid = (np.arange(nseq) + self.walker_rng.rand())*cumw[-1]/nseq
+        parents = np.minimum(np.searchsorted(cumw, grid, side='right'),
+                             nseq - 1)
+
+        seqs = self.seqbufs['main']
+        seqs[...] = seqs[parents]
+        self.Ebufs['main'][...] = self.Ebufs['main'][parents]
+        self._seqschanged('main')
+        self.logevt('resampleWalkers', t)
+
+    def clearSwapCounts(self):
+        self.require('Tempering')
+        self.bufs['swaps accepted'].fill(0)
+        self.bufs['swaps tried'].fill(0)
+
+    def storeTempSeqs(self, tempind=-1):
+        """
+        Replaces the contents of the large buffer by the walkers at the
+        temperature with index tempind, by default the lowest temperature.
+        """
+        self.require('Tempering', 'Large')
+        self.log("storeTempSeqs " + str(tempind))
+
+        walkers = self.bufs['temp walkers'][tempind]
+        self.seqbufs['large'][:self.nchains] = self.seqbufs['main'][walkers]
+        self.nstoredseqs = self.nchains
+        self._seqschanged('large')
+
+    def copySubseq(self, seqind):
+        self.require('Subseq')
+        self.log("copySubseq " + str(seqind))
+        if seqind >= self.nseq['main']:
+            raise Exception("given index is past end of main seq buffer")
+
+        fixedpos = self.bufs['markpos'].astype(bool)
+        self.seqbufs['large'][:,fixedpos] = self.seqbufs['main'][seqind,
+                                                                 fixedpos]
+        self._seqschanged('large')
+
+    def clampSeqs(self):
+        """Set the clamped positions of the walkers, see initClamp"""
+        self.require('Clamp')
+        self.log("clampSeqs")
+        fixedpos = self.bufs['markpos'].astype(bool)
+        self.seqbufs['main'][:,fixedpos] = self.seqbufs['clamp'][0, fixedpos]
+        self._seqschanged('main')
+        self.runningE = None
+
+    def wait(self):
+        self.log("wait")
+
+################################################################################
+
+def packseqs(seqs, swords):
+    """pack (nseq, L) uint8 sequences into the (SWORDS, nseq) uint32 layout
+    of the GPU sequence buffers"""
+    nseq, L = seqs.shape
+    mem = np.zeros((nseq, swords*4), dtype='<u1')
+    mem[:,:L] = seqs
+    return np.ascontiguousarray(mem.view('<u4').T)
+
+def unpackseqs(mem, L):
+    """inverse of packseqs"""
+    return np.ascontiguousarray(mem.T).view('<u1')[:,:L]
+
+def zeroGauge(J):
+    """transform (nPairs, q, q) couplings to the zero-mean gauge"""
+    rowmean = np.mean(J, axis=2, keepdims=True)
+    colmean = np.mean(J, axis=1, keepdims=True)
+    mean = np.mean(J, axis=(1,2), keepdims=True)
+    return J - rowmean - colmean + mean
+
+def indepmarg(f):
+    """fi*fj product of univariate marginals of (nPairs, q, q) bimarg"""
+    fi, fj = np.sum(f, axis=2), np.sum(f, axis=1)
+    return fi[:,:,None]*fj[:,None,:]
+
+def getXijab(J, f):
+    """
+    Computes, for (nPairs, q, q) arrays J and f,
+        Xijab[c,d] = sum_ab J[a,b] (fi[a] - (a==c)) (fj[b] - (b==d))
+    which is the same as the getXijab function in mcmc.cl.
+    """
+    fi, fj = np.sum(f, axis=2), np.sum(f, axis=1)
+    Jfj = np.einsum('nab,nb->na', J, fj)
+    fiJ = np.einsum('na,nab->nb', fi, J)
+    fiJfj = np.einsum('na,na->n', fi, Jfj)
+    return fiJfj[:,None,None] - Jfj[:,:,None] - fiJ[:,None,:] + J
+
+def cpu_name():
+    return 'CPU {}'.format(platform.processor() or platform.machine())
+
+def initCPU(devnum, nwalkers, param, log):
+    outdir = param.outdir
+    L, q = param.L, param.q
+    seed = param.rngseed
+
+    device = CPUDevice('{} (numpy)'.format(cpu_name()))
+    return MCMCCPU((device, devnum), L, q, nwalkers, outdir, seed,
+                   beta=param.beta, profile=param.profile,
+                   sampler=param.sampler or 'metropolis',
+                   schedule=param.schedule or 'random',
+                   precision=param.precision or 'single',
+                   proposal=param.proposal or 'uniform',
+                   gapmoves=param.gapmoves or 0, gapres=param.gapres)
@@ -20,16 +20,69 @@ import os, time, warnings, textwrap, collections
 from pathlib import Path
 import time
 import numpy as np
-from numpy.random import RandomState
 import pyopencl as cl
 import pyopencl.array as cl_array
 
-from mi3gpu.utils.potts_common import printsome
+from mi3gpu.utils.potts_common import posrng_streams
 
 cf = cl.mem_flags
 
 rng_buf_mul = 1024
 
+# Mutation positions are generated on the GPU, from the streams given by
+# posrng_streams, see initPosRNG. These are the supported position schedules.
+schedules = {'random': 0, 'sweep': 1, 'permutation': 2}
+
+# The 'auto' sampler uses the metropolis_fields kernel when the fraction of
+# proposals which change the sequence is below fields_accept_max/q (and the
+# field table fits in device memory), and switches back above twice that.
+# An accepted move costs about q times as much memory traffic as a
+# metropolis proposal, so the two break even at an acceptance rate near 1/q.
+fields_accept_max = 0.5
+# fraction of device memory the field table may use, with the other buffers
+fields_mem_frac = 0.8
+
+# With jlayout 'auto', the samplers are timed for the first jlayout_trials
+# kernel calls with each of the packed (nPairs, q*q) and unpacked (L*L, q*q)
+# couplings, and the 'Junpacked' buffer is only kept if it is faster. It is
+# not allocated at all if it would take more than jlayout_mem_frac of device
+# memory, to leave room for the other buffers.
+jlayout_trials = 2
+jlayout_mem_frac = 0.5
+
+# Proposal distributions of the metropolis samplers: 'uniform' residues,
+# 'indep' draws them from the independent-model marginals set by
+# prepare_indep, and 'adaptive' starts from these (or uniform) and tunes them
+# from the per-position acceptance counts after every kernel call, see
+# adaptProposal in mcmc.cl. The proposals are mixed with the uniform
+# distribution with weight proposal_unif, to bound the Hastings factors.
+proposals = ['uniform', 'indep', 'adaptive']
+proposal_unif = 0.05
+
+# Gap-block moves (see gapMoves in mcmc.cl) insert, delete or shift blocks of
+# up to gap_block_max gaps at once. Residues filled into gapped sites are
+# drawn from the non-gap independent-model marginals set by prepare_indep
+# (or uniformly), mixed with the uniform distribution like the proposals.
+gap_block_max = 8
+
+# Independence-sampler jumps (see jumpPropose in mcmc.cl) replace whole walker
+# sequences by independent-model sequences, or by MSA sequences with each
+# residue redrawn from the independent model with probability jump_mut, so
+# that the proposal distribution is nonzero everywhere.
+jump_mut = 0.05
+
+# The sampler kernels keep 'E main' up to date as they go (the running
+# energies), which is then read by calcEnergies('main') for free. Rounding
+# error accumulates in these, so they are recomputed exactly every
+# energy_resync sampler calls, and whenever the couplings or walkers are
+# changed by other means.
+energy_resync = 16
+
+# The Newton iterations queue several coupling updates before the host reads
+# their weight statistics, which are stored in the rows of 'weightstats log'
+# (see logWeightStats). This is the maximum number of queued updates.
+jstep_log_max = 256
+
 ################################################################################
 
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '0'
@@ -110,7 +163,9 @@ class FutureBuf:
 
 class MCMCGPU:
     def __init__(self, gpuinfo, L, q, nseq, wgsize, outdir,
-                 vsize, seed, profile=False):
+                 vsize, seed, profile=False, sampler='metropolis',
+                 schedule='random', precision='single', jlayout='auto',
+                 seqbits=8, proposal='uniform', gapmoves=0, gapres=None):
         if nseq%512 != 0:
             raise ValueError("nwalkers/ngpus must be a multiple of 512")
             # this guarantees that all kernel access to seqmem is coalesced and
@@ -120,8 +175,13 @@ class MCMCGPU:
         self.q = q
         self.nPairs = L*(L-1)//2
         self.events = collections.deque()
-        self.SWORDS = ((L-1)//4+1)    #num words needed to store a sequence
-        self.SBYTES = (4*self.SWORDS) #num bytes needed to store a sequence
+        # sequences are stored seqbits per residue, see SEQBITS in mcmc.cl
+        if seqbits not in [8, 4, 2] or q > 2**seqbits:
+            raise ValueError("Invalid seqbits {} for q={}".format(seqbits, q))
+        self.seqbits = seqbits
+        self.rpw = 32//seqbits        #num residues per uint32
+        self.SWORDS = ((L-1)//self.rpw+1) #num words needed to store a sequence
+        self.SBYTES = 4*((L-1)//4+1)  #num bytes needed for a byte per residue
         self.nseq = {'main': nseq}
         self.nwalkers = nseq
 
@@ -144,9 +204,41 @@ class MCMCGPU:
         with open(self.logfn, "wt") as f:
             printDevice(f.write, device)
 
-        self.mcmcprg = prg.metropolis
-
-        self.rngstate = RandomState(seed)
+        if sampler not in ['metropolis', 'gibbs', 'fields', 'auto']:
+            raise ValueError("Unknown sampler '{}'".format(sampler))
+        self.sampler = sampler
+        self.mcmcprg = prg.gibbs if sampler == 'gibbs' else prg.metropolis
+        self.usefields = False
+
+        if schedule not in schedules:
+            raise ValueError("Unknown position schedule '{}'".format(schedule))
+        self.schedule = schedule
+
+        # must match the PROPOSAL compile options, see setup_GPU_context
+        if proposal not in proposals:
+            raise ValueError("Unknown proposal '{}'".format(proposal))
+        if proposal != 'uniform' and sampler == 'gibbs':
+            raise ValueError("The gibbs sampler does not use proposals")
+        self.proposal = proposal
+
+        # gapres must match the GAPRES compile option, see setup_GPU_context
+        if gapmoves > 0 and gapres is None:
+            raise ValueError("gap moves require a gap residue")
+        self.gapmoves = gapmoves
+        self.gapres = gapres
+
+        # 'half' must match the JHALF compile option, see setup_GPU_context
+        if precision not in ['single', 'half']:
+            raise ValueError("Unknown J precision '{}'".format(precision))
+        self.precision = precision
+
+        if jlayout not in ['auto', 'packed', 'unpacked']:
+            raise ValueError("Unknown J layout '{}'".format(jlayout))
+        self.jlayout = jlayout
+        self.packedJ = True
+        self.jlayout_times = None
+
+        self.seed = int(seed)
 
         #setup opencl for this device
         self.log("Getting CL Queue")
@@ -175,16 +267,21 @@ class MCMCGPU:
         nPairs, SWORDS = self.nPairs, self.SWORDS
         j_pad = 3*self.wgsize
         self._setupBuffer(        'J', '<f4', (nPairs, q*q), pad=j_pad)
-        self._setupBuffer('Junpacked', '<f4', (L*L, q*q), pad=j_pad)
+        if precision == 'half':
+            self._setupBuffer('J half', '<f2', (nPairs, q*q), pad=j_pad)
         self._setupBuffer(       'bi', '<f4', (nPairs, q*q)),
         self._setupBuffer(  'bicount', '<u4', (nPairs, q*q)),
         self._setupBuffer( 'seq main', '<u4', (SWORDS, self.nseq['main'])),
-        self._setupBuffer('seqL main', '<u4', (L, self.nseq['main']//4)),
+        self._setupBuffer('seqL main', '<u4', (L,
+                                               self.nseq['main']//self.rpw)),
         self._setupBuffer(    'cprob', '<f4', (L, (q-1))),
         self._setupBuffer(   'E main', '<f4', (self.nseq['main'],)),
         self._setupBuffer(   'minout', '<f4', (1,))
         self.unpackedJ = False #use to keep track of whether J is unpacked
         self.repackedSeqT = {'main': False}
+        # sampler calls since 'E main' was last computed exactly, or None if
+        # it is out of date
+        self.runningE = None
 
         self.lastevt = None
 
@@ -276,19 +373,78 @@ class MCMCGPU:
         self.nsteps = nsteps
         self._setupBuffer('rngstates', '<2u8', (self.nseq['main'],)),
         self._setupBuffer(       'Bs', '<f4',  (self.nseq['main'],)),
-        self._setupBuffer(  'randpos', '<u4',  (self.nsteps*rng_buf_mul,))
-        self.randpos_offset = rng_buf_mul*self.nsteps
+        self._setupBuffer(  'naccept', '<u4',  (self.nseq['main'],))
+        self.initPosRNG()
+        self.accept_read = None
+
+        if self.jlayout == 'unpacked':
+            self._usePackedJ(False)
+        elif self.jlayout == 'auto' and self._unpackedFits():
+            self._usePackedJ(False)
+            self.jlayout_times = {False: [], True: []}
+
+        if self.sampler == 'fields':
+            if not self._fieldsFit():
+                raise Exception("Not enough device memory for the local "
+                                "field table of the 'fields' sampler")
+            self._useFields(True)
+
+        if self.proposal != 'uniform':
+            L, q = self.L, self.q
+            self._setupBuffer('proposal', '<f4', (L, q))
+            self.setBuf('proposal', np.full((L, q), 1/q, dtype='<f4'))
+        if self.proposal == 'adaptive':
+            self._setupBuffer('proposal counts', '<u4', (2, L, q))
+            self.fillBuf('proposal counts', 0)
+
+        if self.gapmoves > 0:
+            self._setupBuffer(  'gapfill', '<f4', (self.L, self.q))
+            self._setupBuffer('gapaccept', '<u4', (self.nseq['main'],))
+            self.setBuf('gapfill', self._gapfill())
 
         self.setBuf('Bs', np.ones(self.nseq['main'], dtype='<f4'))
         self._initMCMC_RNG(rng_offset, rng_span)
         self.nsteps = int(nsteps)
 
+    def initJumps(self, jumprate, unimarg=None, msaseqs=None):
+        """
+        Set up the independence-sampler jumps made after each MCMC kernel
+        call, with probability jumprate per walker, to independent-model
+        sequences of the marginals unimarg (uniform if None), or if given to
+        the sequences msaseqs.
+        """
+        self.require('MCMC')
+        self._initcomponent('Jumps')
+        L, q, nseq = self.L, self.q, self.nseq['main']
+
+        self.jumprate = jumprate
+        self.nseq['jump'] = nseq
+        self._setupBuffer(  'seq jump', '<u4', (self.SWORDS, nseq))
+        self._setupBuffer(    'E jump', '<f4', (nseq,))
+        self._setupBuffer('jump dlogg', '<f4', (nseq,))
+        self._setupBuffer('jumpaccept', '<u4', (nseq,))
+        self._setupBuffer(    'jump p', '<f4', (L, q))
+        self.fillBuf('jumpaccept', 0)
+
+        p = np.full((L, q), 1/q)
+        if unimarg is not None:
+            p = unimarg/np.sum(unimarg, axis=1, keepdims=True)
+            p = (1 - proposal_unif)*p + proposal_unif/q
+        self.setBuf('jump p', p.astype('<f4'))
+
+        if msaseqs is not None:
+            self.nseq['jumpmsa'] = msaseqs.shape[0]
+            self._setupBuffer('seq jumpmsa', '<u4', (self.SWORDS,
+                                                     msaseqs.shape[0]))
+            self.setBuf('seq jumpmsa', msaseqs)
+
     def initLargeBufs(self, nseq_large):
         self._initcomponent('Large')
 
         self.nseq['large'] = nseq_large
         self._setupBuffer(    'seq large', '<u4', (self.SWORDS, nseq_large))
-        self._setupBuffer(   'seqL large', '<u4', (self.L, nseq_large//4)),
+        self._setupBuffer(   'seqL large', '<u4', (self.L,
+                                                   nseq_large//self.rpw)),
         self._setupBuffer(      'E large', '<f4', (nseq_large,))
         self._setupBuffer(  'E tmp large', '<f4', (nseq_large,)),
         self._setupBuffer('weights large', '<f4', (nseq_large,))
@@ -310,13 +466,114 @@ class MCMCGPU:
         self._setupBuffer('markpos', '<u1',  (self.SBYTES,), flags=cf.READ_ONLY)
         self.markPos(np.zeros(self.SBYTES, '<u1'))
 
-    ## we may want to select replicas at a particular temperature
-    #def initMarkSeq(self):
-    #    self._initcomponent('Markseq')
+    def initClamp(self, clampseq, marks):
+        """
+        Clamp the positions marked in marks to their residues in clampseq.
+        The samplers never change the marked positions, which must match the
+        CLAMP compile option, and clampSeqs sets them in the walkers.
+        """
+        self.require('MCMC')
+        self._initcomponent('Clamp')
+        self.nseq['clamp'] = 1
+        self._setupBuffer('seq clamp', '<u4', (self.SWORDS, 1))
+        if 'markpos' not in self.bufs:
+            self._setupBuffer('markpos', '<u1',  (self.SBYTES,),
+                              flags=cf.READ_ONLY)
+        self.setBuf('seq clamp', clampseq.reshape((1, self.L)))
+        self.markPos(marks)
+
+    def initTempering(self, betas):
+        """
+        Set up parallel tempering over the (increasing) inverse temperatures
+        betas, which must match the NTEMPS compile option. The walkers are
+        divided into chains with one walker at each temperature, and replica
+        exchange is done within each chain, see swapTemps. The large buffer
+        is used to store the walkers at the lowest temperature.
+        """
+        self.require('MCMC')
+        self._initcomponent('Tempering')
+
+        nseq, ntemps = self.nseq['main'], len(betas)
+        if nseq % ntemps != 0:
+            raise ValueError("The number of temperatures must evenly divide "
+                             "the number of walkers per GPU")
+        self.ntemps = ntemps
+        self.nchains = nseq//ntemps
+        self.swapparity = 0
+
+        self._setupBuffer(  'temp betas', '<f4', (ntemps,),
+                          flags=cf.READ_ONLY)
+        self._setupBuffer('temp walkers', '<u4', (ntemps, self.nchains))
+        self._setupBuffer('swaps accepted', '<u4', (ntemps-1,))
+        self._setupBuffer(   'swaps tried', '<u4', (ntemps-1,))
+
+        betas = np.asarray(betas, dtype='<f4')
+        self.setBuf('temp betas', betas)
+        self.setBuf('temp walkers', np.arange(nseq, dtype='<u4').reshape(
+                                               (ntemps, self.nchains)))
+        self.setBuf('Bs', np.repeat(betas, self.nchains))
+        self.clearSwapCounts()
+
+        if 'Large' not in self.initted:
+            self.initLargeBufs(nseq)
+        elif self.nseq['large'] < self.nchains:
+            raise Exception("large buffer is too small for tempering")
+
+    def initAnnealing(self):
+        self.require('MCMC')
+        self._initcomponent('Annealing')
+
+        nseq = self.nseq['main']
+        self._setupBuffer(     'anneal cumw', '<f4', (nseq,))
+        self._setupBuffer(  'anneal parents', '<u4', (nseq,))
+        self._setupBuffer('resampled seqs', '<u4', (self.SWORDS, nseq))
+
+    def initDesign(self):
+        """
+        Set up the 'best' buffers used for sequence design, which hold the
+        lowest-energy sequence found by each walker, see updateBest.
+        """
+        self.require('MCMC')
+        self._initcomponent('Design')
 
-    #    self._setupBuffer( 'markseqs', '<i4',  (self.nseq['main'],))
-    #    self.setBuf('markseqs', np.arange(self.nseq['main'], dtype='<i4'))
-    #    self.nmarks = self.nseq['main']
+        nseq = self.nseq['main']
+        self.nseq['best'] = nseq
+        self._setupBuffer('seq best', '<u4', (self.SWORDS, nseq))
+        self._setupBuffer(  'E best', '<f4', (nseq,))
+        self.fillBuf('E best', np.inf)
+
+    def initOptimizer(self, optimizer):
+        """
+        Set up the state buffers of the coupling update optimizers used by
+        updateJ_adam ('rmsprop' or 'adam') and momentumStep ('nesterov').
+        """
+        self.require('Jstep')
+        self._initcomponent('Optimizer')
+
+        nPairs, q = self.nPairs, self.q
+        if optimizer in ['rmsprop', 'adam']:
+            for name in ['adam m', 'adam s']:
+                self._setupBuffer(name, '<f4', (nPairs, q*q))
+                self._setupBuffer(name + ' saved', '<f4', (nPairs, q*q))
+                self.fillBuf(name, 0)
+        elif optimizer == 'nesterov':
+            self._setupBuffer('momentum', '<f4', (nPairs, q*q))
+            self.fillBuf('momentum', 0)
+
+    def initAIS(self, dJ):
+        """
+        Set up annealed importance sampling along the couplings J + b*dJ for
+        increasing b, see aisStep. The walker log weights are kept in
+        'ais logw'.
+        """
+        self.require('MCMC')
+        self._initcomponent('AIS')
+
+        nPairs, q = self.nPairs, self.q
+        self._setupBuffer(  'ais dJ', '<f4', (nPairs, q*q))
+        self._setupBuffer('ais logw', '<f4', (self.nseq['main'],))
+        self.setBuf('ais dJ', dJ)
+        self.fillBuf('ais logw', 0)
 
     def initJstep(self):
         self._initcomponent('Jstep')
@@ -328,31 +585,108 @@ class MCMCGPU:
         self._setupBuffer(   'Xlambdas', '<f4', (nPairs,))
         self._setupBuffer(    'weights', '<f4', (self.nseq['main'],))
         self._setupBuffer('weightstats', '<f4', (2,))
+        self._setupBuffer('weightstats log', '<f4', (jstep_log_max, 2))
         self._setupBuffer(      'E tmp', '<f4', (self.nseq['main'],)),
+        self._setupBuffer(   'dJ saved', '<f4', (nPairs, q*q))
+        self._setupBuffer(   'bi saved', '<f4', (nPairs, q*q))
+
+    def doubleWalkers(self):
+        """
+        Doubles the number of walkers, reallocating the per-walker buffers.
+        The new walkers start as copies of the old ones, with rng streams
+        starting halfway between the streams of the old walkers, so that the
+        streams stay distinct after repeated doublings.
+        """
+        self.require('MCMC')
+        for cmp in ['Large', 'Tempering', 'Design', 'AIS']:
+            if cmp in self.initted:
+                raise Exception("Cannot change the number of walkers after "
+                                "initializing {}".format(cmp))
+        self.log("doubleWalkers")
+
+        nseq = self.nseq['main']
+        seqs, Bs, rngstates = [self.getBuf(b).read()
+                               for b in ['seq main', 'Bs', 'rngstates']]
+        self.queue.finish()
+
+        # the local field table is reallocated below if it still fits
+        if 'fields' in self.bufs:
+            self.bufs.pop('fields').release()
+            self.buf_spec.pop('fields')
+
+        # the walker index is the last dimension of all these buffers
+        for name in ['seq main', 'seqL main', 'E main', 'rngstates', 'Bs',
+                     'naccept', 'gapaccept', 'weights', 'E tmp',
+                     'seq jump', 'E jump', 'jump dlogg', 'jumpaccept',
+                     'anneal cumw', 'anneal parents', 'resampled seqs']:
+            if name not in self.bufs:
+                continue
+            buftype, bufshape, flags = self.buf_spec[name]
+            self.bufs.pop(name).release()
+            self._setupBuffer(name, buftype,
+                              bufshape[:-1] + (2*bufshape[-1],), flags=flags)
+
+        self.nseq['main'] = self.nwalkers = 2*nseq
+        if 'jump' in self.nseq:
+            self.nseq['jump'] = 2*nseq
+            self.fillBuf('jumpaccept', 0)
+        if self.gapmoves > 0:
+            self.fillBuf('gapaccept', 0)
+        self.repackedSeqT['main'] = False
+        self.runningE = None
+        self.accept_read = None
+
+        if self.usefields:
+            if self._fieldsFit():
+                self._useFields(True)
+            elif self.sampler == 'fields':
+                raise Exception("Not enough device memory for the local "
+                                "field table of the 'fields' sampler")
+            else:
+                self._useFields(False)
+
+        self.setBuf('seq main', np.concatenate([seqs, seqs]))
+        self.setBuf('Bs', np.concatenate([Bs, Bs]))
+
+        newstates = cl.Buffer(self.ctx, cf.READ_WRITE, size=rngstates.nbytes)
+        ws = self.walker_span
+        evt = self.prg.initRNG2(self.queue, (nseq,), (self.wgsize,), newstates,
+                                self.rng_offset + ws//np.uint64(2), ws)
+        cl.enqueue_copy(self.queue, self.bufs['rngstates'], rngstates)
+        evt = cl.enqueue_copy(self.queue, self.bufs['rngstates'], newstates,
+                              dst_offset=rngstates.nbytes,
+                              byte_count=rngstates.nbytes, wait_for=[evt])
+        self.logevt('doubleWalkers', evt)
+        evt.wait()
+        newstates.release()
+        self.walker_span = ws//np.uint64(2)
 
 
     def packSeqs_4(self, seqs):
         """
-        Converts seqs to 4-byte uint format on CPU, padded to 32bits, assumes
-        little endian. Each row's bytes are
+        Converts seqs to 4-byte uint format on CPU, padded to 32bits. For
+        seqbits=8, each row's bytes are (little endian)
             a0 a1 a2 a3 b0 b1 b2 b3 c0 c1 c2 c3 ...
         for sequences a, b, c, so each uint32 correaponds to 4 seq bytes.
+        For smaller seqbits each uint32 holds 32/seqbits residues instead.
         """
         if seqs.dtype != np.dtype('<u1'):
             raise Exception("seqs must have u1 dtype")
-        bseqs = np.zeros((seqs.shape[0], self.SBYTES), dtype='<u1', order='C')
-        bseqs[:,:self.L] = seqs
-        mem = np.zeros((self.SWORDS, seqs.shape[0]), dtype='<u4', order='C')
-        for i in range(self.SWORDS):
-            mem[i,:] = bseqs.view(np.uint32)[:,i]
-        return mem
+        nseq, rpw = seqs.shape[0], self.rpw
+        wseqs = np.zeros((nseq, self.SWORDS*rpw), dtype='<u4')
+        wseqs[:,:self.L] = seqs
+        wseqs = wseqs.reshape((nseq, self.SWORDS, rpw))
+        wseqs <<= self.seqbits*np.arange(rpw, dtype='<u4')
+        mem = np.bitwise_or.reduce(wseqs, axis=2).T
+        return np.ascontiguousarray(mem, dtype='<u4')
 
     def unpackSeqs_4(self, mem):
         """ reverses packSeqs_4 (on CPU)"""
-        bseqs = np.zeros((mem.shape[1], self.SBYTES), dtype='<u1', order='C')
-        for i in range(self.SWORDS): #undo memory rearrangement
-            bseqs.view(np.uint32)[:,i] = mem[i,:]
-        return bseqs[:,:self.L]
+        shifts = self.seqbits*np.arange(self.rpw, dtype='<u4')
+        mask = (1 << self.seqbits) - 1
+        bseqs = (mem.T[:,:,None] >> shifts) & mask
+        bseqs = bseqs.reshape((mem.shape[1], self.SWORDS*self.rpw))
+        return bseqs[:,:self.L].astype('<u1')
 
     def repackseqs_T(self, bufname, wait_for=None):
         """
@@ -370,16 +704,40 @@ class MCMCGPU:
         return self.logevt('repackseqs_T',
             self.prg.unpackseqs1T(self.queue, (self.SWORDS*256,), (256,),
                             inseq_dev, np.uint32(nseq),
-                            outseq_dev, np.uint32(nseq//4),
+                            outseq_dev, np.uint32(nseq//self.rpw),
                             wait_for=self._waitevt(wait_for)))
 
     def prepare_indep(self, unimarg, wait_for=None):
         cprob = np.cumsum(unimarg, axis=1)
         cprob = (cprob[:,:-1]/cprob[:,-1,None]).copy()
-        return self.setBuf('cprob', cprob, wait_for=self._waitevt(wait_for))
+        evt = self.setBuf('cprob', cprob, wait_for=self._waitevt(wait_for))
+
+        # the metropolis proposals also start from these marginals
+        if 'proposal' in self.bufs:
+            prop = unimarg/np.sum(unimarg, axis=1, keepdims=True)
+            prop = (1 - proposal_unif)*prop + proposal_unif/self.q
+            evt = self.setBuf('proposal', prop.astype('<f4'), wait_for=[evt])
+        if 'gapfill' in self.bufs:
+            evt = self.setBuf('gapfill', self._gapfill(unimarg),
+                              wait_for=[evt])
+        return evt
+
+    def _gapfill(self, unimarg=None):
+        # probabilities of the residues filled into gapped sites by gapMoves
+        nongap = np.ones(self.q)
+        nongap[self.gapres] = 0
+        unif = np.tile(nongap/(self.q - 1), (self.L, 1))
+        if unimarg is None:
+            return unif.astype('<f4')
+        p = unimarg*nongap
+        Z = np.sum(p, axis=1, keepdims=True)
+        p = np.where(Z > 0, p/np.where(Z > 0, Z, 1), unif)
+        return ((1 - proposal_unif)*p + proposal_unif*unif).astype('<f4')
 
     def gen_indep(self, bufname, wait_for=None):
         self.log("gen_indep")
+        if bufname == 'main':
+            self.runningE = None
 
         nseq = self.nseq[bufname]
         seq_dev = self.bufs['seq ' + bufname]
@@ -393,7 +751,9 @@ class MCMCGPU:
 
     def unpackJ(self, wait_for=None):
         """convert J from format where every row is a unique ij pair (L choose 2
-        rows) to format with every pair, all orders (L^2 rows)."""
+        rows) to format with every pair, all orders (L^2 rows), if the
+        'Junpacked' buffer is allocated. In half precision mode, also makes
+        the packed half precision copy 'J half'."""
 
         # quit if J already loaded/unpacked
         if self.unpackedJ:
@@ -403,10 +763,24 @@ class MCMCGPU:
 
         q, nPairs = self.q, self.nPairs
         self.unpackedJ = True
-        return self.logevt('unpackJ',
-            self.prg.unpackfV(self.queue, (nPairs*q*q,), (q*q,),
-                            self.bufs['J'], self.bufs['Junpacked'],
-                            wait_for=self._waitevt(wait_for)))
+        wait = self._waitevt(wait_for)
+        evts = []
+        if 'Junpacked' in self.bufs:
+            evts.append(self.logevt('unpackJ',
+                self.prg.unpackfV(self.queue, (nPairs*q*q,), (q*q,),
+                                self.bufs['J'], self.bufs['Junpacked'],
+                                wait_for=wait)))
+        if self.precision == 'half':
+            evts.append(self.logevt('packHalf',
+                self.prg.packHalf(self.queue, (nPairs*q*q,), None,
+                                self.bufs['J'], self.bufs['J half'],
+                                wait_for=wait)))
+        return evts if evts else wait_for
+
+    def _Jchanged(self):
+        # called when the couplings are modified
+        self.unpackedJ = False
+        self.runningE = None
 
     def _initMCMC_RNG(self, rng_offset, rng_span, wait_for=None):
         self.require('MCMC')
@@ -435,6 +809,8 @@ class MCMCGPU:
         # across gpus are all distinct, or else some walkers will be highly
         # correlated. Touch this code with care.
         assert(walker_span*v2*nwalkers <= rng_span)
+        # used to place the streams of new walkers, see doubleWalkers
+        self.rng_offset, self.walker_span = rng_offset, walker_span
 
         wgsize = self.wgsize
         while wgsize > nwalkers:
@@ -445,16 +821,37 @@ class MCMCGPU:
                          np.uint64(rng_offset), walker_span,
                          wait_for=self._waitevt(wait_for)))
 
+    def initPosRNG(self, wait_for=None):
+        # The position buffer holds rng_buf_mul kernel calls worth of
+        # positions, generated in blocks of L positions, each block with its
+        # own rng stream (block size L makes a permutation schedule easy).
+        # All gpus use same position-rng streams. This way there is no
+        # difference between running on one gpu vs splitting on multiple.
+        L = self.L
+        nblocks, offset, block_span = posrng_streams(
+                                    L, rng_buf_mul*self.nsteps, self.seed)
+        self.posblocks = nblocks
+        self._setupBuffer('randpos', '<u4',  (nblocks*L,))
+        self._setupBuffer( 'posrng', '<2u8', (nblocks,))
+        self.randpos_offset = rng_buf_mul*self.nsteps
+
+        return self.logevt('initPosRNG',
+            self.prg.initRNG2(self.queue, (nblocks,), (64,),
+                         self.bufs['posrng'],
+                         np.uint64(offset), np.uint64(block_span),
+                         wait_for=self._waitevt(wait_for)))
+
     def updateRngPos(self, wait_evt=None):
         self.randpos_offset = self.randpos_offset + self.nsteps
         rng_evt = None
 
         bufsize = rng_buf_mul*self.nsteps
         if self.randpos_offset >= bufsize:
-            # all gpus use same position-rng series. This way there is no
-            # difference between running on one gpu vs splitting on multiple
-            rng = self.rngstate.randint(0, self.L, size=bufsize).astype('u4')
-            rng_evt = self.setBuf('randpos', rng, wait_for=wait_evt)
+            rng_evt = self.logevt('genPositions',
+                self.prg.genPositions(self.queue, (self.posblocks,), (64,),
+                                 self.bufs['posrng'], self.bufs['randpos'],
+                                 np.uint32(schedules[self.schedule]),
+                                 wait_for=self._waitevt(wait_evt)))
             self.randpos_offset = 0
         return np.uint32(self.randpos_offset), rng_evt
 
@@ -473,31 +870,203 @@ class MCMCGPU:
 
         wait = self._evtlist(wait_unpack) + self._evtlist(wait_rng)
 
+        # the samplers update 'E main', so it must be current on entry
+        if self.runningE is not None and self.runningE >= energy_resync:
+            self.runningE = None
+        wait = [self.calcEnergies('main', wait_for=wait)]
+        self.runningE += 1
+
+        if self.sampler == 'auto':
+            self._autoSampler()
+
+        bufs = [self.seqbufs['main'], self.bufs['naccept']]
+        if self.sampler != 'gibbs':
+            bufs.extend([self.bufs.get('proposal'),
+                         self.bufs.get('proposal counts')])
+        if self.usefields:
+            bufs.append(self.bufs['fields'])
+        bufs.append(self.bufs.get('markpos'))
+
+        # alternate the coupling layouts while timing them, see initMCMC
+        timing = self.jlayout_times is not None
+        if timing:
+            ntimed = {k: len(v) for k, v in self.jlayout_times.items()}
+            self._usePackedJ(ntimed[False] > ntimed[True])
+            self.queue.finish()
+            t0 = time.perf_counter()
+
         self.repackedSeqT['main'] = False
-        return self.logevt('mcmc',
+        evt = self.logevt('mcmc',
             self.mcmcprg(self.queue, (nseq,), (self.wgsize,),
-                         self.bufs['Junpacked'], self.bufs['rngstates'],
+                         self._samplerJ(), np.uint32(self.packedJ),
+                         self.bufs['rngstates'],
                          rngoffset, self.bufs['randpos'], np.uint32(nsteps),
-                         self.Ebufs['main'], self.bufs['Bs'],
-                         self.seqbufs['main'],
+                         self.Ebufs['main'], self.bufs['Bs'], *bufs,
                          wait_for=wait))
 
-    def measureFPerror(self, log, nloops=3):
-        log("Measuring FP Error")
-        for n in range(nloops):
-            self.runMCMC()
-            e1 = self.getBuf('E main').read()
-            self.calcEnergies('main')
-            e2 = self.getBuf('E main').read()
-            log("Run", n, "Error:", np.mean((e1-e2)**2))
-            log('    Final E MC', printsome(e1), '...')
-            log("    Final E rc", printsome(e2), '...')
-
-            seqs = self.getBuf('seq main').read()
-            J = self.getBuf('J').read()
-            e3 = getEnergies(seqs, J)
-            log("    Exact E", e3[:5])
-            log("    Error:", np.mean([float((a-b)**2) for a,b in zip(e1, e3)]))
+        if timing:
+            evt.wait()
+            self.jlayout_times[self.packedJ].append(time.perf_counter() - t0)
+            if len(self.jlayout_times[True]) == jlayout_trials:
+                self._chooseJlayout()
+
+        if self.sampler == 'auto' and self.accept_read is None:
+            self.accept_read = self.getBuf('naccept', wait_for=[evt])
+
+        if self.proposal == 'adaptive':
+            evt = self.logevt('adaptProposal',
+                self.prg.adaptProposal(self.queue, (self.L,), None,
+                                self.bufs['proposal'],
+                                self.bufs['proposal counts'],
+                                np.float32(proposal_unif), wait_for=[evt]))
+
+        if self.gapmoves > 0:
+            evt = self.logevt('gapMoves',
+                self.prg.gapMoves(self.queue, (nseq,), (self.wgsize,),
+                                self._samplerJ(), np.uint32(self.packedJ),
+                                self.bufs['rngstates'],
+                                np.uint32(self.gapmoves), self.bufs['Bs'],
+                                self.seqbufs['main'], self.Ebufs['main'],
+                                self.bufs['gapfill'], self.bufs['gapaccept'],
+                                wait_for=[evt]))
+
+        if 'Jumps' in self.initted:
+            evt = self._jumpWalkers(wait_for=[evt])
+        return evt
+
+    def _jumpWalkers(self, wait_for=None):
+        # independence-sampler jumps, see initJumps
+        nseq = self.nseq['main']
+        evt = self.logevt('jumpPropose',
+            self.prg.jumpPropose(self.queue, (nseq,), (self.wgsize,),
+                            self.bufs['rngstates'], np.float32(self.jumprate),
+                            self.seqbufs['main'], self.seqbufs['jump'],
+                            self.seqbufs.get('jumpmsa'),
+                            np.uint32(self.nseq.get('jumpmsa', 0)),
+                            self.bufs['jump p'], np.float32(jump_mut),
+                            self.bufs['jump dlogg'],
+                            wait_for=self._waitevt(wait_for)))
+
+        evts = [self.calcEnergies('main', wait_for=[evt]),
+                self.calcEnergies('jump', wait_for=[evt])]
+        return self.logevt('jumpAccept',
+            self.prg.jumpAccept(self.queue, (nseq,), (self.wgsize,),
+                            self.bufs['rngstates'], self.bufs['Bs'],
+                            self.seqbufs['main'], self.seqbufs['jump'],
+                            self.Ebufs['main'], self.Ebufs['jump'],
+                            self.bufs['jump dlogg'], self.bufs['jumpaccept'],
+                            wait_for=evts))
+
+    def updateBest(self, wait_for=None):
+        """Store each walker's sequence if it is the lowest-energy one it
+        has reached so far, see initDesign"""
+        self.require('Design')
+        self.log("updateBest")
+
+        nseq = self.nseq['main']
+        wait = [self.calcEnergies('main', wait_for=wait_for)]
+        return self.logevt('updateBest',
+            self.prg.updateBest(self.queue, (nseq,), (self.wgsize,),
+                            self.seqbufs['main'], self.Ebufs['main'],
+                            self.seqbufs['best'], self.Ebufs['best'],
+                            wait_for=wait))
+
+    def greedyDescent(self, nsweeps, wait_for=None):
+        """Greedily lower the walker energies by nsweeps sweeps of single
+        mutations. The number of mutations made by each walker is stored in
+        'naccept'."""
+        self.require('MCMC')
+        self.log("greedyDescent")
+
+        nseq = self.nseq['main']
+        wait = self._evtlist(self.unpackJ(wait_for=self._waitevt(wait_for)))
+        wait = [self.calcEnergies('main', wait_for=wait)]
+        self.repackedSeqT['main'] = False
+        return self.logevt('greedyDescent',
+            self.prg.greedyDescent(self.queue, (nseq,), (self.wgsize,),
+                            self._samplerJ(), np.uint32(self.packedJ),
+                            np.uint32(nsweeps), self.Ebufs['main'],
+                            self.seqbufs['main'], self.bufs['naccept'],
+                            wait_for=wait))
+
+    def _unpackedFits(self):
+        # whether the (L*L, q*q) unpacked couplings fit in device memory
+        L, q = self.L, self.q
+        itemsize = 2 if self.precision == 'half' else 4
+        nbytes = itemsize*(L*L*q*q + 3*self.wgsize)
+        used = sum(b.size for b in self.bufs.values())
+        return (nbytes <= self.device.max_mem_alloc_size and
+                used + nbytes <= jlayout_mem_frac*self.device.global_mem_size)
+
+    def _usePackedJ(self, packed):
+        if not packed and 'Junpacked' not in self.bufs:
+            L, q = self.L, self.q
+            jdtype = '<f2' if self.precision == 'half' else '<f4'
+            self._setupBuffer('Junpacked', jdtype, (L*L, q*q),
+                              pad=3*self.wgsize)
+            self.unpackedJ = False
+        self.packedJ = packed
+
+    def _samplerJ(self):
+        # the coupling buffer read by the sampler kernels
+        if not self.packedJ:
+            return self.bufs['Junpacked']
+        return self.bufs['J half' if self.precision == 'half' else 'J']
+
+    def _chooseJlayout(self):
+        tp = min(self.jlayout_times[True])
+        tu = min(self.jlayout_times[False])
+        self.jlayout_times = None
+        self.log("MCMC kernel time with packed J: {:.4g} s, unpacked J: "
+                 "{:.4g} s".format(tp, tu))
+
+        if tu < tp:
+            self._usePackedJ(False)
+            return
+
+        self.log("Using packed J, freeing Junpacked")
+        self._usePackedJ(True)
+        self.queue.finish()
+        self.bufs.pop('Junpacked').release()
+        self.buf_spec.pop('Junpacked')
+
+    def _fieldsFit(self):
+        # whether the (L*q, nseq) field table fits in device memory
+        nbytes = 4*self.L*self.q*self.nseq['main']
+        used = sum(b.size for b in self.bufs.values())
+        return (nbytes <= self.device.max_mem_alloc_size and
+                used + nbytes <= fields_mem_frac*self.device.global_mem_size)
+
+    def _useFields(self, usefields):
+        if usefields and 'fields' not in self.bufs:
+            self._setupBuffer('fields', '<f4', (self.L*self.q,
+                                                self.nseq['main']))
+        self.usefields = usefields
+        self.mcmcprg = (self.prg.metropolis_fields if usefields
+                        else self.prg.metropolis)
+
+    def _autoSampler(self):
+        # Choose between the metropolis and metropolis_fields kernels using
+        # the acceptance rate of an earlier kernel call. The rate is read
+        # back asynchronously, and only used once the read has completed, to
+        # avoid stalling the queue.
+        read = self.accept_read
+        complete = cl.command_execution_status.COMPLETE
+        if read is None or read.event.command_execution_status != complete:
+            return
+        self.accept_read = None
+
+        naccept = np.sum(read.read(), dtype=np.float64)
+        rate = naccept/(self.nseq['main']*self.nsteps)
+        if not self.usefields and rate < fields_accept_max/self.q:
+            if self._fieldsFit():
+                self.log("Acceptance rate {:.4f}, switching to "
+                         "metropolis_fields".format(rate))
+                self._useFields(True)
+        elif self.usefields and rate > 2*fields_accept_max/self.q:
+            self.log("Acceptance rate {:.4f}, switching to "
+                     "metropolis".format(rate))
+            self._useFields(False)
 
     def calcBicounts(self, seqbufname, wait_for=None):
         self.log("calcBicounts " + seqbufname)
@@ -535,23 +1104,39 @@ class MCMCGPU:
                      wait_for=self._waitevt(wait_for)))
 
     def calcEnergies(self, seqbufname, Jbufname='J', wait_for=None):
+        # the running energies of the walkers need no work, see runMCMC
+        if seqbufname == 'main':
+            if Jbufname == 'J' and self.runningE is not None:
+                return cl.enqueue_marker(self.queue,
+                                         wait_for=self._waitevt(wait_for))
+            self.runningE = 0 if Jbufname == 'J' else None
+
         self.log("calcEnergies " + seqbufname)
 
         energies_dev = self.Ebufs[seqbufname]
         seq_dev = self.seqbufs[seqbufname]
         buflen = self.nseq[seqbufname]
 
-        if seqbufname == 'main':
+        if 'seq ' + seqbufname not in self.largebufs:
             nseq = self.nseq[seqbufname]
         else:
             nseq = self.nstoredseqs
             # pad to be a multiple of wgsize (uses dummy seqs at end)
             nseq = nseq + ((self.wgsize - nseq) % self.wgsize)
 
+        # In half precision mode the energies of J are computed from the
+        # same rounded couplings the sampler uses. Other buffers (eg dJ) are
+        # small and need full precision.
+        kernel = self.prg.getEnergies
+        if Jbufname == 'J' and self.precision == 'half':
+            wait_for = self.unpackJ(wait_for=wait_for)
+            kernel = self.prg.getEnergies_half
+            Jbufname = 'J half'
+
         return self.logevt('getEnergies',
-            self.prg.getEnergies(self.queue, (nseq,), (self.wgsize,),
-                             self.bufs[Jbufname], seq_dev, np.uint32(buflen),
-                             energies_dev, wait_for=self._waitevt(wait_for)))
+            kernel(self.queue, (nseq,), (self.wgsize,),
+                   self.bufs[Jbufname], seq_dev, np.uint32(buflen),
+                   energies_dev, wait_for=self._waitevt(wait_for)))
 
     def min_buf(self, buf, wait_for=None):
         self.require('Jstep')
@@ -589,6 +1174,49 @@ class MCMCGPU:
                             local_sum, local_sum2, np.uint32(buflen),
                             wait_for=self._waitevt(wait_for)))
 
+    def logWeightStats(self, n, wait_for=None):
+        # copy 'weightstats' to row n of 'weightstats log', so the statistics
+        # of several coupling updates can be read at once
+        self.require('Jstep')
+        self.log("logWeightStats")
+
+        nbytes = 2*np.dtype(np.float32).itemsize
+        return self.logevt('logWeightStats',
+            cl.enqueue_copy(self.queue, self.bufs['weightstats log'],
+                            self.bufs['weightstats'], byte_count=nbytes,
+                            dst_offset=n*nbytes,
+                            wait_for=self._waitevt(wait_for)))
+
+    def saveJstep(self, wait_for=None):
+        """
+        Save the coupling update 'dJ' and the marginals 'bi' the next update
+        is computed from, and the Adam state if any, so the updates after
+        this can be undone by restoreJstep.
+        """
+        self.require('Jstep')
+        self.log("saveJstep")
+
+        evt = self.setBuf('dJ saved', self.bufs['dJ'], wait_for=wait_for)
+        evt = self.setBuf('bi saved', self.bufs['bi'], wait_for=[evt])
+        for name in ['adam m', 'adam s']:
+            if name in self.bufs:
+                evt = self.setBuf(name + ' saved', self.bufs[name],
+                                  wait_for=[evt])
+        return evt
+
+    def restoreJstep(self, wait_for=None):
+        """Restore the buffers saved by saveJstep"""
+        self.require('Jstep')
+        self.log("restoreJstep")
+
+        evt = self.setBuf('dJ', self.bufs['dJ saved'], wait_for=wait_for)
+        evt = self.setBuf('bi', self.bufs['bi saved'], wait_for=[evt])
+        for name in ['adam m', 'adam s']:
+            if name in self.bufs:
+                evt = self.setBuf(name, self.bufs[name + ' saved'],
+                                  wait_for=[evt])
+        return evt
+
     def dE_to_weights(self,  buf='main', offset=0., wait_for=None):
         self.require('Jstep')
         self.log("dE_to_weights")
@@ -640,11 +1268,11 @@ class MCMCGPU:
 
         if seqbufname == 'main':
             nseq = self.nseq[seqbufname]
-            buflen = nseq//4
+            buflen = nseq//self.rpw
             weights_dev = self.bufs['weights']
         else:
             nseq = self.nstoredseqs
-            buflen = self.nseq[seqbufname]//4
+            buflen = self.nseq[seqbufname]//self.rpw
             weights_dev = self.bufs['weights large']
             # pad to be a multiple of 512 (uses dummy seqs at end)
             nseq = nseq + ((512 - nseq) % 512)
@@ -677,6 +1305,8 @@ class MCMCGPU:
         src = self.bufs[srcname]
         if dst.size != src.size:
             raise Exception('Tried to add bufs of different sizes')
+        if dstname == 'E main':
+            self.runningE = None
         buflen = np.product(self.buf_spec[dstname][1])
         nworkunits = self.wgsize*((buflen-1)//self.wgsize+1)
 
@@ -685,6 +1315,31 @@ class MCMCGPU:
                        dst, src, np.uint32(buflen),
                        wait_for=self._waitevt(wait_for)))
 
+    def _addScaledBuf(self, dstname, srcname, scale, wait_for=None):
+        # dst += scale*src, for float buffers of the same size
+        buflen = np.product(self.buf_spec[dstname][1])
+        nworkunits = self.wgsize*((buflen-1)//self.wgsize+1)
+        return self.logevt('addScaledBuf',
+            self.prg.addScaledFloatBufs(self.queue, (nworkunits,),
+                       (self.wgsize,), self.bufs[dstname], self.bufs[srcname],
+                       np.float32(scale), np.uint32(buflen),
+                       wait_for=self._waitevt(wait_for)))
+
+    def aisStep(self, dB, wait_for=None):
+        """
+        Annealed importance sampling step from b to b+dB, see initAIS: adds
+        -dB times the energy of each walker under 'ais dJ' to its log weight,
+        and adds dB*dJ to the couplings. The walkers should then be
+        equilibrated under the new couplings.
+        """
+        self.require('AIS')
+        self.log("aisStep")
+
+        evt = self.calcEnergies('main', 'ais dJ', wait_for=wait_for)
+        evt = self._addScaledBuf('ais logw', 'E main', -dB, wait_for=[evt])
+        self._Jchanged()
+        return self._addScaledBuf('J', 'ais dJ', dB, wait_for=[evt])
+
     def addBiBuffer(self, bufname, otherbuf, wait_for=None):
         # used for combining results from different gpus, where  otherbuf is a
         # buffer "belonging" to another gpu
@@ -711,20 +1366,55 @@ class MCMCGPU:
 
         bibuf = self.bufs['bi']
         Jin = Jout = self.bufs[Jbuf]
-        self.unpackedJ = False
+        self._Jchanged()
         return self.logevt('updateJ',
             self.prg.updatedJ(self.queue, (nworkunits,), (self.wgsize,),
                                 self.bufs['bi target'], bibuf,
                                 np.float32(gamma), np.float32(pc), Jin, Jout,
                                 wait_for=self._waitevt(wait_for)))
 
+    def updateJ_adam(self, gamma, pc, b1, b2, t, wait_for=None):
+        """
+        Adam update of 'dJ' (RMSprop if b1 is 0), for the t-th update since
+        initOptimizer, see updatedJ_adam in mcmc.cl.
+        """
+        self.require('Jstep', 'Optimizer')
+        self.log("updateJ_adam")
+        q, nPairs = self.q, self.nPairs
+        nworkunits = self.wgsize*((nPairs*q*q-1)//self.wgsize+1)
+
+        self._Jchanged()
+        return self.logevt('updateJ_adam',
+            self.prg.updatedJ_adam(self.queue, (nworkunits,), (self.wgsize,),
+                          self.bufs['bi target'], self.bufs['bi'],
+                          np.float32(gamma), np.float32(pc),
+                          np.float32(b1), np.float32(b2),
+                          np.float32(1 - b1**t), np.float32(1 - b2**t),
+                          self.bufs['adam m'], self.bufs['adam s'],
+                          self.bufs['dJ'], wait_for=self._waitevt(wait_for)))
+
+    def momentumStep(self, mu, wait_for=None):
+        """
+        Nesterov momentum step at the end of the coupling updates of a round:
+        the 'momentum' velocity v becomes mu*v + dJ, and mu*v is added to dJ.
+        """
+        self.require('Jstep', 'Optimizer')
+        self.log("momentumStep")
+        q, nPairs = self.q, self.nPairs
+        nworkunits = self.wgsize*((nPairs*q*q-1)//self.wgsize+1)
+
+        return self.logevt('momentumStep',
+            self.prg.momentumdJ(self.queue, (nworkunits,), (self.wgsize,),
+                       np.float32(mu), self.bufs['momentum'], self.bufs['dJ'],
+                       wait_for=self._waitevt(wait_for)))
+
     def reg_l1z(self, gamma, pc, lJ, wait_for=None):
         self.require('Jstep')
         self.log("reg_l1z")
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_l1z',
             self.prg.reg_l1z(self.queue, (nPairs*q*q,), (q*q,),
                             bibuf, np.float32(gamma), np.float32(pc),
@@ -737,7 +1427,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_l2z',
             self.prg.reg_l2z(self.queue, (nPairs*q*q,), (q*q,),
                             bibuf, np.float32(gamma), np.float32(pc),
@@ -751,7 +1441,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_SCADJ',
             self.prg.reg_SCADJ(self.queue, (nPairs*q*q,), (q*q,),
                             bibuf, np.float32(gamma), np.float32(pc),
@@ -765,7 +1455,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_Xij',
             self.prg.reg_X(self.queue, (nPairs*q*q,), (q*q,),
                                 bibuf, self.bufs['Creg'],
@@ -779,7 +1469,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_X',
             self.prg.reg_Xij(self.queue, (nPairs*q*q,), (q*q,),
                                 bibuf, np.float32(lX),
@@ -793,7 +1483,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_SCADX',
             self.prg.reg_SCADX(self.queue, (nPairs*q*q,), (q*q,),
                             bibuf, np.float32(gamma), np.float32(pc),
@@ -807,7 +1497,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_SCADX',
             self.prg.reg_expX(self.queue, (nPairs*q*q,), (q*q,),
                             bibuf, np.float32(gamma), np.float32(pc),
@@ -821,7 +1511,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_ddE',
             self.prg.reg_ddE(self.queue, (nPairs*q*q,), (q*q,),
                                 bibuf, np.float32(gamma), np.float32(pc),
@@ -835,7 +1525,7 @@ class MCMCGPU:
         q, nPairs = self.q, self.nPairs
 
         bibuf = self.bufs['bi']
-        self.unpackedJ = None
+        self._Jchanged()
         return self.logevt('reg_SCADddE',
             self.prg.reg_SCADddE(self.queue, (nPairs*q*q,), (q*q,),
                                 bibuf, np.float32(gamma), np.float32(pc),
@@ -876,7 +1566,9 @@ class MCMCGPU:
                                   wait_for=self._waitevt(wait_for))
             self.logevt('setBuf', evt, buf.size)
             if bufname.split()[0] == 'J':
-                self.unpackedJ = None
+                self._Jchanged()
+            if bufname in ['seq main', 'E main']:
+                self.runningE = None
             return  evt
 
         if bufname.split()[0] == 'seq':
@@ -899,11 +1591,13 @@ class MCMCGPU:
         self.logevt('setBuf', evt, buf.nbytes)
         #unset packedJ flag if we modified that J buf
         if bufname.split()[0] == 'J':
-            self.unpackedJ = None
+            self._Jchanged()
         if bufname == 'seq large':
             self.nstoredseqs = bufshape[1]
         if bufname.split()[0] == 'seq':
             self.repackedSeqT[bufname.split()[1]] = False
+        if bufname in ['seq main', 'E main']:
+            self.runningE = None
 
         return evt
 
@@ -912,13 +1606,18 @@ class MCMCGPU:
 
         buf = self.bufs[bufname]
         buftype = np.dtype(self.buf_spec[bufname][0]).type
+        if bufname.split()[0] == 'J':
+            self._Jchanged()
+        if bufname in ['seq main', 'E main']:
+            self.runningE = None
 
         self.logevt('fill_buffer',
             cl.enqueue_fill_buffer(self.queue, buf, buftype(val), 0, buf.size,
                                    wait_for=self._waitevt()))
 
     def markPos(self, marks, wait_for=None):
-        self.require('Subseq')
+        if 'Clamp' not in self.initted:
+            self.require('Subseq')
 
         marks = marks.astype('<u1')
         if len(marks) == self.L:
@@ -953,7 +1652,7 @@ class MCMCGPU:
             assert(seqs.dtype == np.dtype('u1'))
             buf = self.packSeqs_4(seqs)
 
-            w, h = self.buf_spec['seq large'][1] # L/4, nseq
+            w, h = self.buf_spec['seq large'][1] # SWORDS, nseq
             # for some reason, rectangular copies in pyOpencl use opposite axis
             # order from numpy, and need indices in bytes not elements, so we
             # have to switch all this around. buf is uint32, or 4 bytes.
@@ -983,6 +1682,14 @@ class MCMCGPU:
         self.nstoredseqs = 0
         self.repackedSeqT['large'] = False
 
+    def setNStored(self, nstores):
+        # Sets the stored sequences to the first nstores blocks of walkers in
+        # the large buffer, so the next storeSeqs overwrites the blocks after
+        # them. Used to keep the samples of several rounds in the buffer.
+        self.require('Large')
+        self.nstoredseqs = nstores*self.nseq['main']
+        self.repackedSeqT['large'] = False
+
     def restoreSeqs(self, wait_for=None):
         self.require('Large')
         self.log("restoreSeqs " + str(offset))
@@ -994,12 +1701,82 @@ class MCMCGPU:
             raise Exception("not enough seqs stored in large buffer")
 
         self.repackedSeqT['main'] = False
+        self.runningE = None
         return self.logevt('restoreSeqs',
             self.prg.restoreSeqs(self.queue, (nseq,), (self.wgsize,),
                            self.seqbufs['main'], self.seqbufs['large'],
                            np.uint32(self.nseq['large']), np.uint32(offset),
                            wait_for=self._waitevt(wait_for)))
 
+    def swapTemps(self, nswaps, wait_for=None):
+        """
+        Performs nswaps rounds of replica exchange between neighboring
+        temperatures, on the device. Updates 'E main' first.
+        """
+        self.require('Tempering')
+        self.log("swapTemps")
+        wait = self.calcEnergies('main', wait_for=wait_for)
+
+        parity = self.swapparity
+        self.swapparity = (parity + nswaps)%2
+        return self.logevt('swapTemps',
+            self.prg.swapTemps(self.queue, (self.nchains,), None,
+                           self.Ebufs['main'], self.bufs['Bs'],
+                           self.bufs['temp walkers'], self.bufs['temp betas'],
+                           self.bufs['rngstates'], np.uint32(nswaps),
+                           np.uint32(parity), self.bufs['swaps accepted'],
+                           self.bufs['swaps tried'], wait_for=[wait]))
+
+    def resampleWalkers(self, dB, wait_for=None):
+        """
+        Population annealing step for an increase dB of the inverse
+        temperature: replaces the walkers by a resampled population, chosen
+        in proportion to exp(-dB*E), on the device.
+        """
+        self.require('Annealing')
+        self.log("resampleWalkers")
+        nseq = self.nseq['main']
+        wait = self.calcEnergies('main', wait_for=wait_for)
+
+        vsize = 1024
+        scratch = cl.LocalMemory(vsize*np.dtype(np.float32).itemsize)
+        evt = self.logevt('annealParents',
+            self.prg.annealParents(self.queue, (vsize,), (vsize,),
+                           self.Ebufs['main'], np.float32(dB), np.uint32(nseq),
+                           self.bufs['anneal cumw'], self.bufs['anneal parents'],
+                           self.bufs['rngstates'], scratch, wait_for=[wait]))
+        evt = self.logevt('copyParents',
+            self.prg.copyParents(self.queue, (nseq,), (self.wgsize,),
+                           self.seqbufs['main'], self.bufs['resampled seqs'],
+                           self.bufs['anneal parents'], wait_for=[evt]))
+        self.repackedSeqT['main'] = False
+        return self.setBuf('seq main', self.bufs['resampled seqs'],
+                           wait_for=[evt])
+
+    def clearSwapCounts(self):
+        self.require('Tempering')
+        self.fillBuf('swaps accepted', 0)
+        self.fillBuf('swaps tried', 0)
+
+    def storeTempSeqs(self, tempind=-1, wait_for=None):
+        """
+        Replaces the contents of the large buffer by the walkers at the
+        temperature with index tempind, by default the lowest temperature.
+        """
+        self.require('Tempering', 'Large')
+        tempind = tempind % self.ntemps
+        self.log("storeTempSeqs " + str(tempind))
+
+        self.nstoredseqs = self.nchains
+        self.repackedSeqT['large'] = False
+        return self.logevt('storeTempSeqs',
+            self.prg.storeTempSeqs(self.queue, (self.nchains,), None,
+                           self.seqbufs['main'], np.uint32(self.nseq['main']),
+                           self.seqbufs['large'], np.uint32(self.nseq['large']),
+                           np.uint32(0), self.bufs['temp walkers'],
+                           np.uint32(tempind),
+                           wait_for=self._waitevt(wait_for)))
+
     def copySubseq(self, seqind, wait_for=None):
         self.require('Subseq')
         self.log("copySubseq " + str(seqind))
@@ -1014,6 +1791,19 @@ class MCMCGPU:
                             self.bufs['markpos'],
                             wait_for=self._waitevt(wait_for)))
 
+    def clampSeqs(self, wait_for=None):
+        """Set the clamped positions of the walkers, see initClamp"""
+        self.require('Clamp')
+        self.log("clampSeqs")
+        nseq = self.nseq['main']
+        self.repackedSeqT['main'] = False
+        self.runningE = None
+        return self.logevt('clampSeqs',
+            self.prg.copySubseq(self.queue, (nseq,), (self.wgsize,),
+                            self.seqbufs['clamp'], self.seqbufs['main'],
+                            np.uint32(1), np.uint32(0), self.bufs['markpos'],
+                            wait_for=self._waitevt(wait_for)))
+
     def wait(self):
         self.log("wait")
         self.queue.finish()
@@ -1080,9 +1870,28 @@ def setup_GPU_context(scriptpath, scriptfile, param, log):
 
     #compile CL program
     options = [('q', q), ('L', L), ('NHIST', nhist), ('HISTWS', histws),
-               ('WGSIZE', param.wgsize)]
+               ('WGSIZE', param.wgsize), ('SEQBITS', param.seqbits or 8)]
     if measureFPerror:
         options.append(('MEASURE_FP_ERROR', 1))
+    if param.precision == 'half':
+        options.append(('JHALF', 1))
+    # TEMPERING makes the samplers use the per-walker 'Bs' buffer
+    if (param.tempering is not None or param.annealing is not None or
+            param.design is not None):
+        options.append(('TEMPERING', 1))
+    if param.clamp is not None:
+        options.append(('CLAMP', 1))
+    if param.tempering is not None:
+        options.append(('NTEMPS', len(param.tempering)))
+    if param.proposal in ['indep', 'adaptive']:
+        options.append(('PROPOSAL', 1))
+    if param.proposal == 'adaptive':
+        options.append(('ADAPT_PROPOSAL', 1))
+    if param.gapmoves:
+        options.append(('GAPRES', param.gapres))
+        options.append(('GAPBLOCK', gap_block_max))
+    if param.jumps:
+        options.append(('JUMPS', 1))
     options.append(('BETA', param.beta if param.beta is not None else 1))
     optstr = " ".join(["-D {}={}".format(opt,val) for opt,val in options])
     log("Compilation Options: ", optstr)
@@ -1107,6 +1916,13 @@ def initGPU(devnum, cldat, device, nwalkers, param, log):
     profile = param.profile
     wgsize = param.wgsize
     seed = param.rngseed
+    sampler = param.sampler or 'metropolis'
+    schedule = param.schedule or 'random'
+    precision = param.precision or 'single'
+    jlayout = param.jlayout or 'auto'
+    seqbits = param.seqbits or 8
+    proposal = param.proposal or 'uniform'
+    gapmoves = param.gapmoves or 0
 
     # wgsize = OpenCL work group size for MCMC kernel.
     # (also for other kernels, although would be nice to uncouple them)
@@ -1116,9 +1932,27 @@ def initGPU(devnum, cldat, device, nwalkers, param, log):
     vsize = 1024 #power of 2. Work group size for 1d vector operations.
 
     gpu = MCMCGPU((device, devnum, cl_ctx, cl_prg), L, q,
-                  nwalkers, wgsize, outdir, vsize, seed, profile=profile)
+                  nwalkers, wgsize, outdir, vsize, seed, profile=profile,
+                  sampler=sampler, schedule=schedule, precision=precision,
+                  jlayout=jlayout, seqbits=seqbits, proposal=proposal,
+                  gapmoves=gapmoves, gapres=param.gapres)
     return gpu
 
+def seqbits_heuristic(q, seqbits='auto'):
+    # number of bits per residue in the GPU sequence buffers. 'auto' uses
+    # the fewest bits which can hold q residue values.
+    if seqbits == 'auto':
+        seqbits = 2
+        while 2**seqbits < q:
+            seqbits *= 2
+        return seqbits
+
+    seqbits = int(seqbits)
+    if 2**seqbits < q:
+        raise Exception("Must have 2^seqbits >= q, but got seqbits={} "
+                        "for q={}".format(seqbits, q))
+    return seqbits
+
 def wgsize_heuristic(q, wgsize='auto'):
     if wgsize == 'auto':
         wgsize = 256
@@ -277,6 +277,28 @@ class MPI_GPU_node(GPU_node, MPI_comm_Mixin):
     def initJstep(self):
         self.isend('initJstep')
 
+    def initTempering(self, betas):
+        self.isend('initTempering')
+        self.isend(betas)
+
+    def initAnnealing(self):
+        self.isend('initAnnealing')
+
+    def initJumps(self, jumprate, unimarg=None, msaseqs=None):
+        self.isend('initJumps')
+        self.isend((jumprate, unimarg, msaseqs))
+
+    def initDesign(self):
+        self.isend('initDesign')
+
+    def initClamp(self, clampseq, marks):
+        self.isend('initClamp')
+        self.isend((clampseq, marks))
+
+    def initAIS(self, dJ):
+        self.isend('initAIS')
+        self.isend(dJ)
+
     def prepare_indep(self, unimarg):
         self.isend('prepare_indep')
         self.isend(unimarg)
@@ -305,6 +327,18 @@ class MPI_GPU_node(GPU_node, MPI_comm_Mixin):
         self.isend('updateJ')
         self.isend((gamma, pc, Jbuf))
 
+    def initOptimizer(self, optimizer):
+        self.isend('initOptimizer')
+        self.isend(optimizer)
+
+    def updateJ_adam(self, gamma, pc, b1, b2, t):
+        self.isend('updateJ_adam')
+        self.isend((gamma, pc, b1, b2, t))
+
+    def momentumStep(self, mu):
+        self.isend('momentumStep')
+        self.isend(mu)
+
     def reg(self, name, param):
         self.isend('reg')
         self.isend((name, param))
@@ -313,6 +347,16 @@ class MPI_GPU_node(GPU_node, MPI_comm_Mixin):
         self.isend('calcWeights')
         self.isend(seqbufname)
 
+    def logWeightStats(self, n):
+        self.isend('logWeightStats')
+        self.isend(n)
+
+    def saveJstep(self):
+        self.isend('saveJstep')
+
+    def restoreJstep(self):
+        self.isend('restoreJstep')
+
     def weightedMarg(self, seqbufname):
         self.isend('weightedMarg')
         self.isend(seqbufname)
@@ -400,6 +444,44 @@ class MPI_GPU_node(GPU_node, MPI_comm_Mixin):
     def clearLargeSeqs(self):
         self.isend('clearLargeSeqs')
 
+    def setNStored(self, nstores):
+        self.isend('setNStored')
+        self.isend(nstores)
+
+    def doubleWalkers(self):
+        self.isend('doubleWalkers')
+        self._nwalkers *= 2
+        self._nseq['main'] *= 2
+
+    def clampSeqs(self):
+        self.isend('clampSeqs')
+
+    def aisStep(self, dB):
+        self.isend('aisStep')
+        self.isend(dB)
+
+    def swapTemps(self, nswaps):
+        self.isend('swapTemps')
+        self.isend(nswaps)
+
+    def clearSwapCounts(self):
+        self.isend('clearSwapCounts')
+
+    def resampleWalkers(self, dB):
+        self.isend('resampleWalkers')
+        self.isend(dB)
+
+    def updateBest(self):
+        self.isend('updateBest')
+
+    def greedyDescent(self, nsweeps):
+        self.isend('greedyDescent')
+        self.isend(nsweeps)
+
+    def storeTempSeqs(self, tempind=-1):
+        self.isend('storeTempSeqs')
+        self.isend(tempind)
+
     def reduce_node_bimarg(self):
         self.isend('reduce_node_bimarg')
 
@@ -455,6 +537,26 @@ class MPI_worker(GPU_node, MPI_comm_Mixin):
         nseq = self.recv()
         super().initLargeBufs(nseq)
 
+    def initTempering(self):
+        betas = self.recv()
+        super().initTempering(betas)
+
+    def initJumps(self):
+        args = self.recv()
+        super().initJumps(*args)
+
+    def initClamp(self):
+        args = self.recv()
+        super().initClamp(*args)
+
+    def initAIS(self):
+        dJ = self.recv()
+        super().initAIS(dJ)
+
+    def aisStep(self):
+        dB = self.recv()
+        super().aisStep(dB)
+
     def prepare_indep(self):
         unimarg = self.recv()
         super().prepare_indep(unimarg)
@@ -480,6 +582,18 @@ class MPI_worker(GPU_node, MPI_comm_Mixin):
         args = self.recv()
         super().updateJ(*args)
 
+    def initOptimizer(self):
+        optimizer = self.recv()
+        super().initOptimizer(optimizer)
+
+    def updateJ_adam(self):
+        args = self.recv()
+        super().updateJ_adam(*args)
+
+    def momentumStep(self):
+        mu = self.recv()
+        super().momentumStep(mu)
+
     def reg(self):
         args = self.recv()
         super().reg(*args)
@@ -488,6 +602,10 @@ class MPI_worker(GPU_node, MPI_comm_Mixin):
         seqbufname = self.recv()
         super().calcWeights(seqbufname)
 
+    def logWeightStats(self):
+        n = self.recv()
+        super().logWeightStats(n)
+
     def weightedMarg(self):
         seqbufname = self.recv()
         super().weightedMarg(seqbufname)
@@ -577,6 +695,26 @@ class MPI_worker(GPU_node, MPI_comm_Mixin):
         for gpu in self.gpus:
             gpu.storeSeqs(seqs)
 
+    def setNStored(self):
+        nstores = self.recv()
+        super().setNStored(nstores)
+
+    def swapTemps(self):
+        nswaps = self.recv()
+        super().swapTemps(nswaps)
+
+    def storeTempSeqs(self):
+        tempind = self.recv()
+        super().storeTempSeqs(tempind)
+
+    def resampleWalkers(self):
+        dB = self.recv()
+        super().resampleWalkers(dB)
+
+    def greedyDescent(self):
+        nsweeps = self.recv()
+        super().greedyDescent(nsweeps)
+
     def merge_bimarg(self):
         # this is implemented on manager's node_controller
         raise NotImplementedError
@@ -72,11 +72,13 @@ class GPU_node:
 
     def initMCMC(self, nsteps):
         # rng_span is the rng stream range assigned per GPU, used to compute
-        # mutant residues. Here we just take the full span (2**63) and divide
-        # it evenly per gpu. Note this is the same in all runs of the program
-        # (only the random position gets changed by numpy random seed).
+        # mutant residues. Here we just take the first half of the full span
+        # (2**63) and divide it evenly per gpu. The second half is used for
+        # the mutation positions, which all GPUs share (see
+        # MCMCGPU.initPosRNG). Note this is the same in all runs of the
+        # program (only the positions get changed by the random seed).
         # mwc64x period is 2**63
-        rng_span = np.uint64(2**63)//np.uint64(self.ngpus) 
+        rng_span = np.uint64(2**62)//np.uint64(self.ngpus)
         rng_offsets = [i*rng_span for i in range(self.ngpus)]
         self._initMCMC_rng(nsteps, rng_offsets, rng_span)
 
@@ -100,6 +102,30 @@ class GPU_node:
         for gpu in self.gpus:
             gpu.initSubseq()
 
+    def initTempering(self, betas):
+        for gpu in self.gpus:
+            gpu.initTempering(betas)
+
+    def initAnnealing(self):
+        for gpu in self.gpus:
+            gpu.initAnnealing()
+
+    def initJumps(self, jumprate, unimarg=None, msaseqs=None):
+        for gpu in self.gpus:
+            gpu.initJumps(jumprate, unimarg, msaseqs)
+
+    def initDesign(self):
+        for gpu in self.gpus:
+            gpu.initDesign()
+
+    def initClamp(self, clampseq, marks):
+        for gpu in self.gpus:
+            gpu.initClamp(clampseq, marks)
+
+    def initAIS(self, dJ):
+        for gpu in self.gpus:
+            gpu.initAIS(dJ)
+
     def logProfile(self):
         for gpu in self.gpus:
             gpu.logProfile()
@@ -132,6 +158,18 @@ class GPU_node:
         for gpu in self.gpus:
             gpu.updateJ(gamma, pc, Jbuf)
 
+    def initOptimizer(self, optimizer):
+        for gpu in self.gpus:
+            gpu.initOptimizer(optimizer)
+
+    def updateJ_adam(self, gamma, pc, b1, b2, t):
+        for gpu in self.gpus:
+            gpu.updateJ_adam(gamma, pc, b1, b2, t)
+
+    def momentumStep(self, mu):
+        for gpu in self.gpus:
+            gpu.momentumStep(mu)
+
     def reg(self, name, param):
         meth = 'reg_{}'.format(name)
         for gpu in self.gpus:
@@ -145,6 +183,18 @@ class GPU_node:
         for gpu in self.gpus:
             gpu.weight_statistics(buf)
 
+    def logWeightStats(self, n):
+        for gpu in self.gpus:
+            gpu.logWeightStats(n)
+
+    def saveJstep(self):
+        for gpu in self.gpus:
+            gpu.saveJstep()
+
+    def restoreJstep(self):
+        for gpu in self.gpus:
+            gpu.restoreJstep()
+
     def dE_to_weights(self, offset=0., buf='main'):
         for gpu in self.gpus:
             gpu.dE_to_weights(offset, buf)
@@ -178,6 +228,7 @@ class GPU_node:
         'weights': skip_single(np.concatenate),
         'E': skip_single(np.concatenate),
         'Bs': skip_single(np.concatenate),
+        'swaps': skip_single(sumarr),
         'bicount': skip_single(sumarr),
         'bi': skip_single(meanarr),
         'seq': skip_single(np.concatenate)}
@@ -239,6 +290,14 @@ class GPU_node:
         for gpu in self.gpus:
             gpu.markPos(marks)
 
+    def clampSeqs(self):
+        for gpu in self.gpus:
+            gpu.clampSeqs()
+
+    def aisStep(self, dB):
+        for gpu in self.gpus:
+            gpu.aisStep(dB)
+
     def storeSeqs(self, seqs=None):
         for gpu in self.gpus:
             gpu.storeSeqs(seqs)
@@ -247,10 +306,42 @@ class GPU_node:
         for gpu in self.gpus:
             gpu.clearLargeSeqs()
 
+    def setNStored(self, nstores):
+        for gpu in self.gpus:
+            gpu.setNStored(nstores)
+
+    def doubleWalkers(self):
+        for gpu in self.gpus:
+            gpu.doubleWalkers()
+
     def copySubseq(self, seqind):
         for gpu in self.gpus:
             gpu.copySubseq(seqind)
 
+    def swapTemps(self, nswaps):
+        for gpu in self.gpus:
+            gpu.swapTemps(nswaps)
+
+    def clearSwapCounts(self):
+        for gpu in self.gpus:
+            gpu.clearSwapCounts()
+
+    def resampleWalkers(self, dB):
+        for gpu in self.gpus:
+            gpu.resampleWalkers(dB)
+
+    def updateBest(self):
+        for gpu in self.gpus:
+            gpu.updateBest()
+
+    def greedyDescent(self, nsweeps):
+        for gpu in self.gpus:
+            gpu.greedyDescent(nsweeps)
+
+    def storeTempSeqs(self, tempind=-1):
+        for gpu in self.gpus:
+            gpu.storeTempSeqs(tempind)
+
     def reduce_node_bimarg(self):
         # each gpu has its own bimarg computed for its sequences. We want to
         # sum the bimarg to get the total bimarg, so need to share the bimarg
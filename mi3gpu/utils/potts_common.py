@@ -167,6 +167,27 @@ def getRddE(J):
     R = R/(4*(q-1)**2)
     return R, dR
 
+# Mutation positions are drawn from mwc64x streams in the second half of the
+# rng period (the walkers use the first half), one stream per block of L
+# positions. The streams are the same on all devices and for the GPU and CPU
+# backends, see posrng_streams.
+posrng_offset = 1 << 62
+posrng_span = 1 << 61
+
+def posrng_streams(L, npos, seed):
+    # Returns the number of position blocks (a multiple of 64) needed for npos
+    # positions, and the rng offset and span of the streams of the blocks.
+    # The seed shifts all streams by less than half their span, so the streams
+    # of different blocks do not overlap. Computed with python ints, since
+    # with numpy ints (eg a np.uint32 nsteps) the 64 bit offset is rounded
+    # through float64.
+    L, npos, seed = int(L), int(npos), int(seed)
+    nblocks = (npos - 1)//L + 1
+    nblocks = ((nblocks - 1)//64 + 1)*64
+    block_span = posrng_span//(2*nblocks)
+    shift = ((seed*0x9E3779B97F4A7C15) % (1 << 64)) % (block_span//2)
+    return nblocks, posrng_offset + shift, block_span
+
 def printsome(a, prec=4):
     return np.array2string(a.flatten()[:5], precision=prec, sign=' ')[1:-1]
 
@@ -18,6 +18,8 @@
 #include "Python.h"
 #include <stdlib.h>
 #include <stdio.h>
+#include <math.h>
+#include <pthread.h>
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #include "numpy/arrayobject.h"
 
@@ -1255,6 +1257,965 @@ translateascii(PyObject *self, PyObject *args){
     Py_RETURN_NONE;
 }
 
+/*
+ * Metropolis sampler and energy computation on the CPU.
+ *
+ * These use the same buffer formats as the kernels in mcmc.cl: sequences are
+ * packed 4 residues per uint32 in a (SWORDS, buflen) array like the 'seq main'
+ * GPU buffer, couplings are either in the packed (nPairs, q*q) 'J' format or
+ * the (L*L, q*q) 'Junpacked' format, and the rng is the same mwc64xvec2
+ * generator, so given the same inputs the sampled sequences are the same as
+ * on the GPU. Walkers are divided over nthreads threads which run without
+ * the GIL.
+ */
+
+// mwc64xvec2 rng, same as mwc64x/cl/mwc64x/mwc64xvec2_rng.cl
+
+typedef struct { uint32 x[2]; uint32 c[2]; } mwc64xvec2_state_t;
+
+#define MWC64XVEC2_A 4294883355U
+#define MWC64XVEC2_M 18446383549859758079ULL
+#define MWC_BASEID 4077358422479273989ULL
+
+static uint64
+MWC_MulMod64(uint64 a, uint64 b, uint64 M){
+    return (uint64)(((unsigned __int128)a*b) % M);
+}
+
+static uint64
+MWC_PowMod64(uint64 a, uint64 e, uint64 M){
+    uint64 sqr = a, acc = 1;
+    while(e != 0){
+        if(e & 1){
+            acc = MWC_MulMod64(acc, sqr, M);
+        }
+        sqr = MWC_MulMod64(sqr, sqr, M);
+        e = e >> 1;
+    }
+    return acc;
+}
+
+static void
+MWC64XVEC2_SeedStreams(mwc64xvec2_state_t *s, uint64 baseOffset,
+                       uint64 perStreamOffset, uint64 gid){
+    int k;
+    for(k = 0; k < 2; k++){
+        uint64 dist = baseOffset + (gid*2 + k)*perStreamOffset;
+        uint64 m = MWC_PowMod64(MWC64XVEC2_A, dist, MWC64XVEC2_M);
+        uint64 x = MWC_MulMod64(MWC_BASEID, m, MWC64XVEC2_M);
+        s->x[k] = (uint32)(x/MWC64XVEC2_A);
+        s->c[k] = (uint32)(x%MWC64XVEC2_A);
+    }
+}
+
+static inline void
+MWC64XVEC2_NextUint2(mwc64xvec2_state_t *s, uint32 *res){
+    int k;
+    for(k = 0; k < 2; k++){
+        uint32 X = s->x[k], C = s->c[k];
+        res[k] = X ^ C;
+        uint32 Xn = MWC64XVEC2_A*X + C;
+        uint32 carry = Xn < C;
+        s->x[k] = Xn;
+        s->c[k] = (uint32)(((uint64)MWC64XVEC2_A*X) >> 32) + carry;
+    }
+}
+
+static inline float
+uniformMap(uint32 i){
+    return (i>>8)*0x1.0p-24f; //converts a 32 bit integer to a float [0,1)
+}
+
+#define getbyte(mem, n) (((uint8*)(mem))[n])
+
+// walkers are processed in blocks of this size, so that each coupling row
+// loaded into cache is reused by all walkers in the block
+#define WALKER_BLOCK 64
+
+static void
+unpack_block(uint8 *seqs, uint32 *seqmem, npy_intp buflen, npy_intp w0,
+             npy_intp nw, uint32 L){
+    npy_intp n;
+    uint32 pos;
+    for(pos = 0; pos < L; pos++){
+        uint32 *row = &seqmem[(pos/4)*buflen + w0];
+        for(n = 0; n < nw; n++){
+            seqs[n*L + pos] = getbyte(&row[n], pos%4);
+        }
+    }
+}
+
+static void
+pack_block(uint8 *seqs, uint32 *seqmem, npy_intp buflen, npy_intp w0,
+           npy_intp nw, uint32 L){
+    npy_intp n;
+    uint32 pos;
+    for(pos = 0; pos < L; pos++){
+        uint32 *row = &seqmem[(pos/4)*buflen + w0];
+        for(n = 0; n < nw; n++){
+            ((uint8*)&row[n])[pos%4] = seqs[n*L + pos];
+        }
+    }
+}
+
+typedef struct {
+    float *J;
+    uint32 *seqmem;
+    npy_intp buflen;
+    mwc64xvec2_state_t *rngstates;
+    uint32 *positions;
+    npy_intp nsteps;
+    float *betas;
+    float *energies; // optional for the samplers, running walker energies
+    uint32 *naccept; // optional, number of changed residues per walker
+    float *proposal; // optional, (L, q) proposal probabilities
+    uint32 *propcounts; // optional, (2, L, q) tried/accepted proposals
+    uint8 *markpos; // optional, L flags of positions never mutated
+    uint32 L, q;
+    npy_intp start, end; // range of walkers for this thread
+    int err;
+} mcmc_thread_args;
+
+// Draws the proposed residue of the metropolis samplers: uniformly if there
+// is no proposal table, otherwise like proposeRes in mcmc.cl. Sets *hastings
+// to the Hastings factor of the move.
+static inline uint32
+propose_res(mcmc_thread_args *a, uint32 pos, uint32 seqp, uint32 r,
+            float *hastings){
+    uint32 k, q = a->q, mutres = q-1;
+    float *p, u, cumprob = 0;
+
+    if(a->proposal == NULL){
+        *hastings = 1;
+        return r%q;
+    }
+
+    p = &a->proposal[pos*q];
+    u = uniformMap(r);
+    for(k = 0; k < q-1; k++){
+        cumprob += p[k];
+        if(u < cumprob){
+            mutres = k;
+            break;
+        }
+    }
+    *hastings = p[seqp]/p[mutres];
+    return mutres;
+}
+
+// whether moves at pos are forbidden, like clamped in mcmc.cl
+static inline int
+is_clamped(mcmc_thread_args *a, uint32 pos){
+    return a->markpos != NULL && a->markpos[pos];
+}
+
+// counts proposals per thread in counts, like countProposal in mcmc.cl
+static inline void
+count_proposal(uint32 *counts, uint32 L, uint32 q, uint32 pos,
+               uint32 mutres, uint32 seqp, int accepted){
+    if(counts != NULL && mutres != seqp){
+        counts[pos*q + mutres]++;
+        if(accepted){
+            counts[(L + pos)*q + mutres]++;
+        }
+    }
+}
+
+// adds the thread's proposal counts to the shared ones
+static void
+merge_counts(mcmc_thread_args *a, uint32 *counts){
+    uint32 k;
+    if(counts == NULL){
+        return;
+    }
+    for(k = 0; k < 2*a->L*a->q; k++){
+        __atomic_fetch_add(&a->propcounts[k], counts[k], __ATOMIC_RELAXED);
+    }
+    free(counts);
+}
+
+static void *
+metropolis_thread(void *vargs){
+    mcmc_thread_args *a = vargs;
+    uint32 L = a->L, q = a->q, qq = q*q;
+    npy_intp w0, n, i;
+    uint32 m;
+    uint8 *seqs = malloc(WALKER_BLOCK*L);
+    uint32 *counts = NULL;
+    mwc64xvec2_state_t rstate[WALKER_BLOCK];
+    uint32 nacc[WALKER_BLOCK];
+    float E[WALKER_BLOCK];
+
+    if(a->propcounts != NULL){
+        counts = calloc(2*L*q, sizeof(uint32));
+    }
+    if(seqs == NULL || (a->propcounts != NULL && counts == NULL)){
+        free(seqs);
+        free(counts);
+        a->err = 1;
+        return NULL;
+    }
+
+    for(w0 = a->start; w0 < a->end; w0 += WALKER_BLOCK){
+        npy_intp nw = a->end - w0 < WALKER_BLOCK ? a->end - w0 : WALKER_BLOCK;
+
+        unpack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            rstate[n] = a->rngstates[w0 + n];
+            nacc[n] = 0;
+            E[n] = a->energies != NULL ? a->energies[w0 + n] : 0;
+        }
+
+        for(i = 0; i < a->nsteps; i++){
+            uint32 pos = a->positions[i];
+            float *Jpos = &a->J[(npy_intp)pos*L*qq];
+
+            for(n = 0; n < nw; n++){
+                uint8 *s = &seqs[n*L];
+                uint32 rng[2];
+                float hastings;
+                MWC64XVEC2_NextUint2(&rstate[n], rng);
+                uint32 seqp = s[pos];
+                uint32 mutres = propose_res(a, pos, seqp, rng[0], &hastings);
+
+                // same summation order as DeltaEnergy in mcmc.cl
+                float *Jm = &Jpos[q*mutres], *Jp = &Jpos[q*seqp];
+                float dE = 0;
+                for(m = 0; m < L; m++){
+                    if(m != pos){
+                        dE += Jm[m*qq + s[m]] - Jp[m*qq + s[m]];
+                    }
+                }
+
+                //apply MC criterion and possibly update
+                int accept = !is_clamped(a, pos) &&
+                             expf(-a->betas[w0 + n]*dE)*hastings >
+                             uniformMap(rng[1]);
+                if(accept){
+                    nacc[n] += mutres != seqp;
+                    s[pos] = mutres;
+                    E[n] += dE;
+                }
+                count_proposal(counts, L, q, pos, mutres, seqp, accept);
+            }
+        }
+
+        pack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            a->rngstates[w0 + n] = rstate[n];
+            if(a->naccept != NULL){
+                a->naccept[w0 + n] = nacc[n];
+            }
+            if(a->energies != NULL){
+                a->energies[w0 + n] = E[n];
+            }
+        }
+    }
+
+    merge_counts(a, counts);
+    free(seqs);
+    return NULL;
+}
+
+static void *
+gibbs_thread(void *vargs){
+    mcmc_thread_args *a = vargs;
+    uint32 L = a->L, q = a->q, qq = q*q;
+    npy_intp w0, n, i;
+    uint32 m, r;
+    uint8 *seqs = malloc(WALKER_BLOCK*L);
+    float *condE = malloc(q*sizeof(float));
+    mwc64xvec2_state_t rstate[WALKER_BLOCK];
+    uint32 nacc[WALKER_BLOCK];
+    float E[WALKER_BLOCK];
+
+    if(seqs == NULL || condE == NULL){
+        free(seqs);
+        free(condE);
+        a->err = 1;
+        return NULL;
+    }
+
+    for(w0 = a->start; w0 < a->end; w0 += WALKER_BLOCK){
+        npy_intp nw = a->end - w0 < WALKER_BLOCK ? a->end - w0 : WALKER_BLOCK;
+
+        unpack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            rstate[n] = a->rngstates[w0 + n];
+            nacc[n] = 0;
+            E[n] = a->energies != NULL ? a->energies[w0 + n] : 0;
+        }
+
+        for(i = 0; i < a->nsteps; i++){
+            uint32 pos = a->positions[i];
+            float *Jpos = &a->J[(npy_intp)pos*L*qq];
+
+            for(n = 0; n < nw; n++){
+                uint8 *s = &seqs[n*L];
+                uint32 rng[2];
+                float B = a->betas[w0 + n];
+                MWC64XVEC2_NextUint2(&rstate[n], rng);
+
+                // same summation order as ConditionalEnergies in mcmc.cl
+                for(r = 0; r < q; r++){
+                    condE[r] = 0;
+                }
+                for(m = 0; m < L; m++){
+                    if(m != pos){
+                        float *Jm = &Jpos[m*qq + s[m]];
+                        for(r = 0; r < q; r++){
+                            condE[r] += Jm[q*r];
+                        }
+                    }
+                }
+
+                float Emin = condE[0], Z = 0, cumprob = 0;
+                for(r = 1; r < q; r++){
+                    Emin = condE[r] < Emin ? condE[r] : Emin;
+                }
+                // recomputed in the search so condE keeps the energies
+                for(r = 0; r < q; r++){
+                    Z += expf(-B*(condE[r] - Emin));
+                }
+
+                float u = uniformMap(rng[0])*Z;
+                uint32 mutres = q-1;
+                for(r = 0; r < q-1; r++){
+                    cumprob += expf(-B*(condE[r] - Emin));
+                    if(u < cumprob){
+                        mutres = r;
+                        break;
+                    }
+                }
+                if(is_clamped(a, pos)){
+                    mutres = s[pos];
+                }
+                if(mutres != s[pos]){
+                    nacc[n]++;
+                    E[n] += condE[mutres] - condE[s[pos]];
+                }
+                s[pos] = mutres;
+            }
+        }
+
+        pack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            a->rngstates[w0 + n] = rstate[n];
+            if(a->naccept != NULL){
+                a->naccept[w0 + n] = nacc[n];
+            }
+            if(a->energies != NULL){
+                a->energies[w0 + n] = E[n];
+            }
+        }
+    }
+
+    free(condE);
+    free(seqs);
+    return NULL;
+}
+
+static void *
+metropolis_fields_thread(void *vargs){
+    mcmc_thread_args *a = vargs;
+    uint32 L = a->L, q = a->q, qq = q*q, Lq = L*q;
+    npy_intp w0, n, i;
+    uint32 m, k, r;
+    uint8 *seqs = malloc(WALKER_BLOCK*L);
+    float *fields = malloc(WALKER_BLOCK*Lq*sizeof(float));
+    uint32 *counts = NULL;
+    mwc64xvec2_state_t rstate[WALKER_BLOCK];
+    uint32 nacc[WALKER_BLOCK];
+    float E[WALKER_BLOCK];
+
+    if(a->propcounts != NULL){
+        counts = calloc(2*Lq, sizeof(uint32));
+    }
+    if(seqs == NULL || fields == NULL ||
+            (a->propcounts != NULL && counts == NULL)){
+        free(seqs);
+        free(fields);
+        free(counts);
+        a->err = 1;
+        return NULL;
+    }
+
+    for(w0 = a->start; w0 < a->end; w0 += WALKER_BLOCK){
+        npy_intp nw = a->end - w0 < WALKER_BLOCK ? a->end - w0 : WALKER_BLOCK;
+
+        unpack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            rstate[n] = a->rngstates[w0 + n];
+            nacc[n] = 0;
+            E[n] = a->energies != NULL ? a->energies[w0 + n] : 0;
+        }
+
+        // fill in the field table, same summation order as the
+        // metropolis_fields kernel in mcmc.cl
+        for(n = 0; n < nw; n++){
+            uint8 *s = &seqs[n*L];
+            float *f = &fields[n*Lq];
+            for(m = 0; m < L; m++){
+                float *Jrow = &a->J[(npy_intp)m*L*qq];
+                for(r = 0; r < q; r++){
+                    f[m*q + r] = 0;
+                }
+                for(k = 0; k < L; k++){
+                    if(k != m){
+                        float *Jk = &Jrow[k*qq + s[k]];
+                        for(r = 0; r < q; r++){
+                            f[m*q + r] += Jk[q*r];
+                        }
+                    }
+                }
+            }
+        }
+
+        for(i = 0; i < a->nsteps; i++){
+            uint32 pos = a->positions[i];
+
+            for(n = 0; n < nw; n++){
+                uint8 *s = &seqs[n*L];
+                float *f = &fields[n*Lq];
+                uint32 rng[2];
+                float hastings;
+                MWC64XVEC2_NextUint2(&rstate[n], rng);
+                uint32 seqp = s[pos];
+                uint32 mutres = propose_res(a, pos, seqp, rng[0], &hastings);
+
+                float dE = f[pos*q + mutres] - f[pos*q + seqp];
+
+                //apply MC criterion and possibly update
+                int accept = !is_clamped(a, pos) &&
+                             expf(-a->betas[w0 + n]*dE)*hastings >
+                             uniformMap(rng[1]);
+                count_proposal(counts, L, q, pos, mutres, seqp, accept);
+                if(accept && mutres != seqp){
+                    s[pos] = mutres;
+                    nacc[n]++;
+                    E[n] += dE;
+                    for(m = 0; m < L; m++){
+                        float *Jm = &a->J[((npy_intp)m*L + pos)*qq];
+                        if(m == pos){
+                            continue;
+                        }
+                        for(r = 0; r < q; r++){
+                            f[m*q + r] += Jm[q*r + mutres] - Jm[q*r + seqp];
+                        }
+                    }
+                }
+            }
+        }
+
+        pack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            a->rngstates[w0 + n] = rstate[n];
+            if(a->naccept != NULL){
+                a->naccept[w0 + n] = nacc[n];
+            }
+            if(a->energies != NULL){
+                a->energies[w0 + n] = E[n];
+            }
+        }
+    }
+
+    merge_counts(a, counts);
+    free(fields);
+    free(seqs);
+    return NULL;
+}
+
+static void *
+energies_thread(void *vargs){
+    mcmc_thread_args *a = vargs;
+    uint32 L = a->L, q = a->q, qq = q*q;
+    npy_intp w0, n;
+    uint32 i, j;
+    uint8 *seqs = malloc(WALKER_BLOCK*L);
+    float energy[WALKER_BLOCK], rem[WALKER_BLOCK];
+
+    if(seqs == NULL){
+        a->err = 1;
+        return NULL;
+    }
+
+    for(w0 = a->start; w0 < a->end; w0 += WALKER_BLOCK){
+        npy_intp nw = a->end - w0 < WALKER_BLOCK ? a->end - w0 : WALKER_BLOCK;
+        float *Jpair = a->J;
+
+        unpack_block(seqs, a->seqmem, a->buflen, w0, nw, L);
+        for(n = 0; n < nw; n++){
+            energy[n] = 0;
+            rem[n] = 0;
+        }
+
+        for(i = 0; i < L-1; i++){
+            for(j = i+1; j < L; j++){
+                for(n = 0; n < nw; n++){
+                    uint8 *s = &seqs[n*L];
+                    // Kahan summation, as in getEnergiesf in mcmc.cl
+                    float y = Jpair[q*s[i] + s[j]] - rem[n];
+                    float t = energy[n] + y;
+                    rem[n] = (t - energy[n]) - y;
+                    energy[n] = t;
+                }
+                Jpair += qq;
+            }
+        }
+
+        for(n = 0; n < nw; n++){
+            a->energies[w0 + n] = energy[n];
+        }
+    }
+
+    free(seqs);
+    return NULL;
+}
+
+/*
+ * Runs func over nthreads threads, each given a contiguous range of the
+ * nwalkers walkers. The GIL is released while the threads run.
+ */
+static int
+run_mcmc_threads(void *(*func)(void *), mcmc_thread_args *args,
+                 npy_intp nwalkers, int nthreads){
+    int t, nstarted, err = 0;
+    pthread_t *threads;
+    mcmc_thread_args *targs;
+
+    if(nthreads < 1){
+        PyErr_SetString(PyExc_ValueError, "nthreads must be positive");
+        return -1;
+    }
+    if(nthreads > nwalkers){
+        nthreads = nwalkers > 0 ? nwalkers : 1;
+    }
+
+    threads = malloc(sizeof(pthread_t)*nthreads);
+    targs = malloc(sizeof(mcmc_thread_args)*nthreads);
+    if(threads == NULL || targs == NULL){
+        free(threads);
+        free(targs);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for(t = 0; t < nthreads; t++){
+        targs[t] = *args;
+        // divide walkers in multiples of WALKER_BLOCK where possible
+        targs[t].start = (nwalkers*t/nthreads)/WALKER_BLOCK*WALKER_BLOCK;
+        targs[t].end = (nwalkers*(t+1)/nthreads)/WALKER_BLOCK*WALKER_BLOCK;
+        if(t == nthreads-1){
+            targs[t].end = nwalkers;
+        }
+        targs[t].err = 0;
+    }
+    // the calling thread does the work of thread 0
+    for(nstarted = 1; nstarted < nthreads; nstarted++){
+        if(pthread_create(&threads[nstarted], NULL, func, &targs[nstarted])){
+            err = 1;
+            break;
+        }
+    }
+    if(!err){
+        func(&targs[0]);
+    }
+    for(t = 1; t < nstarted; t++){
+        pthread_join(threads[t], NULL);
+    }
+    for(t = 0; t < nthreads; t++){
+        err |= targs[t].err;
+    }
+    Py_END_ALLOW_THREADS
+
+    free(threads);
+    free(targs);
+    if(err){
+        PyErr_SetString(PyExc_RuntimeError, "mcmc thread failed");
+        return -1;
+    }
+    return 0;
+}
+
+static int
+check_mcmc_seqmem(PyArrayObject *seqmem, uint32 L){
+    if(PyArray_NDIM(seqmem) != 2 || PyArray_TYPE(seqmem) != NPY_UINT32 ||
+            !PyArray_ISCARRAY(seqmem)){
+        PyErr_SetString(PyExc_ValueError,
+                        "seqmem must be a 2d C-contiguous uint32 array");
+        return -1;
+    }
+    if(PyArray_DIM(seqmem, 0) != (L-1)/4+1){
+        PyErr_SetString(PyExc_ValueError,
+                        "seqmem must have shape (SWORDS, nseq) for this L");
+        return -1;
+    }
+    return 0;
+}
+
+static int
+check_mcmc_J(PyArrayObject *J){
+    if(PyArray_NDIM(J) != 2 || PyArray_TYPE(J) != NPY_FLOAT32 ||
+            !PyArray_ISCARRAY_RO(J)){
+        PyErr_SetString(PyExc_ValueError,
+                        "J must be a 2d C-contiguous float32 array");
+        return -1;
+    }
+    return 0;
+}
+
+static int
+check_rngstates(PyArrayObject *rngstates, npy_intp nwalkers){
+    if(!PyArray_ISCARRAY(rngstates) ||
+            PyArray_NBYTES(rngstates) !=
+                (npy_intp)(nwalkers*sizeof(mwc64xvec2_state_t))){
+        PyErr_SetString(PyExc_ValueError, "rngstates must be a writeable "
+                        "C-contiguous array of 16 bytes per walker");
+        return -1;
+    }
+    return 0;
+}
+
+static uint32
+isqrt(npy_intp n){
+    uint32 r = (uint32)sqrt((double)n);
+    while((npy_intp)r*r > n){
+        r--;
+    }
+    while((npy_intp)(r+1)*(r+1) <= n){
+        r++;
+    }
+    return r;
+}
+
+/*
+ * Seeds the mwc64xvec2 rng streams of each walker, like the initRNG2 kernel.
+ */
+static PyObject *
+initRNG2(PyObject *self, PyObject *args){
+    PyArrayObject *rngstates;
+    unsigned long long offset, walker_span;
+    mwc64xvec2_state_t *states;
+    npy_intp n, nwalkers;
+
+    if(!PyArg_ParseTuple(args, "O!KK", &PyArray_Type, &rngstates, &offset,
+                         &walker_span)){
+        return NULL;
+    }
+
+    nwalkers = PyArray_NBYTES(rngstates)/sizeof(mwc64xvec2_state_t);
+    if(check_rngstates(rngstates, nwalkers) < 0){
+        return NULL;
+    }
+
+    states = PyArray_DATA(rngstates);
+    Py_BEGIN_ALLOW_THREADS
+    for(n = 0; n < nwalkers; n++){
+        MWC64XVEC2_SeedStreams(&states[n], offset, walker_span, n);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+/*
+ * Fills positions with blocks of L mutation positions, one block per position
+ * rng stream in posrng, like the genPositions kernel. schedule is 0 for
+ * random positions, 1 for a systematic sweep, 2 for random permutations.
+ */
+static PyObject *
+genPositions(PyObject *self, PyObject *args){
+    PyArrayObject *posrng, *positions;
+    unsigned int L, schedule;
+    mwc64xvec2_state_t *states;
+    uint32 *pos;
+    npy_intp b, nblocks;
+
+    if(!PyArg_ParseTuple(args, "O!O!II", &PyArray_Type, &posrng,
+                         &PyArray_Type, &positions, &L, &schedule)){
+        return NULL;
+    }
+
+    nblocks = PyArray_NBYTES(posrng)/sizeof(mwc64xvec2_state_t);
+    if(check_rngstates(posrng, nblocks) < 0){
+        return NULL;
+    }
+    if(PyArray_NDIM(positions) != 1 || PyArray_TYPE(positions) != NPY_UINT32 ||
+            !PyArray_ISCARRAY(positions) ||
+            PyArray_DIM(positions, 0) != nblocks*L){
+        PyErr_SetString(PyExc_ValueError, "positions must be a writeable "
+                        "uint32 array of size L*len(posrng)");
+        return NULL;
+    }
+    if(schedule > 2){
+        PyErr_SetString(PyExc_ValueError, "unknown schedule");
+        return NULL;
+    }
+
+    states = PyArray_DATA(posrng);
+    pos = PyArray_DATA(positions);
+    Py_BEGIN_ALLOW_THREADS
+    for(b = 0; b < nblocks; b++){
+        uint32 *bpos = &pos[b*L];
+        uint32 rng[2], i, n = 0;
+
+        // same order of rng use as the genPositions kernel
+        for(i = 0; i < L; i++){
+            if(schedule == 0){
+                if(n++ % 2 == 0){
+                    MWC64XVEC2_NextUint2(&states[b], rng);
+                }
+                bpos[i] = ((uint64)rng[(n-1)%2]*L) >> 32;
+            }
+            else{
+                bpos[i] = i;
+            }
+        }
+        if(schedule == 2){
+            for(i = L-1; i > 0; i--){
+                uint32 j, tmp;
+                if(n++ % 2 == 0){
+                    MWC64XVEC2_NextUint2(&states[b], rng);
+                }
+                j = ((uint64)rng[(n-1)%2]*(i+1)) >> 32;
+                tmp = bpos[i];
+                bpos[i] = bpos[j];
+                bpos[j] = tmp;
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+/*
+ * Runs an MCMC sampler thread function in place on seqmem and rngstates,
+ * like the metropolis, metropolis_fields and gibbs kernels. Takes couplings
+ * in the (L*L, q*q) 'Junpacked' format and a list of nsteps positions, and
+ * uses the per-walker betas. If naccept is given, the number of residues
+ * changed in each walker is written to it. The metropolis samplers draw
+ * proposals from the (L, q) probabilities in proposal if given, and add the
+ * number of tried and accepted proposals of each residue at each position
+ * to the (2, L, q) propcounts if given. If energies is given it must hold
+ * the walker energies, and the energy change of every accepted move is
+ * added to it. Moves at the positions flagged in the uint8 array markpos of
+ * size L are rejected, if it is given.
+ */
+static PyObject *
+run_sampler(PyObject *args, PyObject *kwds, void *(*func)(void *)){
+    PyArrayObject *J, *rngstates, *positions, *betas, *seqmem;
+    PyObject *naccept = Py_None, *proposal = Py_None, *propcounts = Py_None;
+    PyObject *energies = Py_None, *markpos = Py_None;
+    int nthreads = 1;
+    mcmc_thread_args margs;
+    npy_intp i, nwalkers;
+    static char *kwlist[] = {"J", "rngstates", "positions", "betas",
+                             "seqmem", "nthreads", "naccept", "proposal",
+                             "propcounts", "energies", "markpos", NULL};
+
+    if(!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!O!O!|iOOOOO", kwlist,
+            &PyArray_Type, &J, &PyArray_Type, &rngstates,
+            &PyArray_Type, &positions, &PyArray_Type, &betas,
+            &PyArray_Type, &seqmem, &nthreads, &naccept, &proposal,
+            &propcounts, &energies, &markpos)){
+        return NULL;
+    }
+
+    if(check_mcmc_J(J) < 0){
+        return NULL;
+    }
+    margs.L = isqrt(PyArray_DIM(J, 0));
+    margs.q = isqrt(PyArray_DIM(J, 1));
+    if((npy_intp)margs.L*margs.L != PyArray_DIM(J, 0) ||
+            (npy_intp)margs.q*margs.q != PyArray_DIM(J, 1) || margs.q > 256){
+        PyErr_SetString(PyExc_ValueError, "J must have shape (L*L, q*q)");
+        return NULL;
+    }
+    if(check_mcmc_seqmem(seqmem, margs.L) < 0){
+        return NULL;
+    }
+    nwalkers = PyArray_DIM(seqmem, 1);
+
+    if(check_rngstates(rngstates, nwalkers) < 0){
+        return NULL;
+    }
+    if(PyArray_NDIM(betas) != 1 || PyArray_TYPE(betas) != NPY_FLOAT32 ||
+            !PyArray_ISCARRAY_RO(betas) || PyArray_DIM(betas, 0) != nwalkers){
+        PyErr_SetString(PyExc_ValueError,
+                        "betas must be a float32 array of size nseq");
+        return NULL;
+    }
+    if(PyArray_NDIM(positions) != 1 || PyArray_TYPE(positions) != NPY_UINT32 ||
+            !PyArray_ISCARRAY_RO(positions)){
+        PyErr_SetString(PyExc_ValueError,
+                        "positions must be a 1d uint32 array");
+        return NULL;
+    }
+
+    margs.J = PyArray_DATA(J);
+    margs.seqmem = PyArray_DATA(seqmem);
+    margs.buflen = nwalkers;
+    margs.rngstates = PyArray_DATA(rngstates);
+    margs.positions = PyArray_DATA(positions);
+    margs.nsteps = PyArray_DIM(positions, 0);
+    margs.betas = PyArray_DATA(betas);
+    margs.energies = NULL;
+    if(energies != Py_None){
+        PyArrayObject *E = (PyArrayObject*)energies;
+        if(!PyArray_Check(energies) || PyArray_NDIM(E) != 1 ||
+                PyArray_TYPE(E) != NPY_FLOAT32 || !PyArray_ISCARRAY(E) ||
+                PyArray_DIM(E, 0) != nwalkers){
+            PyErr_SetString(PyExc_ValueError,
+                            "energies must be a writeable float32 array of "
+                            "size nseq");
+            return NULL;
+        }
+        margs.energies = PyArray_DATA(E);
+    }
+    margs.naccept = NULL;
+    if(naccept != Py_None){
+        PyArrayObject *nacc = (PyArrayObject*)naccept;
+        if(!PyArray_Check(naccept) || PyArray_NDIM(nacc) != 1 ||
+                PyArray_TYPE(nacc) != NPY_UINT32 || !PyArray_ISCARRAY(nacc) ||
+                PyArray_DIM(nacc, 0) != nwalkers){
+            PyErr_SetString(PyExc_ValueError,
+                            "naccept must be a writeable uint32 array of "
+                            "size nseq");
+            return NULL;
+        }
+        margs.naccept = PyArray_DATA(nacc);
+    }
+    margs.proposal = NULL;
+    if(proposal != Py_None){
+        PyArrayObject *prop = (PyArrayObject*)proposal;
+        if(!PyArray_Check(proposal) || PyArray_NDIM(prop) != 2 ||
+                PyArray_TYPE(prop) != NPY_FLOAT32 ||
+                !PyArray_ISCARRAY_RO(prop) ||
+                PyArray_DIM(prop, 0) != margs.L ||
+                PyArray_DIM(prop, 1) != margs.q){
+            PyErr_SetString(PyExc_ValueError,
+                            "proposal must be a float32 array of shape "
+                            "(L, q)");
+            return NULL;
+        }
+        margs.proposal = PyArray_DATA(prop);
+    }
+    margs.propcounts = NULL;
+    if(propcounts != Py_None){
+        PyArrayObject *pc = (PyArrayObject*)propcounts;
+        if(!PyArray_Check(propcounts) || PyArray_SIZE(pc) != 2*margs.L*margs.q ||
+                PyArray_TYPE(pc) != NPY_UINT32 || !PyArray_ISCARRAY(pc)){
+            PyErr_SetString(PyExc_ValueError,
+                            "propcounts must be a writeable uint32 array of "
+                            "shape (2, L, q)");
+            return NULL;
+        }
+        margs.propcounts = PyArray_DATA(pc);
+    }
+    margs.markpos = NULL;
+    if(markpos != Py_None){
+        PyArrayObject *mp = (PyArrayObject*)markpos;
+        if(!PyArray_Check(markpos) || PyArray_NDIM(mp) != 1 ||
+                PyArray_TYPE(mp) != NPY_UINT8 || !PyArray_ISCARRAY_RO(mp) ||
+                PyArray_DIM(mp, 0) != margs.L){
+            PyErr_SetString(PyExc_ValueError,
+                            "markpos must be a uint8 array of size L");
+            return NULL;
+        }
+        margs.markpos = PyArray_DATA(mp);
+    }
+
+    for(i = 0; i < margs.nsteps; i++){
+        if(margs.positions[i] >= margs.L){
+            PyErr_SetString(PyExc_ValueError, "position out of range");
+            return NULL;
+        }
+    }
+
+    if(run_mcmc_threads(func, &margs, nwalkers, nthreads) < 0){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+metropolis(PyObject *self, PyObject *args, PyObject *kwds){
+    return run_sampler(args, kwds, metropolis_thread);
+}
+
+static PyObject *
+metropolis_fields(PyObject *self, PyObject *args, PyObject *kwds){
+    return run_sampler(args, kwds, metropolis_fields_thread);
+}
+
+static PyObject *
+gibbs(PyObject *self, PyObject *args, PyObject *kwds){
+    return run_sampler(args, kwds, gibbs_thread);
+}
+
+/*
+ * Computes the energies of the first len(energies) sequences in seqmem,
+ * like the getEnergies kernel, using couplings in packed (nPairs, q*q)
+ * format. The result is written to energies.
+ */
+static PyObject *
+getEnergies(PyObject *self, PyObject *args, PyObject *kwds){
+    PyArrayObject *J, *seqmem, *energies;
+    int nthreads = 1;
+    mcmc_thread_args margs;
+    npy_intp nseq, nPairs;
+    static char *kwlist[] = {"J", "seqmem", "energies", "nthreads", NULL};
+
+    if(!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!|i", kwlist,
+            &PyArray_Type, &J, &PyArray_Type, &seqmem,
+            &PyArray_Type, &energies, &nthreads)){
+        return NULL;
+    }
+
+    if(check_mcmc_J(J) < 0){
+        return NULL;
+    }
+    nPairs = PyArray_DIM(J, 0);
+    margs.L = (1 + isqrt(1 + 8*nPairs))/2;
+    margs.q = isqrt(PyArray_DIM(J, 1));
+    if((npy_intp)margs.L*(margs.L-1)/2 != nPairs || margs.L < 2 ||
+            (npy_intp)margs.q*margs.q != PyArray_DIM(J, 1) || margs.q > 256){
+        PyErr_SetString(PyExc_ValueError, "J must have shape (nPairs, q*q)");
+        return NULL;
+    }
+    if(check_mcmc_seqmem(seqmem, margs.L) < 0){
+        return NULL;
+    }
+    if(PyArray_NDIM(energies) != 1 || PyArray_TYPE(energies) != NPY_FLOAT32 ||
+            !PyArray_ISCARRAY(energies)){
+        PyErr_SetString(PyExc_ValueError,
+                        "energies must be a writeable 1d float32 array");
+        return NULL;
+    }
+    nseq = PyArray_DIM(energies, 0);
+    if(nseq > PyArray_DIM(seqmem, 1)){
+        PyErr_SetString(PyExc_ValueError,
+                        "energies is larger than the number of sequences");
+        return NULL;
+    }
+
+    margs.J = PyArray_DATA(J);
+    margs.seqmem = PyArray_DATA(seqmem);
+    margs.buflen = PyArray_DIM(seqmem, 1);
+    margs.energies = PyArray_DATA(energies);
+    margs.naccept = NULL;
+    margs.proposal = NULL;
+    margs.propcounts = NULL;
+    margs.markpos = NULL;
+
+    if(run_mcmc_threads(energies_thread, &margs, nseq, nthreads) < 0){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef SeqtoolsMethods[] = {
     {"nsim", nsim, METH_VARARGS,
             "compute number of similar sequences"},
@@ -1274,6 +2235,20 @@ static PyMethodDef SeqtoolsMethods[] = {
             "remove sequences under a similarity cutoff to another sequence"},
     {"translateascii", translateascii, METH_VARARGS,
             "translate sequence buffer from scii to integers"},
+    {"initRNG2", initRNG2, METH_VARARGS,
+            "seed mwc64xvec2 rng states of each walker"},
+    {"genPositions", genPositions, METH_VARARGS,
+            "generate mutation positions from mwc64xvec2 rng streams"},
+    {"metropolis", (PyCFunction)metropolis, METH_VARARGS | METH_KEYWORDS,
+            "run Metropolis MCMC on packed sequences, multi-threaded"},
+    {"metropolis_fields", (PyCFunction)metropolis_fields,
+            METH_VARARGS | METH_KEYWORDS,
+            "run Metropolis MCMC using a table of local fields, "
+            "multi-threaded"},
+    {"gibbs", (PyCFunction)gibbs, METH_VARARGS | METH_KEYWORDS,
+            "run heat-bath MCMC on packed sequences, multi-threaded"},
+    {"getEnergies", (PyCFunction)getEnergies, METH_VARARGS | METH_KEYWORDS,
+            "compute energies of packed sequences, multi-threaded"},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
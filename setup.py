@@ -5,7 +5,8 @@ import setuptools
 seqtools_module = setuptools.Extension('mi3gpu.utils.seqtools',
                     sources = ['mi3gpu/utils/seqtools.c'],
                     include_dirs=['/opt/conda/lib/python3.10/site-packages/numpy/core/include'],
-                    extra_compile_args = ['-O3', '-Wall'])
+                    extra_compile_args = ['-O3', '-Wall', '-pthread'],
+                    extra_link_args = ['-pthread'])
 
 with open("README.md", "r") as fh:
     long_description = fh.read()